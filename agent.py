@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Агент, выполняемый на хосте. Копируется туда один раз за установку и запускается python3,
+# поэтому использует только стандартную библиотеку.
+#   python3 agent.py verify [-j N] [-T список] base.txt
+# Проверка текущего каталога по манифесту: файлы с ошибкой выводятся по одному в строке по мере нахождения.
+# -T - проверить только файлы из списка (по одному в строке, - - из stdin).
+#   python3 agent.py receive [--rest] [--delete] [-j N] base.txt < tar
+# Распаковка tar из stdin в текущий каталог с подсчётом сумм по мере записи (повторно файлы не читаются).
+# Манифест берётся из потока (отправитель передаёт его первым) или, если его там нет, с диска.
+# --rest - прочитать и проверить файлы манифеста, которых не было в потоке; --delete - удалить файлы не из потока.
+# Код возврата: 0 - всё совпало, 1 - есть ошибки, 2 - манифест или поток не прочитаны.
+#   python3 agent.py prune < список
+# Удаление из текущего каталога всех файлов, которых нет в списке (по одному в строке).
+#   python3 agent.py serve
+# Сессия: запросы и ответы кадрами в stdin/stdout, один процесс на хост на всю установку, см. serve.
+#   python3 agent.py chain < заголовок + tar
+# Звено цепочки: tar распаковывается как в receive и одновременно передаётся следующему звену, см. chain.
+#
+# Манифест: строки "<алгоритм> <сумма> <путь>", алгоритм - один из ALGORITHMS.
+# Старые проверяющие (verify-md5) учитывают только строки md5 и молча пропускают остальные, поэтому манифест
+# с другими алгоритмами начинается со строки "manifest 2": её версию старше MANIFEST_VERSION агент не принимает.
+
+import os
+import sys
+import glob
+import json
+import mmap
+import time
+import queue
+import shutil
+import struct
+import tarfile
+import hashlib
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+MANIFEST_VERSION = 2
+ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b', 'blake2s')
+MMAP_THRESHOLD = 8 * 1024 * 1024  # Файлы больше читаются через mmap
+CHUNK = 8 * 1024 * 1024
+CHAIN_TIMEOUT = 60  # Сколько секунд ждать, пока следующее звено цепочки сообщит о запуске
+
+
+class ManifestError(Exception):
+    pass
+
+
+# Записи манифеста: [(алгоритм, сумма, путь)].
+def read_manifest(lines):
+    entries = []
+    for line in lines:
+        words = line.rstrip('\r\n').split(' ', 2)
+        if words[0] == 'manifest':
+            if len(words) < 2 or not words[1].isdigit() or int(words[1]) > MANIFEST_VERSION:
+                raise ManifestError('Неподдерживаемая версия манифеста: %s' % line.strip())
+        elif words[0] in ALGORITHMS and len(words) == 3:
+            entries.append((words[0], words[1].lower(), words[2]))
+    return entries
+
+
+# Сумма файла или '', если он не читается. hashlib отпускает GIL, поэтому файлы считаются параллельно в потоках.
+def hash_file(path, algorithm):
+    digest = hashlib.new(algorithm)
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_THRESHOLD:
+                digest.update(f.read())
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if hasattr(m, 'madvise'):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(m) as view:
+                        for offset in range(0, size, CHUNK):
+                            digest.update(view[offset:offset + CHUNK])
+    except (OSError, ValueError):
+        return ''
+    return digest.hexdigest()
+
+
+# Параллельное выполнение function над items: результаты по мере готовности, в очереди не больше jobs * 4 задач,
+# чтобы не создавать задачи сразу на весь манифест.
+def parallel(function, items, jobs=0):
+    jobs = jobs if jobs > 0 else min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        items = iter(items)
+        while True:
+            for item in items:
+                pending.add(executor.submit(function, item))
+                if len(pending) >= jobs * 4:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+# Проверка файлов root по записям манифеста. found(путь) вызывается для каждого несовпавшего файла сразу,
+# как он найден. Возвращает число несовпавших файлов.
+def verify(root, entries, jobs=0, found=lambda path: None):
+    mismatched = 0
+
+    def check(entry):
+        algorithm, expected, path = entry
+        return None if hash_file(os.path.join(root, path), algorithm) == expected else path
+
+    for path in parallel(check, entries, jobs):
+        if path is not None:
+            mismatched += 1
+            found(path)
+    return mismatched
+
+
+# Записи манифеста только для файлов files (None - все).
+def select(entries, files):
+    if files is None:
+        return entries
+    files = set(os.path.normpath(f) for f in files)
+    return [entry for entry in entries if os.path.normpath(entry[2]) in files]
+
+
+def load_manifest(path):
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        return dict((os.path.normpath(name), (algorithm, digest)) for algorithm, digest, name in read_manifest(f))
+
+
+# Распаковка tar из stream в root с проверкой по манифесту manifest (путь относительно root) при записи.
+# Возвращает число несовпавших файлов, found(путь) вызывается для каждого сразу.
+def receive(root, stream, manifest, rest=False, delete=False, jobs=0, found=lambda path: None):
+    manifest = os.path.normpath(manifest)
+    entries = load_manifest(os.path.join(root, manifest)) if os.path.isfile(os.path.join(root, manifest)) else {}
+    received = set()
+    unchecked = []  # Пришли раньше манифеста: проверяются чтением в конце
+    mismatched = 0
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if os.path.isabs(name) or name == '..' or name.startswith('..' + os.sep):
+                raise tarfile.TarError('Недопустимый путь в потоке: %s' % member.name)
+            target = os.path.join(root, name)
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            if member.issym():
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                elif os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(member.linkname, target)
+                received.add(name)
+                continue
+            if not member.isfile():
+                continue
+            expected = entries.get(name)
+            digest = hashlib.new(expected[0]) if expected else None
+            # Запись во временный файл и замена: запущенные из старого файла процессы его не видят.
+            temporary = os.path.join(os.path.dirname(target), '.%s.installer-tmp' % os.path.basename(target))
+            source = tar.extractfile(member)
+            with open(temporary, 'wb') as f:
+                while True:
+                    chunk = source.read(CHUNK)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if digest:
+                        digest.update(chunk)
+            os.chmod(temporary, member.mode)
+            os.utime(temporary, (member.mtime, member.mtime))
+            os.replace(temporary, target)
+            received.add(name)
+            if name == manifest:
+                entries = load_manifest(target)
+            elif digest is None:
+                unchecked.append(name)
+            elif digest.hexdigest() != expected[1]:
+                mismatched += 1
+                found(member.name)
+
+    check = [name for name in unchecked if name in entries]
+    if rest:
+        check += [name for name in entries if name not in received]
+    mismatched += verify(root, [entries[name] + (name,) for name in check], jobs, found)
+    if delete:
+        prune(root, received)
+    return mismatched
+
+
+# Удаление из root всех файлов, которых нет в keep (нормализованные пути относительно root).
+def prune(root, keep):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            if os.path.normpath(os.path.relpath(path, root)) not in keep:
+                os.remove(path)
+
+
+# Кадр: вид (J - JSON, D - данные), номер запроса, длина, содержимое. Запрос - J {"id", "op", параметры};
+# за запросом receive идут кадры D с tar-потоком и пустой кадр D в конце. Ответ - J {"id", "rc", "seconds", ...};
+# до него могут прийти J {"id", "found": путь} (файл не совпал с манифестом) и D (вывод execute).
+FRAME = struct.Struct('!cII')
+
+
+def write_frame(stream, kind, id, payload):
+    stream.write(FRAME.pack(kind, id, len(payload)) + payload)
+    stream.flush()
+
+
+def read_frame(stream):
+    header = stream.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None
+    kind, id, length = FRAME.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return kind, id, payload
+
+
+# Файл для tarfile из кадров D до пустого кадра.
+class FrameReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.frame = b''  # Текущий кадр и сколько из него уже прочитано
+        self.offset = 0
+        self.finished = False
+
+    def read(self, size=-1):
+        parts = []
+        while size:
+            if self.offset == len(self.frame):
+                if self.finished:
+                    break
+                frame = read_frame(self.stream)
+                if frame is None or frame[0] != b'D':
+                    raise EOFError('Поток прерван')
+                self.frame, self.offset = frame[2], 0
+                self.finished = not self.frame
+                continue
+            end = len(self.frame) if size < 0 else min(len(self.frame), self.offset + size)
+            parts.append(self.frame[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(parts)
+
+    # Дочитать поток до конца, даже если tar его не дочитал: следующий кадр - уже другой запрос.
+    def drain(self):
+        while not self.finished:
+            self.read(CHUNK)
+
+
+# Обработка запросов сессии из stdin до запроса exit или конца stdin. Запросы выполняются по очереди.
+def serve(input, output):
+    while True:
+        frame = read_frame(input)
+        if frame is None:
+            return 0
+        kind, id, payload = frame
+        if kind != b'J':
+            continue
+        request = json.loads(payload.decode())
+        op = request.get('op')
+        if op == 'exit':
+            write_frame(output, b'J', id, json.dumps({'id': id, 'rc': 0}).encode())
+            return 0
+        started = time.time()
+        reply = {'id': id, 'rc': 0}
+
+        def found(path):
+            write_frame(output, b'J', id, json.dumps({'id': id, 'found': path}).encode())
+        data = FrameReader(input) if op == 'receive' else None
+        try:
+            reply.update(handle(op, request, data, found, lambda chunk: write_frame(output, b'D', id, chunk)))
+        except (OSError, ValueError, KeyError, EOFError, ManifestError, tarfile.TarError) as e:
+            reply.update(rc=2, error='%s' % e)
+        if data:
+            try:
+                data.drain()
+            except EOFError:
+                return 2
+        reply['seconds'] = round(time.time() - started, 3)
+        write_frame(output, b'J', id, json.dumps(reply).encode())
+
+
+def handle(op, request, data, found, output):
+    path = request.get('path', '')
+    if op == 'prepare':
+        if request.get('wipe'):
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+        return {}
+    if op == 'read_manifest':
+        g = glob.glob(os.path.join(glob.escape(path), 'base*.txt'))
+        if len(g) != 1 or not os.path.isfile(g[0]):
+            return {'rc': 1}
+        with open(g[0], encoding='utf-8', errors='ignore') as f:
+            return {'name': os.path.basename(g[0]), 'text': f.read()}
+    if op == 'remove':
+        for file in request['files']:
+            try:
+                os.remove(os.path.join(path, file))
+            except FileNotFoundError:
+                pass
+        return {}
+    if op == 'prune':
+        prune(path, set(os.path.normpath(file) for file in request['files']))
+        return {}
+    if op == 'read_file':
+        with open(path, encoding='utf-8', errors='ignore') as f:
+            return {'text': f.read()}
+    if op == 'write_file':
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(request['text'])
+        return {}
+    if op == 'receive':
+        os.makedirs(path, exist_ok=True)
+        mismatched = receive(path, data, request.get('manifest', ''), request.get('rest', False),
+                             request.get('delete', False), request.get('jobs', 0), found)
+        return {'rc': 1 if mismatched else 0}
+    if op == 'verify':
+        with open(os.path.join(path, request['manifest']), encoding='utf-8', errors='ignore') as f:
+            entries = select(read_manifest(f), request.get('files'))
+        return {'rc': 1 if verify(path, entries, request.get('jobs', 0), found) else 0}
+    if op == 'execute':
+        script = request['script']
+        for sh in glob.glob(os.path.join(glob.escape(os.path.join(path, os.path.dirname(script))), '*.sh')):
+            os.chmod(sh, os.stat(sh).st_mode | 0o111)
+        p = subprocess.Popen('./' + script, shell=True, cwd=path, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for chunk in iter(lambda: p.stdout.read1(CHUNK), b''):
+            output(chunk)
+        return {'rc': p.wait()}
+    raise ValueError('Неизвестный запрос: %s' % op)
+
+
+# Цепочка: первая строка stdin - JSON {"hops": [{"host", "path", "command"}, ...], "manifest", ...}, первое звено -
+# этот хост, дальше tar. Поток распаковывается в path с проверкой по манифесту (как receive) и одновременно
+# уходит следующему звену (command запускает там агент) с заголовком без первого звена. Звено, которое
+# не запустилось, пропускается. В stdout - JSON-строки: {"host", "ready"} сразу после заголовка, {"host", "found"}
+# и {"host", "rc"} (с "error" при сбое) этого и всех следующих звеньев. Сбой записи здесь не прерывает передачу
+# дальше; если оборвалось следующее звено, хосты за ним о результате не сообщают.
+def chain(input, output):
+    lock = threading.Lock()
+
+    def report(message):
+        with lock:
+            output.write((json.dumps(message) + '\n').encode())
+            output.flush()
+    header = json.loads(input.readline().decode())
+    hops = header.pop('hops')
+    host, path = hops[0]['host'], hops[0]['path']
+    report({'host': host, 'ready': True})
+    process, reader = start_chain(hops[1:], header, report)
+    tee = Tee(input, process.stdin if process else None)
+    reply = {'host': host, 'rc': 0}
+    try:
+        os.makedirs(path, exist_ok=True)
+        mismatched = receive(path, tee, header.get('manifest', ''), delete=header.get('delete', False),
+                             found=lambda name: report({'host': host, 'found': name}))
+        reply['rc'] = 1 if mismatched else 0
+    except (OSError, EOFError, ManifestError, tarfile.TarError) as e:
+        reply.update(rc=2, error='%s' % e)
+    tee.drain()
+    report(reply)
+    if process:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        process.wait()
+        reader.join()
+    return reply['rc']
+
+
+# Запуск первого из звеньев hops: заголовок с ними и параметрами params - первой строкой его stdin.
+# Звено, которое не сообщило о запуске за CHAIN_TIMEOUT, пропускается: report получает {"host", "rc": 255}
+# и запускается следующее. Дальше строки stdout звена передаются в report из отдельного потока.
+# Возвращает (процесс, поток чтения) или (None, None), если не запустилось ни одно звено.
+def start_chain(hops, params, report, new_session=False):
+    while hops:
+        hop = hops[0]
+        ready = queue.Queue()
+
+        def read(process, ready):
+            started = False
+            for line in process.stdout:
+                try:
+                    message = json.loads(line.decode(errors='ignore'))
+                except ValueError:
+                    continue
+                if not started:
+                    started = True
+                    ready.put(bool(message.get('ready')))
+                else:
+                    report(message)
+            if not started:
+                ready.put(False)
+        try:
+            process = subprocess.Popen(hop['command'], shell=isinstance(hop['command'], str),
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=new_session)
+        except OSError as e:
+            report({'host': hop['host'], 'rc': 255, 'error': '%s' % e})
+            hops = hops[1:]
+            continue
+        reader = threading.Thread(target=read, args=(process, ready), daemon=True)
+        reader.start()
+        try:
+            process.stdin.write((json.dumps(dict(params, hops=hops)) + '\n').encode())
+            process.stdin.flush()
+            started = ready.get(timeout=CHAIN_TIMEOUT)
+        except (OSError, queue.Empty):
+            started = False
+        if started:
+            return process, reader
+        process.kill()
+        process.wait()
+        report({'host': hop['host'], 'rc': 255, 'error': 'звено цепочки не запустилось'})
+        hops = hops[1:]
+    return None, None
+
+
+# Чтение input с копией всего прочитанного в output (следующее звено цепочки). Ошибка записи в output
+# не прерывает чтение: дальше поток просто не передаётся.
+class Tee:
+    def __init__(self, input, output):
+        self.input = input
+        self.output = output
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self, size=-1):
+        if self.offset == len(self.buffer):
+            self.buffer = getattr(self.input, 'read1', self.input.read)(CHUNK)
+            self.offset = 0
+            if self.output and self.buffer:
+                try:
+                    self.output.write(self.buffer)
+                except (OSError, ValueError):
+                    self.output = None
+        end = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+        data = self.buffer[self.offset:end]
+        self.offset = end
+        return data
+
+    # Дочитать и передать дальше остаток потока, который tar не дочитал (или после сбоя распаковки).
+    def drain(self):
+        while True:
+            self.offset = len(self.buffer)
+            if not self.read():
+                return
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Агент установщика на хосте.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('verify', help='проверка текущего каталога по манифесту')
+    command.add_argument('manifest')
+    command.add_argument('-j', '--jobs', type=int, default=0, help='потоков (по умолчанию 2 на ядро)')
+    command.add_argument('-T', '--files-from', default=None, help='проверить только файлы из списка (- - stdin)')
+    command = commands.add_parser('receive', help='распаковка tar из stdin с проверкой по манифесту при записи')
+    command.add_argument('manifest')
+    command.add_argument('--rest', action='store_true', help='проверить чтением файлы манифеста не из потока')
+    command.add_argument('--delete', action='store_true', help='удалить файлы, которых не было в потоке')
+    command.add_argument('-j', '--jobs', type=int, default=0, help='потоков для --rest (по умолчанию 2 на ядро)')
+    commands.add_parser('prune', help='удалить из текущего каталога файлы, которых нет в списке из stdin')
+    commands.add_parser('serve', help='сессия: запросы кадрами из stdin, ответы в stdout')
+    commands.add_parser('chain', help='звено цепочки: заголовок и tar из stdin, результаты в stdout')
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve(sys.stdin.buffer, sys.stdout.buffer)
+    if args.command == 'chain':
+        return chain(sys.stdin.buffer, sys.stdout.buffer)
+
+    def found(path):
+        sys.stdout.write(path + '\n')
+        sys.stdout.flush()
+    try:
+        if args.command == 'prune':
+            prune('.', set(os.path.normpath(line.rstrip('\n')) for line in sys.stdin if line.strip()))
+            return 0
+        if args.command == 'receive':
+            mismatched = receive('.', sys.stdin.buffer, args.manifest, args.rest, args.delete, args.jobs, found)
+        else:
+            with open(args.manifest, encoding='utf-8', errors='ignore') as f:
+                entries = read_manifest(f)
+            if args.files_from is not None:
+                with (sys.stdin if args.files_from == '-' else open(args.files_from, encoding='utf-8')) as f:
+                    entries = select(entries, [line.rstrip('\n') for line in f if line.strip()])
+            mismatched = verify('.', entries, args.jobs, found)
+    except (OSError, ManifestError, tarfile.TarError) as e:
+        sys.stderr.write('%s\n' % e)
+        return 2
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,162 @@
+# encoding: utf-8
+
+# Установка без GUI, например из cron или CI:
+#   python cli.py дистрибутив.zip конфигурация [хост ...]
+# Если хосты не указаны, установка идёт на все хосты конфигурации.
+
+import os
+import sys
+import argparse
+import threading
+
+invocation_dir = os.getcwd()
+installer_dir = os.path.dirname(os.path.realpath(__file__))
+os.chdir(installer_dir)
+sys.path.append(installer_dir)
+
+import helpers
+from globals import Globals
+from engine import Host, Engine, parse_batch
+from distribution import Distribution
+from transport import LocalTransport
+
+
+# Тип --post-batch: неверное значение отвергается при разборе аргументов, а не посреди установки.
+def post_batch(value):
+    try:
+        parse_batch(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('ожидается число хостов не меньше 1 или процент от 0 до 100, например 10%%: %s'
+                                         % value)
+    return value
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Установка дистрибутива на хосты в режиме "паука".')
+    parser.add_argument('distribution', help='zip-дистрибутив или base*.txt в распакованном дистрибутиве')
+    parser.add_argument('configuration', help='имя конфигурации (каталог в conf)')
+    parser.add_argument('hosts', nargs='*', help='хосты для установки (по умолчанию все хосты конфигурации)')
+    parser.add_argument('--path', default='', help='путь установки (по умолчанию из settings.txt)')
+    parser.add_argument('--no-verify', action='store_true', help='не проверять md5 после копирования base')
+    parser.add_argument('--fanout', type=int, default=0,
+                        help='скольким хостам источник раздаёт base одновременно (по умолчанию из settings.txt или 1)')
+    for phase in ('base', 'conf', 'post'):
+        parser.add_argument('--%s-workers' % phase, type=int, default=0,
+                            help='сколько операций фазы %s выполнять одновременно' % phase)
+        parser.add_argument('--%s-retries' % phase, type=int, default=None,
+                            help='сколько раз повторять неудавшуюся фазу %s на хосте (по умолчанию %d)'
+                            % (phase, Globals.retries[phase]))
+    parser.add_argument('--post-batch', default='', type=post_batch,
+                        help='post-скрипты волнами: 10%% или число хостов в волне (по умолчанию все сразу)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='conf и post каждого хоста сразу после его base, не дожидаясь остальных хостов')
+    parser.add_argument('--wipe', action='store_true',
+                        help='очистить каталог установки и скопировать base целиком (по умолчанию только изменения)')
+    parser.add_argument('--verify-on-copy', action='store_true',
+                        help='проверять md5 на хосте по мере записи (tar-поток через agent.py) вместо проверки после')
+    parser.add_argument('--tar', action='store_true',
+                        help='base целиком копировать tar-потоком со сжатием (изменения по-прежнему rsync)')
+    parser.add_argument('--compression', default=None, choices=('auto', 'zstd', 'lz4', ''),
+                        help='сжатие tar-потока (по умолчанию auto: zstd или lz4, что есть на обеих сторонах)')
+    parser.add_argument('--agent', action='store_true',
+                        help='шаги на хосте выполнять запросами к одной сессии agent.py serve на хост')
+    parser.add_argument('--swarm', action='store_true',
+                        help='base кусками: хост получает куски с нескольких хостов и сразу раздаёт проверенные')
+    parser.add_argument('--swarm-chunk', type=int, default=0, help='размер куска роя, байт (по умолчанию 64 МиБ)')
+    parser.add_argument('--chain', action='store_true',
+                        help='base одним потоком по цепочке хостов: каждый пишет его и сразу передаёт следующему')
+    parser.add_argument('--straggler-factor', type=float, default=None,
+                        help='копирование base, идущее дольше стольких медиан законченных, отменять и продолжать '
+                             'с другого источника (например 3; по умолчанию %g, 0 - выключено)'
+                             % Globals.straggler_factor)
+    parser.add_argument('--stream-archive', action='store_true',
+                        help='не распаковывать base из zip: первые хосты получают его потоком прямо из архива')
+    parser.add_argument('--local-root', default='',
+                        help='вместо сети хост X это каталог LOCAL_ROOT/X на этой машине (замеры, регресс-тесты)')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    helpers.Logger.reset()
+    uri = os.path.abspath(os.path.join(invocation_dir, args.distribution))
+    helpers.Logger.i('Открываем %s' % uri)
+    if args.stream_archive:
+        Globals.stream_archive = True
+    if args.agent:
+        Globals.agent_session = True
+    distribution = Distribution(uri)
+    if not distribution.prepare():
+        return 2
+    # Размер base нужен для подбора уровня сжатия, см. Engine.base_size.
+    threading.Thread(target=distribution.compute_size, daemon=True).start()
+    if args.configuration not in distribution.table_data_dict:
+        helpers.Logger.e('Нет конфигурации %s, есть: %s'
+                         % (args.configuration, ' '.join(distribution.configurations)))
+        return 2
+    table_data = distribution.table_data_dict[args.configuration]
+
+    hostnames = [hostname.lower() for hostname in args.hosts]
+    for hostname in hostnames:
+        if hostname not in [host.hostname for host in table_data.hosts]:
+            helpers.Logger.e('Хост %s отсутствует в конфигурации %s' % (hostname, args.configuration))
+            return 2
+    for host in table_data.hosts:
+        host.checked = not hostnames or host.hostname in hostnames
+
+    engine = Engine(transport=LocalTransport(os.path.join(invocation_dir, args.local_root)) if args.local_root else None)
+    engine.distribution = distribution
+    engine.configuration = args.configuration
+    engine.installation_path = args.path if args.path else table_data.destination
+    engine.hosts = table_data.hosts
+    engine.do_verify = not args.no_verify
+    engine.fanout = args.fanout
+    if args.pipeline:
+        engine.pipeline = True
+    if args.wipe:
+        engine.wipe = True
+    if args.verify_on_copy:
+        engine.verify_on_copy = True
+    if args.tar:
+        engine.tar_copy = True
+    if args.swarm:
+        engine.swarm = True
+    if args.chain:
+        engine.chain = True
+    if args.straggler_factor is not None:
+        engine.straggler_factor = args.straggler_factor
+    if args.swarm_chunk:
+        engine.swarm_chunk = args.swarm_chunk
+    if args.compression is not None:
+        Globals.compression = args.compression
+    if args.post_batch:
+        engine.post_batch = args.post_batch
+    for phase in engine.workers:
+        if getattr(args, '%s_workers' % phase):
+            engine.workers[phase] = getattr(args, '%s_workers' % phase)
+        if getattr(args, '%s_retries' % phase) is not None:
+            engine.retries[phase] = getattr(args, '%s_retries' % phase)
+
+    finished = threading.Event()
+    engine.on_finished = finished.set
+
+    engine.start()
+    try:
+        while not finished.wait(1):
+            pass
+    except KeyboardInterrupt:
+        helpers.Logger.w('Прервано пользователем')
+        engine.do_stop()
+        return 130
+
+    failed = [host.hostname for host in engine.checked_hosts() if host.state != Host.State.SUCCESS]
+    if failed:
+        helpers.Logger.e('Установка не удалась: %s' % ' '.join(failed))
+        return 1
+    helpers.Logger.i('Установка завершена')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
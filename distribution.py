@@ -0,0 +1,449 @@
+# encoding: utf-8
+
+import os
+import glob
+import json
+import stat
+import time
+import zlib
+import heapq
+import hashlib
+import shutil
+import zipfile
+import threading
+import subprocess
+
+import agent
+import helpers
+from globals import Globals
+from engine import TableData
+from transport import ArchiveBase
+
+INDEX_VERSION = 1
+INDEX_LARGEST = 20  # Сколько самых больших файлов хранить в индексе
+PROGRESS_INTERVAL = 0.2  # Не чаще, секунд, обновлять заголовок окна при подсчёте
+UNPACK_CHUNK = 1024 * 1024
+CACHE_KEY_CHUNK = 1024 * 1024  # Сколько байт начала и конца архива входит в его ключ
+STREAM_SUFFIX = '-stream'  # Каталог распаковки без base, см. without_base
+
+
+class Distribution:
+
+    def __init__(self, uri):
+        self.uri = uri  # zip-дистрибутив или base*.txt
+        self.base_txt = ''  # Полный путь к base*.txt
+        self.configurations_dir = ''  # Полный путь к распакованному директории conf
+        self.name = ''  # Имя дистрибутива
+        self.base = ''
+        self.size = 0
+        self.prepare_timer = 0
+        self.installation_timer = 0  # <=0 - процесс не запущен, >0 - процесс идёт
+        self.files = 0  # Число файлов в base
+        self.executables = []
+        self.largest = []  # [(размер, путь относительно base)] самых больших файлов, по убыванию
+        self.configurations = []  # Имена конфигураций (каталогов в conf), отсортированы
+        self.table_data_dict = {}  # Имя конфигурации -> TableData
+        self.unpacked = 0  # Распаковано байт из unpack_total
+        self.unpack_total = 0
+        self.stopped = False  # Открытие отменено, см. stop()
+        self.archive = None  # ArchiveBase, если base не распакован и копируется прямо из zip
+
+    # Распаковка (если нужно) и разбор дистрибутива. Возвращает False, если дистрибутив негодный.
+    def prepare(self):
+        uri = self.uri
+        if os.path.basename(uri).startswith('base') and os.path.basename(uri).endswith('.txt'):
+            base_txt = uri
+        else:
+            streamed = Globals.stream_archive and zipfile.is_zipfile(uri)
+            if Globals.cache_dir:
+                unpack_to, streamed = cached_distribution(uri, self.on_unpack_progress, lambda: self.stopped,
+                                                          streamed)
+            else:
+                unpack_to = unpack_distribution(uri, self.on_unpack_progress, lambda: self.stopped,
+                                                os.path.splitext(uri)[0] + STREAM_SUFFIX if streamed else '',
+                                                without_base if streamed else None)
+            if not unpack_to:
+                return False
+            if streamed:
+                self.archive = ArchiveBase(uri, 'base/')
+            g = glob.glob(os.path.join(unpack_to, 'base', 'base*.txt'))
+            if len(g) != 1:  # файл вида base*.txt в корне распакованного дистрибутива должен быть только один!
+                helpers.Logger.e('После распаковки не найден base*.txt')
+                return False
+            base_txt = g[0]
+
+        conf = os.path.join(os.path.dirname(base_txt), '..', 'conf')
+        if os.path.isdir(conf):
+            for name in os.listdir(conf):
+                destination = ''
+                settings = []
+                settings_txt = os.path.join(conf, name, 'settings.txt')
+                if os.path.isfile(settings_txt):
+                    settings = [line.split() for line in open(settings_txt, errors='ignore') if line.strip()]
+                    destination = settings[0][1] if settings else ''
+                table_data = TableData(os.path.dirname(base_txt), destination)
+                table_data.settings = settings[1:]
+                for hostname in os.listdir(os.path.join(conf, name)):
+                    if (hostname == 'common' or
+                            not os.path.isdir(os.path.join(conf, name, hostname))):
+                        continue
+                    table_data.add_host(hostname)
+                self.configurations.append(name)
+                self.table_data_dict[name] = table_data
+
+        self.configurations.sort()
+
+        configurations_dir = os.path.abspath(
+            os.path.join(os.path.dirname(base_txt), '..', 'conf'))
+        if os.path.isdir(configurations_dir):
+            self.configurations_dir = configurations_dir
+        for line in open(base_txt, errors='ignore').readlines():
+            if line.startswith('name '):
+                self.name = line.split(' ')[1].strip()
+                continue
+        if not self.name:
+            self.name = os.path.basename(self.uri)
+        self.base_txt = base_txt
+        self.base = os.path.dirname(self.base_txt)
+
+        return True
+
+    # Распаковка base, оставленного в архиве: для транспортов, которые не умеют копировать потоком.
+    def extract_base(self):
+        if not self.archive:
+            return True
+        helpers.Logger.i('Распаковка base из %s' % self.uri)
+        try:
+            unzip(self.uri, os.path.dirname(self.base), self.on_unpack_progress, lambda: self.stopped,
+                  select=lambda name: name.startswith('base/'))
+        except (Cancelled, OSError, zipfile.BadZipFile, zlib.error, RuntimeError) as e:
+            helpers.Logger.e('Сбой при распаковке base: %s' % e)
+            return False
+        self.archive = None
+        return True
+
+    def on_unpack_progress(self, done, total):
+        self.unpacked, self.unpack_total = done, total
+
+    # Отмена открытия: прерывает распаковку.
+    def stop(self):
+        self.stopped = True
+
+    # Индекс дистрибутива лежит рядом с его каталогом: дистрибутив.zip -> дистрибутив/ и дистрибутив.index.json.
+    def index_path(self):
+        return os.path.normpath(os.path.join(self.base, '..')) + '.index.json'
+
+    # Индекс действителен, пока не изменился base*.txt: дистрибутив определяется своим манифестом.
+    def index_key(self):
+        st = os.stat(self.base_txt)
+        return [os.path.basename(self.base_txt), st.st_size, st.st_mtime_ns]
+
+    def load_index(self):
+        try:
+            with open(self.index_path()) as f:
+                index = json.load(f)
+            if index.get('version') != INDEX_VERSION or index.get('key') != self.index_key():
+                return False
+            self.files = index['files']
+            self.executables = index['executables']
+            self.largest = [tuple(item) for item in index['largest']]
+            self.size = index['bytes']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save_index(self):
+        index = {'version': INDEX_VERSION, 'key': self.index_key(), 'files': self.files, 'bytes': abs(self.size),
+                 'executables': self.executables, 'largest': self.largest}
+        temporary = self.index_path() + '.tmp'
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(temporary, self.index_path())
+        except OSError as e:
+            helpers.Logger.w('Индекс дистрибутива не сохранён: %s' % e)
+
+    # Один проход по base: число файлов, размер, исполняемые файлы (для отстрела перед установкой) и самые
+    # большие файлы. Пока идёт подсчёт size > 0, по окончании size становится отрицательным. progress()
+    # вызывается не чаще раза в PROGRESS_INTERVAL секунд. Если дистрибутив уже открывался, берётся индекс.
+    def compute_size(self, progress=lambda: None):
+        if self.archive:  # Всё есть в оглавлении архива
+            self.scan_archive()
+            self.size = -self.size
+            progress()
+            return
+        if self.load_index():
+            helpers.Logger.i('Индекс дистрибутива: %s' % self.index_path())
+            self.size = -self.size
+            progress()
+            return
+        self.files = 0
+        self.executables = []
+        largest = []  # Куча (размер, путь) из INDEX_LARGEST самых больших файлов
+        shown = time.monotonic()
+        directories = [self.base]
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                helpers.Logger.w(e)
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                        continue
+                    size = entry.stat(follow_symlinks=False).st_size
+                except OSError as e:
+                    helpers.Logger.w(e)
+                    continue
+                self.files += 1
+                self.size += size
+                if entry.name.endswith('.exe'):
+                    self.executables.append(entry.name)
+                if len(largest) < INDEX_LARGEST:
+                    heapq.heappush(largest, (size, os.path.relpath(entry.path, self.base)))
+                elif size > largest[0][0]:
+                    heapq.heapreplace(largest, (size, os.path.relpath(entry.path, self.base)))
+            if time.monotonic() - shown >= PROGRESS_INTERVAL:
+                shown = time.monotonic()
+                progress()
+        self.largest = sorted(largest, reverse=True)
+        self.save_index()
+        self.size = -self.size
+        progress()
+
+    def scan_archive(self):
+        self.files = len(self.archive.members)
+        self.size = sum(member.file_size for member in self.archive.members.values())
+        self.executables = [os.path.basename(f) for f in self.archive.members if f.endswith('.exe')]
+        self.largest = heapq.nlargest(INDEX_LARGEST, ((member.file_size, f)
+                                                      for f, member in self.archive.members.items()))
+
+
+# Ключ архива в кэше: размер, mtime и md5 начала и конца файла (весь архив читать долго). Этого достаточно, чтобы
+# отличить пересобранный дистрибутив с тем же именем.
+def archive_key(file):
+    st = os.stat(file)
+    digest = hashlib.md5(b'%d %d' % (st.st_size, st.st_mtime_ns))
+    with open(file, 'rb') as f:
+        digest.update(f.read(CACHE_KEY_CHUNK))
+        if st.st_size > CACHE_KEY_CHUNK:
+            f.seek(max(CACHE_KEY_CHUNK, st.st_size - CACHE_KEY_CHUNK))
+            digest.update(f.read(CACHE_KEY_CHUNK))
+    return digest.hexdigest()[:20]
+
+
+# Распаковка через кэш Globals.cache_dir: каталог кэша <ключ архива>, повторное открытие того же архива
+# распаковку пропускает. Время изменения каталога - время последнего использования, по нему вытесняются
+# давно не открывавшиеся дистрибутивы, пока кэш больше Globals.cache_budget. Возвращает (каталог или '' при сбое,
+# распакован ли он без base): полностью распакованный каталог из кэша годится и для streamed.
+def cached_distribution(file, progress=lambda done, total: None, stopped=lambda: False, streamed=False):
+    os.makedirs(Globals.cache_dir, exist_ok=True)
+    unpack_to = os.path.abspath(os.path.join(Globals.cache_dir, archive_key(file)))
+    for candidate, without in ((unpack_to, False), (unpack_to + STREAM_SUFFIX, True))[:2 if streamed else 1]:
+        if os.path.isdir(candidate):
+            helpers.Logger.i('Дистрибутив уже распакован: %s' % candidate)
+            os.utime(candidate)
+            return candidate, without
+    if streamed:
+        unpack_to += STREAM_SUFFIX
+    if not unpack_distribution(file, progress, stopped, unpack_to, without_base if streamed else None):
+        return '', streamed
+    threading.Thread(target=evict, args=(Globals.cache_dir, Globals.cache_budget, unpack_to)).start()
+    return unpack_to, streamed
+
+
+# Вытеснение из кэша cache самых давно использованных дистрибутивов, пока их размер больше budget. Размер
+# каталога считается один раз и хранится рядом в <ключ>.size. Каталог keep не вытесняется.
+def evict(cache, budget, keep=''):
+    entries = []
+    for entry in os.scandir(cache):
+        if not entry.is_dir(follow_symlinks=False) or '.installer-' in entry.name:
+            continue
+        try:
+            with open(entry.path + '.size') as f:
+                size = int(f.read())
+        except (OSError, ValueError):
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(entry.path):
+                for f in filenames:
+                    try:
+                        size += os.lstat(os.path.join(dirpath, f)).st_size
+                    except OSError:
+                        pass
+            with open(entry.path + '.size', 'w') as f:
+                f.write('%d' % size)
+        entries.append((entry.stat().st_mtime, entry.path, size))
+    total = sum(size for mtime, path, size in entries)
+    for mtime, path, size in sorted(entries):
+        if total <= budget:
+            break
+        if os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        helpers.Logger.i('Удаление из кэша %s (%s)' % (path, helpers.bytes_to_human(size)))
+        old = '%s.installer-old-%d' % (path, time.time_ns())
+        try:
+            os.rename(path, old)
+        except OSError as e:  # Например, на Windows каталог открыт
+            helpers.Logger.w(e)
+            continue
+        for extra in (path + '.size', path + '.index.json'):
+            if os.path.exists(extra):
+                os.remove(extra)
+        shutil.rmtree(old, ignore_errors=True)
+        total -= size
+
+
+# Что распаковывать, когда base копируется прямо из архива: всё, кроме base, но с манифестом base*.txt.
+def without_base(name):
+    if not name.startswith('base/'):
+        return True
+    name = name[len('base/'):]
+    return '/' not in name and name.startswith('base') and name.endswith('.txt')
+
+
+# Распаковка архива file в каталог unpack_to (по умолчанию рядом с архивом, без расширения). select(имя в архиве)
+# отбирает распаковываемые файлы zip (None - все). Распаковывается во временный каталог, который
+# затем переименовывается на место прежнего; прежний удаляется в фоне. zip распаковывается в потоках,
+# progress(распаковано байт, всего байт) вызывается по мере записи. Если stopped() вернула True, распаковка
+# прерывается. Возвращает каталог распаковки или '' при сбое или отмене.
+def unpack_distribution(file, progress=lambda done, total: None, stopped=lambda: False, unpack_to='', select=None):
+    unpack_to = unpack_to or os.path.splitext(file)[0]  # отрезаем .zip
+    # Во временном каталоге номер процесса: каталоги идущих распаковок других экземпляров не трогаются.
+    temporary = '%s.installer-tmp-%d-%d' % (unpack_to, os.getpid(), time.time_ns())
+    remove_in_background([path for path in glob.glob(glob.escape(unpack_to) + '.installer-*')
+                          if leftover(path[len(unpack_to):])])  # Остатки прерванных распаковок
+    helpers.Logger.i('Распаковка %s во временный каталог %s' % (file, temporary))
+    try:
+        os.makedirs(temporary)
+        if zipfile.is_zipfile(file):
+            unzip(file, temporary, progress, stopped, select=select)
+        else:
+            un7z(file, temporary, stopped)
+    except Cancelled:
+        helpers.Logger.w('Распаковка отменена')
+        remove_in_background([temporary])
+        return ''
+    except (OSError, zipfile.BadZipFile, zlib.error, RuntimeError) as e:
+        helpers.Logger.e('Сбой при распаковке архива, архив битый? %s' % e)
+        remove_in_background([temporary])
+        return ''
+
+    old = ''
+    try:
+        if os.path.exists(unpack_to):
+            old = '%s.installer-old-%d' % (unpack_to, time.time_ns())
+            os.rename(unpack_to, old)
+        os.rename(temporary, unpack_to)
+    except OSError as e:  # На Windows прежний каталог может быть открыт, например в Проводнике
+        helpers.Logger.e('Не удалось заменить %s распакованным: %s' % (unpack_to, e))
+        remove_in_background([temporary])
+        return ''
+    helpers.Logger.i('Распаковано в %s' % unpack_to)
+    if old:
+        remove_in_background([old])
+    return unpack_to
+
+
+# Остаток прерванной распаковки по суффиксу каталога: прежний каталог (.installer-old-*) или временный
+# каталог (.installer-tmp-<pid>-*) завершившегося процесса.
+def leftover(suffix):
+    if not suffix.startswith('.installer-tmp-'):
+        return True
+    try:
+        pid = int(suffix[len('.installer-tmp-'):].split('-')[0])
+    except ValueError:
+        return True
+    return not helpers.process_alive(pid)
+
+
+class Cancelled(Exception):
+    pass
+
+
+def remove_in_background(paths):
+    if paths:
+        threading.Thread(target=lambda: [shutil.rmtree(path, ignore_errors=True) for path in paths]).start()
+
+
+# Параллельная распаковка zip: у каждого потока свой ZipFile, чтобы чтение и разжатие не шли под одной блокировкой.
+# Сначала берутся большие файлы, чтобы один большой файл не остался в конце.
+def unzip(file, destination, progress, stopped, jobs=0, select=None):
+    with zipfile.ZipFile(file) as z:
+        members = [member for member in z.infolist() if not select or select(member.filename)]
+    total = sum(member.file_size for member in members)
+    done = [0]
+    lock = threading.Lock()
+    local = threading.local()
+    opened = []
+
+    def extract(member):
+        name = os.path.normpath(member.filename)
+        if os.path.isabs(name) or os.path.splitdrive(name)[0] or name == '..' or name.startswith('..' + os.sep):
+            raise RuntimeError('Недопустимый путь в архиве: %s' % member.filename)
+        target = os.path.join(destination, name)
+        if member.is_dir():
+            os.makedirs(target, exist_ok=True)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if not hasattr(local, 'zip'):
+            local.zip = zipfile.ZipFile(file)
+            with lock:
+                opened.append(local.zip)
+        mode = member.external_attr >> 16
+        # Ссылка (в архиве - файл с её путём) распаковывается ссылкой, как у 7za. Где ссылку создать нельзя
+        # (Windows без прав), остаётся файлом с путём.
+        if stat.S_ISLNK(mode):
+            try:
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(local.zip.read(member).decode(), target)
+            except OSError:
+                pass
+            else:
+                with lock:
+                    done[0] += member.file_size
+                    progress(done[0], total)
+                return
+        with local.zip.open(member) as source, open(target, 'wb') as f:
+            while True:
+                if stopped():
+                    raise Cancelled()
+                chunk = source.read(UNPACK_CHUNK)
+                if not chunk:
+                    break
+                f.write(chunk)
+                with lock:
+                    done[0] += len(chunk)
+                    progress(done[0], total)
+        if mode & 0o777:
+            os.chmod(target, mode & 0o777)
+        # Время изменения из архива: по нему узнаётся повторно распакованный дистрибутив, см. index_key.
+        mtime = time.mktime(member.date_time + (0, 0, -1))
+        os.utime(target, (mtime, mtime))
+
+    members.sort(key=lambda member: member.file_size, reverse=True)
+    progress(0, total)
+    try:
+        for _ in agent.parallel(extract, members, jobs):
+            pass
+    finally:
+        for z in opened:
+            z.close()
+
+
+# Прочие архивы (.tar.xz, .7z) распаковываются внешним 7za без отчёта о ходе.
+def un7z(file, destination, stopped):
+    cmd = '7za x "' + file + '" -aoa -o"' + destination + '"'
+    helpers.Logger.i(cmd)
+    p = subprocess.Popen(cmd, shell=True)
+    while p.poll() is None:
+        if stopped():
+            p.kill()
+            p.wait()
+            raise Cancelled()
+        time.sleep(0.2)
+    if p.returncode != 0:
+        raise RuntimeError('7za завершился с кодом %d' % p.returncode)
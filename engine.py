@@ -0,0 +1,1212 @@
+# encoding: utf-8
+
+# Движок установки без GUI: состояние хостов и "паук" base -> conf -> post.
+# Не импортирует PySide6, поэтому может запускаться из cron/CI (см. cli.py),
+# а Installer в installer.py является только представлением над ним.
+
+import os
+import sys
+import time
+import hashlib
+import shutil
+import itertools
+import tempfile
+import threading
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import agent
+import swarm
+import helpers
+from globals import Globals
+from hosts import Host, TableData, HostIndex, HOLDING_STATES
+from transport import default_transport, AgentTransport
+from scheduler import Topology, Fanout
+
+
+def local_hostname():
+    return subprocess.check_output('hostname').decode(errors='ignore').strip().lower()
+
+
+# Разбор размера волны: '10%' -> (10.0, True), число хостов -> (число, False), пусто - None (все хосты сразу).
+# Не число, число меньше 1 и процент вне (0, 100] - ValueError.
+def parse_batch(spec):
+    spec = str(spec).strip() if spec else ''
+    if not spec:
+        return None
+    if spec.endswith('%'):
+        number = spec[:-1]
+        percent = float(number) if number == number.strip() else -1
+        if not 0 < percent <= 100:
+            raise ValueError('процент волны должен быть больше 0 и не больше 100: %s' % spec)
+        return percent, True
+    count = int(spec)
+    if count < 1:
+        raise ValueError('в волне должен быть хотя бы один хост: %s' % spec)
+    return count, False
+
+
+# Размер волны из total хостов по spec, см. parse_batch.
+def batch_size(spec, total):
+    batch = parse_batch(spec)
+    if batch is None:
+        return max(1, total)
+    value, percent = batch
+    if percent:
+        return max(1, int(total * value / 100 + 0.999))
+    return value
+
+
+class Engine:
+    def __init__(self, hostname=None, transport=None):
+        self.hostname = hostname if hostname else local_hostname()
+        self.transport = transport if transport else default_transport(self.hostname)
+        # Шаги на хосте - запросами к одной сессии agent.py serve вместо отдельной команды на каждый.
+        if Globals.agent_session and self.transport.agent_supported:
+            self.transport = AgentTransport(self.transport)
+
+        self.distribution = None  # distribution.Distribution
+        self.configuration = ''  # Имя выбранной конфигурации (каталог в conf)
+        self.installation_path = ''  # Путь установки на хостах
+        self.hosts = []  # Список TableData.Host
+        self.do_verify = True
+        self.fanout = 0  # Сколько приёмников у источника одновременно, 0 - из settings.txt (по умолчанию 1)
+        self.topology = Topology()
+        self.fanout_rules = Fanout()
+        self.index = HostIndex([], self.topology, self.fanout_rules, threading.RLock())
+        self.stop = False
+        self.running = False
+        # Номер запуска: задачи и повторы, назначенные в прежнем запуске, ничего не меняют, см. stopped.
+        self.generation = 0
+        self.local = threading.local()  # generation - запуск, к которому относится задача этого потока
+        self.post_install_script_used = False
+        # Post-скрипты волнами: '10%' или число хостов в волне, пусто - все сразу (в пределах пула post).
+        self.post_batch = Globals.post_batch
+        self.post_batch_size = 0
+        # Конвейер: conf и post хоста начинаются сразу после проверки его base, не дожидаясь остальных хостов.
+        # Хост при этом остаётся в BASE_SUCCESS и продолжает раздавать base, ход conf/post - в conf_state/post_state.
+        self.pipeline = Globals.pipeline
+        self.pipelining = False  # Конвейер включён и поддерживается транспортом
+        self.pipelined = 0  # Сколько хостов сейчас проходят conf/post в конвейере
+        # Инкрементальная установка: каталог на хосте не очищается, копируются только файлы, у которых
+        # изменилась запись в манифесте, и удаляются исчезнувшие из него. wipe - всегда очищать и копировать всё.
+        self.wipe = Globals.wipe
+        self.incremental = False  # wipe выключен и транспорт умеет копировать по списку
+        self.base_files = []  # Файлы base (пути относительно base)
+        self.base_files_set = set()
+        self.shadowed = set()  # Файлы, перекрываемые conf какого-либо хоста конфигурации
+        self.manifest = {}  # Манифест дистрибутива: путь -> md5
+        # Проверка во время копирования: приёмник считает суммы по мере записи (agent.py receive),
+        # base не перечитывается после копирования. Копируется tar-потоком, без дельты rsync.
+        self.verify_on_copy = Globals.verify_on_copy
+        self.streaming = False  # verify_on_copy включён, проверка включена и транспорт это умеет
+        # base целиком (пустой каталог) копируется tar-потоком со сжатием, изменения - как обычно.
+        self.tar_copy = Globals.tar_copy
+        self.tarring = False  # tar_copy включён, транспорт это умеет и не используется streaming
+        # Рой: base передаётся кусками, хост получает их с нескольких хостов и раздаёт дальше проверенные куски.
+        self.swarm = Globals.swarm
+        self.swarm_chunk = Globals.swarm_chunk
+        self.swarming = False  # swarm включён и транспорт умеет копировать по списку
+        self.tracker = None  # swarm.Tracker
+        self.leftovers = {}  # hostname -> (был ли манифест на хосте, файлы для удаления) для хостов роя
+        # Цепочка: хосты без прежней установки получают base одним потоком с этого компьютера по цепочке хостов,
+        # каждый пишет его и одновременно передаёт следующему (для очень больших base).
+        self.chain = Globals.chain
+        self.chaining = False  # chain включён, транспорт умеет копировать потоком и не используется рой
+        self.chained = False  # Цепочка в этой установке уже запускалась
+        # Повторы после неудачи: сколько раз по фазам и паузы перед ними, см. retry.
+        self.retries = dict(Globals.retries)
+        self.timers = []  # threading.Timer назначенных повторов
+        # Отстающие копирования base: отменяются и продолжаются с другого источника, см. speculate.
+        # straggler_factor 0 - выключено.
+        self.straggler_factor = Globals.straggler_factor
+        self.races = {}  # hostname -> копирования base на хост, см. settle_copy
+        self.durations = []  # Длительность законченных копирований base, секунд
+        self.jobs = itertools.count()  # Номера заданий транспорта, см. Transport.begin
+        # Отметка об установленной версии: файл рядом с каталогом установки со строками "base|conf|post <md5>",
+        # дописывается после каждого успешного шага. Хосты с совпадающей отметкой не переустанавливаются
+        # (только в инкрементальном режиме, wipe переустанавливает всё).
+        self.stamping = False
+        self.stamps = {}  # hostname -> {шаг: md5}, что записано в отметку хоста
+        self.base_digest = ''
+        self.post_digest = ''
+        self.staging_dir = ''  # Временный каталог для сборки conf
+        self.lock = threading.RLock()  # Общий для планировщика и индекса хостов
+
+        # Ограничения числа одновременных удалённых операций по фазам.
+        self.workers = {'base': Globals.base_workers, 'conf': Globals.conf_workers, 'post': Globals.post_workers}
+        self.executors = {}
+
+        # Обратные вызовы представления (GUI или CLI). Вызываются из любых потоков.
+        self.on_hosts_changed = lambda: None
+        self.on_started = lambda: None
+        self.on_finished = lambda: None
+        self.on_tick = lambda: None  # Раз в секунду во время установки
+
+    def checked_hosts(self):
+        return [host for host in self.hosts if host.checked]
+
+    def configuration_dir(self):
+        return os.path.join(self.distribution.configurations_dir, self.configuration)
+
+    # settings.txt выбранной конфигурации без первой строки.
+    def settings(self):
+        table_data = self.distribution.table_data_dict.get(self.configuration)
+        return table_data.settings if table_data else []
+
+    def post_install_script(self):
+        s = os.path.join(self.configuration_dir(), 'common', 'etc', 'post-install')
+        if sys.platform == 'win32':
+            s += '.bat'
+        else:
+            s += '.sh'
+        return s
+
+    def queue(self, host):
+        if host.state == Host.State.IDLE or host.state == Host.State.SUCCESS or host.state == Host.State.FAILURE:
+            helpers.Logger.i('Запуск %s' % host.hostname)
+            host.conf_state = host.post_state = Host.State.IDLE
+            host.attempts = {}
+            host.avoid = set()
+            host.state = Host.State.QUEUED
+            return True
+        return False
+
+    def start(self):
+        for host in self.checked_hosts():
+            if (host.state == Host.State.IDLE
+                    or host.state == Host.State.FAILURE
+                    or host.state == Host.State.SUCCESS):
+                host.conf_state = host.post_state = Host.State.IDLE
+                host.state = Host.State.QUEUED
+        self.run()
+
+    # Запуск, к которому относится вызывающий поток: задачи, повторы и heartbeat помнят свой, остальные - текущий.
+    def thread_generation(self):
+        return getattr(self.local, 'generation', self.generation)
+
+    # Остановлена ли установка для вызывающего потока: останов или задача прежнего запуска.
+    def stopped(self):
+        return self.stop or self.thread_generation() != self.generation
+
+    def do_stop(self):
+        self.stop = True
+        self.cancel_retries()
+        self.transport.terminate()
+        self.shutdown_executors()
+
+        for host in self.hosts:
+            host.conf_state = host.post_state = Host.State.IDLE
+            host.state = Host.State.IDLE
+            host.outgoing = 0
+        self.on_hosts_changed()
+
+        self.running = False
+        self.remove_staging_dir()
+        self.transport.close()
+
+    # Копирование base на destination_host - задание транспорта job: отстающее копирование отменяется, и его
+    # продолжает запасное (speculative) с другого источника, см. speculate.
+    def do_copy_base(self, source_host, destination_host, job=None):
+        speculative = job is not None
+        if not speculative:
+            job = next(self.jobs)
+        self.transport.begin(job)
+        try:
+            self.copy_base_job(source_host, destination_host, job, speculative)
+        finally:
+            self.transport.end()
+            with self.lock:  # Прерванное (останов, исключение) копирование не должно держать запасной источник
+                race = self.races.get(destination_host.hostname)
+                if race and race['job'] == job:
+                    del self.races[destination_host.hostname]
+                    if race['spare']:
+                        self.release_source(race['spare'])
+
+    def copy_base_job(self, source_host, destination_host, job, speculative):
+        manifest = os.path.basename(self.distribution.base_txt)
+
+        def found(file):
+            helpers.Logger.w('%s: ошибка md5: %s' % (destination_host.hostname, file))
+        if speculative:
+            # Каталог уже подготовлен основным копированием, список файлов - его же: манифест на хосте
+            # могло уже обновить оно. Уже скопированное rsync пропускает.
+            race = self.races[destination_host.hostname]
+            files, removed = race['files'], race['removed']
+            resume = True
+        else:
+            destination_host.base_timer = 0
+            # Повтор продолжает прерванное копирование: каталог не очищается, уже скопированные файлы rsync
+            # пропускает, недокопированный файл докачивает (--partial-dir).
+            resume = destination_host.attempts.get('base', 0) > 0
+
+            # Шаг 1: сброс отметки, останов процессов и удаление существующего каталога установки
+            # (в инкрементальном режиме каталог сохраняется).
+            returncode = self.write_stamp(destination_host, None)
+            if returncode == 0:
+                returncode = self.transport.prepare(destination_host.hostname, self.installation_path,
+                                                    not self.incremental and not resume)
+            if self.stopped():
+                return
+            if returncode != 0:
+                helpers.Logger.e(
+                    'На %s не удалось удалить %s' % (destination_host.hostname, self.installation_path))
+                self.fail_copy_base(None, destination_host)
+                if source_host:
+                    self.release_source(source_host)
+                self.worker()
+                return
+
+            # Шаг 2: Копирование base: целиком или только изменившиеся по сравнению с манифестом на хосте файлы.
+            # При проверке во время копирования файлы с ошибкой попадают в журнал по мере нахождения.
+            files, removed = self.delta(destination_host) if self.incremental else (None, [])
+            with self.lock:
+                self.races[destination_host.hostname] = {
+                    'files': files, 'removed': removed, 'job': job, 'source': source_host, 'spare': None,
+                    'replaced': None}
+        mismatched = []
+        if self.streaming:
+            returncode, mismatched = self.stream_base(source_host, destination_host, files, True, found)
+            copied = returncode == 0 or (returncode == 1 and mismatched)
+        else:
+            returncode = 0
+            if files is None and self.incremental and self.tarring and not resume:
+                # tar, в отличие от rsync --delete, лишнего не удаляет: каталог без манифеста очищается.
+                returncode = self.transport.prepare(destination_host.hostname, self.installation_path, True)
+            if returncode == 0:
+                returncode = self.copy_base(source_host, destination_host, files, resume)
+            copied = returncode == 0
+        if copied and removed and not self.stopped():
+            helpers.Logger.i('%s: удаление %d файлов' % (destination_host.hostname, len(removed)))
+            copied = self.transport.remove(destination_host.hostname, self.installation_path, removed) == 0
+        if self.stopped():
+            return
+        if not self.settle_copy(source_host, destination_host, job, copied):
+            if source_host:
+                self.release_source(source_host)
+            self.worker()
+            return
+
+        if not copied:
+            self.fail_copy_base(source_host, destination_host)
+            if source_host:
+                self.release_source(source_host)
+            self.worker()
+            return
+
+        # Шаг 3: проверка по манифесту (если не проверено при копировании).
+        result = Host.State.BASE_SUCCESS
+        if self.do_verify:
+            if not self.streaming:
+                returncode, mismatched = self.transport.verify(
+                    destination_host.hostname, self.installation_path, manifest, found)
+            if returncode and self.incremental and mismatched and not self.stopped():
+                returncode, mismatched = self.recopy_base(destination_host, mismatched, found)
+            if returncode:
+                result = Host.State.FAILURE
+                helpers.Logger.e('%s: не пройдена проверка по %s, файлов с ошибкой: %d'
+                                 % (destination_host.hostname, manifest, len(mismatched)))
+        if self.stopped():
+            return
+        if result == Host.State.FAILURE:
+            self.fail_copy_base(source_host, destination_host)
+        else:
+            if self.do_verify:
+                self.write_stamp(destination_host, 'base', self.base_digest)
+            destination_host.state = result
+        if source_host:
+            self.release_source(source_host)
+        if self.pipelining and result == Host.State.BASE_SUCCESS:
+            self.start_conf(destination_host)
+        self.worker()
+
+    # В инкрементальном режиме на хосте могли остаться изменённые вручную файлы с прежними размером
+    # и временем: повторяем копирование только их из локального base. Возвращает (код возврата, файлы с ошибкой).
+    def recopy_base(self, host, mismatched, found):
+        helpers.Logger.w('%s: повторное копирование %d файлов с ошибкой md5' % (host.hostname, len(mismatched)))
+        if self.streaming:
+            return self.stream_base(None, host, mismatched, False, found)
+        if self.copy_base(None, host, mismatched) != 0:
+            return 1, mismatched
+        return self.transport.verify(host.hostname, self.installation_path,
+                                     os.path.basename(self.distribution.base_txt), found)
+
+    # Копирование job на host с source_host закончено (copied - успешно). Возвращает False, если оно отменено
+    # ради запасного (см. speculate): тогда запасное копирование начинается сейчас, когда это уже вышло, и два
+    # копирования никогда не пишут в каталог одновременно. Успевшее закончиться копирование остаётся, запасной
+    # источник освобождается. Если запасное копирование закончилось успешно и быстрее, чем шло отменённое,
+    # медленным считается основной источник (а не канал приёмника).
+    def settle_copy(self, source_host, host, job, copied):
+        with self.lock:
+            race = self.races[host.hostname]
+            spare = race['spare']
+            if spare is None or copied:
+                del self.races[host.hostname]
+                if spare is not None:
+                    self.transport.keep(job)
+                    self.release_source(spare)
+                if copied:
+                    self.durations.append(max(0, host.base_timer))
+                if (copied and race['replaced'] is not None and race['source']
+                        and host.base_timer - race['replaced'] < race['replaced']):
+                    race['source'].slow += 1
+                    helpers.Logger.w('%s: копирование с %s закончено, %s считается медленным источником'
+                                     % (host.hostname, source_host.hostname, race['source'].hostname))
+                return True
+            race['job'] = next(self.jobs)
+            race['spare'] = None
+            race['replaced'] = max(0, host.base_timer)  # Сколько шло отменённое копирование
+            self.submit('base', self.do_copy_base, spare, host, race['job'])
+        return False
+
+    # Отстающие копирования base (вызывается раз в секунду): копирование идёт дольше straggler_factor медиан
+    # законченных (не меньше Globals.straggler_min секунд) - оно отменяется и продолжается запасным копированием
+    # со свободного источника, один раз на хост. Уже скопированное rsync пропускает. Только если транспорт
+    # умеет отменять задания и без проверки при записи.
+    def speculate(self):
+        if (not self.straggler_factor or not self.transport.cancel_supported or self.streaming
+                or len(self.durations) < Globals.straggler_peers):
+            return
+        with self.lock:
+            if self.stopped() or not self.running:
+                return
+            durations = sorted(self.durations)
+            threshold = max(Globals.straggler_min, durations[len(durations) // 2] * self.straggler_factor)
+            for hostname, race in self.races.items():
+                host = self.index.by_hostname[hostname]
+                if race['spare'] or race['replaced'] is not None or host.base_timer < threshold:
+                    continue
+                source_host = self.index.spare_source(host, race['source'])
+                if not source_host:
+                    continue
+                race['spare'] = source_host
+                source_host.outgoing += 1
+                source_host.state = Host.State.BASE_INSTALLING_SOURCE
+                helpers.Logger.w('%s: копирование base идёт %s (обычно %s), переносится на %s'
+                                 % (hostname, helpers.seconds_to_human(host.base_timer),
+                                    helpers.seconds_to_human(durations[len(durations) // 2]), source_host.hostname))
+                self.transport.cancel(race['job'])
+
+    # Неудачное копирование base на destination_host с source_host (None - с локального компьютера или
+    # не дошло до копирования): повтор через паузу, с другого источника, или FAILURE, если повторы исчерпаны.
+    # Источник, с которого не удалось копирование, приёмник больше не выбирает, а после
+    # Globals.source_failures таких случаев он не выбирается никем.
+    def fail_copy_base(self, source_host, destination_host):
+        if source_host:
+            self.blame_source(source_host, destination_host)
+
+        def requeue():
+            destination_host.state = Host.State.QUEUED
+            self.worker()
+        # На время паузы хост не считается ни получающим base, ни стоящим в очереди.
+        destination_host.state = Host.State.BASE_WAITING
+        if not self.retry(destination_host, 'base', requeue):
+            destination_host.state = Host.State.FAILURE
+
+    def blame_source(self, source_host, destination_host):
+        with self.lock:
+            destination_host.avoid.add(source_host.hostname)
+            source_host.failures += 1
+            if source_host.failures == Globals.source_failures:
+                helpers.Logger.w('%s: %d неудачных копирований с хоста, больше не используется как источник'
+                                 % (source_host.hostname, source_host.failures))
+
+    # Повтор фазы phase на хосте: не больше self.retries[phase] раз за установку, с паузой Globals.retry_backoff
+    # секунд, удваивающейся с каждой попыткой (не больше Globals.retry_backoff_max). Хост остаётся в прежнем
+    # состоянии, по окончании паузы вызывается again. Возвращает False, если повторы исчерпаны.
+    def retry(self, host, phase, again):
+        attempt = host.attempts.get(phase, 0) + 1
+        if self.stopped() or attempt > self.retries.get(phase, 0):
+            return False
+        host.attempts[phase] = attempt
+        delay = min(Globals.retry_backoff_max, Globals.retry_backoff * 2 ** (attempt - 1))
+        helpers.Logger.w('%s: повтор %s через %g с (попытка %d из %d)'
+                         % (host.hostname, phase, delay, attempt, self.retries[phase]))
+
+        generation = self.thread_generation()
+
+        def fire():
+            self.local.generation = generation
+            with self.lock:
+                if self.stopped() or not self.running:
+                    return
+            again()
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        with self.lock:
+            self.timers.append(timer)
+        timer.start()
+        return True
+
+    def cancel_retries(self):
+        with self.lock:
+            timers, self.timers = self.timers, []
+        for timer in timers:
+            timer.cancel()
+
+    # Копирование файлов base files (пути относительно base) с source_host или, если его нет, с локального
+    # компьютера. files=None - весь base с удалением лишнего. resume - повтор после неудачи: не tar-потоком.
+    def copy_base(self, source_host, destination_host, files, resume=False):
+        path = self.installation_path.strip()
+        if files is not None and not files:
+            return 0
+        seeding = files is None and self.tarring and not resume  # Каталог пуст: tar-потоком, см. tar_copy
+        if not source_host:  # Копирование с локального хоста на удалённый.
+            if seeding:
+                return self.transport.push_tar(self.distribution.base, destination_host.hostname, path,
+                                               size=self.base_size())
+            return self.transport.push(self.distribution.base, destination_host.hostname, path, files is None, files)
+        if not self.pipelining and not self.stamping:  # Копирование с удалённого хоста на удалённый.
+            if seeding:
+                return self.transport.relay_tar(source_host.hostname, path, destination_host.hostname, path,
+                                                size=self.base_size())
+            return self.transport.relay(source_host.hostname, path, destination_host.hostname, path, files)
+        # На источнике уже может быть его conf (конвейер или источник установлен прошлым запуском): берём с него
+        # только файлы, которые conf не перекрывает, перекрываемые - из локального base. Копирование по списку
+        # лишнего не удаляет: при копировании base целиком оно удаляется отдельно.
+        delete = files is None
+        if files is None:
+            files = self.base_files
+        relay_files = [f for f in files if f not in self.shadowed]
+        shadowed_files = [f for f in files if f in self.shadowed]
+        returncode = 0
+        if relay_files and seeding:
+            returncode = self.transport.relay_tar(source_host.hostname, path, destination_host.hostname, path,
+                                                  relay_files, self.base_size(len(relay_files)))
+        elif relay_files:
+            returncode = self.transport.relay(source_host.hostname, path, destination_host.hostname, path,
+                                              relay_files)
+        if returncode == 0 and shadowed_files and not self.stopped():
+            if seeding:
+                returncode = self.transport.push_tar(self.distribution.base, destination_host.hostname, path,
+                                                     shadowed_files, self.base_size(len(shadowed_files)))
+            else:
+                returncode = self.transport.push(self.distribution.base, destination_host.hostname, path,
+                                                 files=shadowed_files)
+        if returncode == 0 and delete and not self.stopped():
+            returncode = self.transport.prune(destination_host.hostname, path, files)
+        return returncode
+
+    # Размер base в байтах (0, пока не посчитан) или, если задано число файлов count, его доля на count файлов.
+    def base_size(self, count=None):
+        size = -self.distribution.size if self.distribution.size < 0 else 0
+        if count is None:
+            return size
+        return size * count // max(1, len(self.base_files))
+
+    # Копирование с проверкой на приёмнике по мере записи, аналог copy_base. rest - проверить чтением
+    # остальные файлы манифеста. Возвращает (код возврата, файлы с ошибкой).
+    def stream_base(self, source_host, destination_host, files, rest, found):
+        path = self.installation_path.strip()
+        manifest = os.path.basename(self.distribution.base_txt)
+        delete = files is None
+        if files is None:
+            files = self.base_files
+        if not source_host:
+            parts = [(None, files)]
+        elif not self.pipelining and not self.stamping:
+            parts = [(source_host, files)]
+        else:  # Перекрываемые conf файлы из локального base, см. copy_base.
+            parts = [(None, [f for f in files if f in self.shadowed]),
+                     (source_host, [f for f in files if f not in self.shadowed])]
+            parts = [part for part in parts if part[1]]
+        # Из нескольких потоков ни один не содержит всего base: лишнее удаляется отдельно после них.
+        pruning = delete and len(parts) > 1
+        delete = delete and not pruning
+        returncode = 0
+        mismatched = []
+        for i, (source, part) in enumerate(parts):
+            if self.stopped():
+                return 1, mismatched
+            last = i == len(parts) - 1
+            code, files_with_mismatched_md5 = self.transport.stream(
+                source.hostname if source else None, path if source else self.local_base(),
+                destination_host.hostname, path, part, manifest, rest and last, delete and last, found)
+            mismatched += files_with_mismatched_md5
+            if code not in (0, 1):
+                return code, mismatched
+            returncode = returncode or code
+        if pruning and not self.stopped() and self.transport.prune(destination_host.hostname, path, files) != 0:
+            return 2, mismatched
+        return returncode, mismatched
+
+    # Инкрементальная установка: (файлы base для копирования, файлы для удаления) по манифесту, который
+    # уже лежит на хосте. Если манифеста нет, копируется весь base: (None, []).
+    def delta(self, host):
+        old = self.transport.read_manifest(host.hostname, self.installation_path)
+        if old is None:
+            return None, []
+        old_name, old_text = old
+        old_manifest = helpers.parse_manifest(old_text.splitlines())
+        # Файлы, которые перекрывал conf, на хосте не совпадают с base - копируются всегда,
+        # как и файлы вне манифеста (включая сам манифест).
+        files = [f for f in self.base_files
+                 if f in self.shadowed or f not in self.manifest or old_manifest.get(f) != self.manifest[f]]
+        removed = [f for f in old_manifest if f not in self.manifest and f not in self.base_files_set]
+        if old_name != os.path.basename(self.distribution.base_txt):
+            removed.append(old_name)
+        helpers.Logger.i('%s: изменилось %d файлов из %d, удаляется %d'
+                         % (host.hostname, len(files), len(self.base_files), len(removed)))
+        return files, removed
+
+    # Копирование с источника закончено: если это было последнее, источник снова свободен.
+    def release_source(self, source_host):
+        with self.lock:
+            source_host.outgoing -= 1
+            if source_host.outgoing <= 0:
+                source_host.outgoing = 0
+                source_host.state = Host.State.BASE_SUCCESS
+
+    # Цепочка. Шаг 1: сброс отметки и подготовка каталогов на всех хостах параллельно. Хосты с прежней
+    # установкой (инкрементальный режим) возвращаются в очередь: изменения они получат обычным способом.
+    def do_chain_base(self, hosts):
+        def prepare(host):
+            host.base_timer = 0
+            if self.incremental and self.transport.read_manifest(host.hostname, self.installation_path) is not None:
+                return host, None
+            returncode = self.write_stamp(host, None)
+            if returncode == 0:
+                returncode = self.transport.prepare(host.hostname, self.installation_path, True)
+            return host, returncode
+        chained = []
+        for host, returncode in agent.parallel(prepare, hosts, self.workers['base']):
+            if self.stopped():
+                return
+            if returncode is None:
+                host.state = Host.State.QUEUED
+            elif returncode != 0:
+                helpers.Logger.e('На %s не удалось удалить %s' % (host.hostname, self.installation_path))
+                host.state = Host.State.FAILURE
+            else:
+                chained.append(host)
+        chained.sort(key=hosts.index)
+        if not chained:
+            self.worker()
+            return
+
+        # Шаг 2: base одним потоком по цепочке с проверкой при записи на каждом хосте.
+        mismatched = dict((host.hostname, []) for host in chained)
+
+        def found(hostname, file):
+            helpers.Logger.w('%s: ошибка md5: %s' % (hostname, file))
+            mismatched[hostname].append(file)
+        results = self.transport.chain(self.local_base(), [host.hostname for host in chained],
+                                       self.installation_path.strip(), self.base_files,
+                                       os.path.basename(self.distribution.base_txt), found)
+        if self.stopped():
+            return
+
+        # Шаг 3: итог по хостам. Файлы с ошибкой копируются повторно с локального компьютера. Хосты за оборвавшимся
+        # звеном (и само звено) возвращаются в очередь: base они получат обычным "пауком" от хостов,
+        # которые цепочку прошли, или с локального компьютера.
+        for host in chained:
+            returncode = results[host.hostname]
+            if returncode == 1 and mismatched[host.hostname] and not self.stopped():
+                returncode, files = self.recopy_base(
+                    host, mismatched[host.hostname],
+                    lambda file, hostname=host.hostname: helpers.Logger.w('%s: ошибка md5: %s' % (hostname, file)))
+            if self.stopped():
+                return
+            if returncode == 0:
+                if self.do_verify:
+                    self.write_stamp(host, 'base', self.base_digest)
+                host.state = Host.State.BASE_SUCCESS
+                if self.pipelining:
+                    self.start_conf(host)
+            else:
+                helpers.Logger.w('%s: base не получен по цепочке (код %d), копируется обычным способом'
+                                 % (host.hostname, returncode))
+                host.state = Host.State.QUEUED
+        self.worker()
+
+    # Рой: куски base по манифесту и учёт того, у кого какие куски, см. swarm.py.
+    def make_tracker(self):
+        sizes = {}
+        for f in self.base_files:
+            if self.distribution.archive:
+                sizes[f] = self.distribution.archive.members[f].file_size
+            else:
+                try:
+                    sizes[f] = os.path.getsize(os.path.join(self.distribution.base, f))
+                except OSError:
+                    sizes[f] = 0
+        chunks = swarm.split(self.base_files, sizes, self.manifest, self.swarm_chunk,
+                             os.path.basename(self.distribution.base_txt))
+        helpers.Logger.i('Рой: base разбит на %d кусков по %s'
+                         % (len(chunks), helpers.bytes_to_human(self.swarm_chunk)))
+        return swarm.Tracker(chunks, self.fanout_rules.limit, self.topology, self.hostname)
+
+    # Рой, шаг 1: сброс отметки, подготовка каталога установки и список нужных хосту файлов.
+    def do_join_swarm(self, host):
+        host.base_timer = 0
+        returncode = self.write_stamp(host, None)
+        if returncode == 0:
+            returncode = self.transport.prepare(host.hostname, self.installation_path, not self.incremental)
+        if self.stopped():
+            return
+        if returncode != 0:
+            helpers.Logger.e('На %s не удалось удалить %s' % (host.hostname, self.installation_path))
+            host.state = Host.State.FAILURE
+            self.worker()
+            return
+        files, removed = self.delta(host) if self.incremental else (None, [])
+        if self.stopped():
+            return
+        with self.lock:
+            self.leftovers[host.hostname] = (files is not None, removed)
+            self.tracker.join(host.hostname, files)
+        self.worker()
+
+    # Рой, шаг 2: передача куска с source_host (None - с локального компьютера) и его проверка на приёмнике.
+    # Проверенный кусок приёмник сразу раздаёт дальше.
+    def do_copy_chunk(self, i, source_host, destination_host, files):
+        if self.stopped():
+            return
+        manifest = os.path.basename(self.distribution.base_txt)
+
+        def found(file):
+            helpers.Logger.w('%s: ошибка md5: %s' % (destination_host.hostname, file))
+        if self.streaming:
+            returncode, mismatched = self.stream_base(source_host, destination_host, files, False, found)
+        else:
+            returncode = self.copy_base(source_host, destination_host, files)
+            if returncode == 0 and self.do_verify:
+                returncode, mismatched = self.transport.verify(
+                    destination_host.hostname, self.installation_path, manifest, found, files)
+        if self.stopped():
+            return
+        with self.lock:
+            source = source_host.hostname if source_host else None
+            failed = self.tracker.done(i, source, destination_host.hostname, returncode == 0)
+            if returncode != 0:
+                helpers.Logger.w('%s: не удалось получить кусок %s с %s'
+                                 % (destination_host.hostname, self.tracker.chunks[i].id, source or 'localhost'))
+            if failed:
+                helpers.Logger.e('%s: слишком много ошибок копирования base' % destination_host.hostname)
+                self.tracker.drop(destination_host.hostname)
+                destination_host.state = Host.State.FAILURE
+        self.worker()
+
+    # Рой, шаг 3: хост получил все куски - удаление лишнего, в инкрементальном режиме проверка base целиком
+    # (куски проверены, но прежние файлы могли быть изменены вручную), отметка.
+    def do_finish_swarm(self, host):
+        existed, removed = self.leftovers.pop(host.hostname)
+        returncode = 0
+        if removed and not self.stopped():
+            helpers.Logger.i('%s: удаление %d файлов' % (host.hostname, len(removed)))
+            returncode = self.transport.remove(host.hostname, self.installation_path, removed)
+        # Каталог без прежнего манифеста получил куски списками файлов, без удаления: лишнее удаляется по base,
+        # как в copy_base (без инкрементального режима каталог очищен в do_join_swarm).
+        if returncode == 0 and not existed and self.incremental and not self.stopped():
+            returncode = self.transport.prune(host.hostname, self.installation_path.strip(), self.base_files)
+        manifest = os.path.basename(self.distribution.base_txt)
+
+        def found(file):
+            helpers.Logger.w('%s: ошибка md5: %s' % (host.hostname, file))
+        if returncode == 0 and existed and self.do_verify and not self.stopped():
+            returncode, mismatched = self.transport.verify(host.hostname, self.installation_path, manifest, found)
+            if returncode and mismatched and not self.stopped():
+                returncode, mismatched = self.recopy_base(host, mismatched, found)
+            if returncode:
+                helpers.Logger.e('%s: не пройдена проверка по %s, файлов с ошибкой: %d'
+                                 % (host.hostname, manifest, len(mismatched)))
+        if self.stopped():
+            return
+        if returncode:
+            with self.lock:
+                self.tracker.drop(host.hostname)
+                host.state = Host.State.FAILURE
+            self.worker()
+            return
+        if self.do_verify:
+            self.write_stamp(host, 'base', self.base_digest)
+        with self.lock:
+            self.tracker.seed(host.hostname)
+            host.state = Host.State.BASE_SUCCESS
+        if self.pipelining:
+            self.start_conf(host)
+        self.worker()
+
+    # Каталог, в котором common и персональный каталог хоста сложены в одно дерево (жёсткими ссылками),
+    # чтобы conf уходил на хост одним копированием. Персональные файлы перекрывают common.
+    def stage_conf(self, hostname):
+        staging = os.path.join(self.staging_dir, hostname)
+        shutil.rmtree(staging, ignore_errors=True)
+        # Подкаталог конфигураций common не обязателен!
+        for source in (os.path.join(self.configuration_dir(), 'common'), os.path.join(self.configuration_dir(), hostname)):
+            for dirpath, dirnames, filenames in os.walk(source):
+                target = os.path.normpath(os.path.join(staging, os.path.relpath(dirpath, source)))
+                if os.path.islink(target):  # Ссылку из common перекрывает персональный каталог
+                    os.remove(target)
+                os.makedirs(target, exist_ok=True)
+                # Символические ссылки (и на каталоги, в которые os.walk не заходит) переносятся ссылками,
+                # как при rsync -a; если ссылку создать нельзя (Windows без прав) - копией.
+                links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+                for f in filenames + links:
+                    path = os.path.join(dirpath, f)
+                    destination = os.path.join(target, f)
+                    if os.path.isdir(destination) and not os.path.islink(destination):
+                        shutil.rmtree(destination)
+                    elif os.path.lexists(destination):
+                        os.remove(destination)
+                    if os.path.islink(path):
+                        try:
+                            os.symlink(os.readlink(path), destination)
+                            continue
+                        except OSError:
+                            if os.path.isdir(path):
+                                shutil.copytree(path, destination)
+                                continue
+                    try:
+                        os.link(path, destination)
+                    except OSError:
+                        shutil.copy2(path, destination)
+        os.makedirs(staging, exist_ok=True)
+        return staging
+
+    # Откуда копируется base с этого компьютера: каталог или архив (ArchiveBase, только потоком).
+    def local_base(self):
+        return self.distribution.archive or self.distribution.base
+
+    # Списки файлов base и файлов, перекрываемых conf, для копирования по списку.
+    def scan_base(self):
+        self.shadowed = set()
+        for name in os.listdir(self.configuration_dir()):
+            source = os.path.join(self.configuration_dir(), name)
+            for dirpath, dirnames, filenames in os.walk(source):
+                for f in filenames:
+                    self.shadowed.add(os.path.normpath(os.path.relpath(os.path.join(dirpath, f), source)))
+        self.base_files = []
+        if self.distribution.archive:  # base не распакован, на диске только манифест
+            self.base_files = list(self.distribution.archive.members)
+        else:
+            for dirpath, dirnames, filenames in os.walk(self.distribution.base):
+                for f in filenames:
+                    self.base_files.append(
+                        os.path.normpath(os.path.relpath(os.path.join(dirpath, f), self.distribution.base)))
+        self.base_files_set = set(self.base_files)
+        with open(self.distribution.base_txt, errors='ignore') as f:
+            self.manifest = helpers.parse_manifest(f)
+
+    # Путь к отметке об установленной версии на хостах.
+    def stamp_path(self):
+        return self.installation_path.strip().rstrip('/\\') + '.installer-stamp'
+
+    # md5 conf хоста: common с перекрывающим его персональным каталогом.
+    def conf_digest(self, hostname):
+        files = {}
+        for source in (os.path.join(self.configuration_dir(), 'common'), os.path.join(self.configuration_dir(), hostname)):
+            for dirpath, dirnames, filenames in os.walk(source):
+                for f in filenames:
+                    files[os.path.relpath(os.path.join(dirpath, f), source).replace(os.sep, '/')] = \
+                        os.path.join(dirpath, f)
+        digest = hashlib.md5()
+        for relative in sorted(files):
+            with open(files[relative], 'rb') as f:
+                digest.update(('%s %s\n' % (hashlib.md5(f.read()).hexdigest(), relative)).encode())
+        return digest.hexdigest()
+
+    # Запись шага step в отметку хоста; step=None - сброс отметки перед изменением каталога установки.
+    # conf и post записываются, только если base в отметке есть.
+    def write_stamp(self, host, step, digest=''):
+        if not self.stamping:
+            return 0
+        with self.lock:
+            if step is None:
+                self.stamps.pop(host.hostname, None)
+                stamp = {}
+            elif step == 'base':
+                stamp = self.stamps[host.hostname] = {'base': digest}
+            elif host.hostname in self.stamps:
+                stamp = self.stamps[host.hostname]
+                stamp[step] = digest
+            else:
+                return 0
+            text = ''.join('%s %s\n' % (key, value) for key, value in stamp.items())
+        returncode = self.transport.write_file(host.hostname, self.stamp_path(), text)
+        if returncode:
+            helpers.Logger.w('%s: не удалось записать %s' % (host.hostname, self.stamp_path()))
+        return returncode
+
+    # Предварительная проверка отметки: хост с тем же base не переустанавливается и сразу может раздавать base,
+    # при совпадении conf и post он уже установлен полностью.
+    def do_check(self, host):
+        if self.stopped():
+            return
+        text = self.transport.read_file(host.hostname, self.stamp_path())
+        stamp = dict(line.split(' ', 1) for line in (text or '').splitlines() if ' ' in line)
+        conf_digest = self.conf_digest(host.hostname)
+        if self.stopped():
+            return
+        with self.lock:
+            if stamp.get('base') != self.base_digest:
+                host.state = Host.State.QUEUED
+            else:
+                self.stamps[host.hostname] = {'base': self.base_digest}
+                installed = 'base'
+                if stamp.get('conf') == conf_digest:
+                    self.stamps[host.hostname]['conf'] = conf_digest
+                    host.conf_state = Host.State.CONF_SUCCESS
+                    installed += ', conf'
+                    if not self.post_install_script_used or stamp.get('post') == self.post_digest:
+                        self.stamps[host.hostname]['post'] = self.post_digest
+                        host.post_state = Host.State.POST_SUCCESS
+                        installed += ', post'
+                helpers.Logger.i('%s: уже установлено: %s' % (host.hostname, installed))
+                if self.tracker:
+                    self.tracker.seed(host.hostname)
+                host.state = Host.State.BASE_SUCCESS
+                if self.pipelining:
+                    self.start_conf(host)
+        self.worker()
+
+    # Конвейер: постановка conf хоста сразу после его base (если conf уже стоит - post).
+    def start_conf(self, host):
+        with self.lock:
+            if self.stopped() or not self.executors:
+                return
+            if host.conf_state == Host.State.CONF_SUCCESS:
+                if self.post_install_script_used and host.post_state != Host.State.POST_SUCCESS:
+                    self.pipelined += 1
+                    host.post_state = Host.State.POST_RUNNING
+                    self.submit('post', self.do_run_post_script, host)
+                return
+            self.pipelined += 1
+            host.conf_state = Host.State.CONF_INSTALLING
+            self.submit('conf', self.do_copy_conf, host)
+
+    def finish_conf(self, host, result):
+        if result == Host.State.CONF_SUCCESS:
+            self.write_stamp(host, 'conf', self.conf_digest(host.hostname))
+        with self.lock:
+            host.conf_state = result
+            if not self.pipelining:
+                host.state = result
+            elif result == Host.State.CONF_SUCCESS and self.post_install_script_used and self.executors:
+                host.post_state = Host.State.POST_RUNNING
+                self.submit('post', self.do_run_post_script, host)
+            else:
+                self.pipelined -= 1
+        self.worker()
+
+    def finish_post(self, host, result):
+        if result == Host.State.POST_SUCCESS:
+            self.write_stamp(host, 'post', self.post_digest)
+        with self.lock:
+            host.post_state = result
+            if self.pipelining:
+                self.pipelined -= 1
+            else:
+                host.state = result
+        self.worker()
+
+    def do_copy_conf(self, host):
+        if self.stopped():
+            return
+        try:
+            staging = self.stage_conf(host.hostname)
+        except OSError as e:
+            helpers.Logger.e('%s: не удалось подготовить conf: %s' % (host.hostname, e))
+            self.finish_conf(host, Host.State.FAILURE)
+            return
+        returncode = self.transport.push(staging, host.hostname, self.installation_path.strip())
+        shutil.rmtree(staging, ignore_errors=True)
+        if self.stopped():
+            return
+        if returncode != 0 and self.retry(host, 'conf', lambda: self.submit('conf', self.do_copy_conf, host)):
+            return
+        self.finish_conf(host, Host.State.FAILURE if returncode != 0 else Host.State.CONF_SUCCESS)
+
+    def do_run_post_script(self, host):
+        if self.stopped():
+            return
+        s = os.path.join('etc', os.path.basename(self.post_install_script()))
+        log = helpers.Logger.host_log(host.hostname, 'post')
+        with open(log, 'wb') as output:
+            returncode = self.transport.execute(host.hostname, self.installation_path, s, output)
+        if self.stopped():
+            return
+        if returncode:
+            helpers.Logger.e(
+                'Ошибка выполнения post-скрипта: host=%s returncode=%d, вывод в %s' % (host.hostname, returncode, log))
+            if self.retry(host, 'post', lambda: self.submit('post', self.do_run_post_script, host)):
+                return
+        self.finish_post(host, Host.State.FAILURE if returncode else Host.State.POST_SUCCESS)
+
+    # Запуск установки поставленных в очередь хостов (start, GUI). Если установка уже идёт - шаг планировщика.
+    def run(self):
+        with self.lock:
+            if not self.running:
+                self.stop = False
+                self.generation += 1
+                self.running = True
+                self.transport.reset()
+                self.topology = Topology(self.settings())
+                self.fanout_rules = Fanout(self.settings(), self.fanout)
+                for host in self.hosts:
+                    host.failures = 0
+                    host.attempts = {}
+                    host.avoid = set()
+                    host.slow = 0
+                self.races = {}
+                self.durations = []
+                self.index = HostIndex(self.hosts, self.topology, self.fanout_rules, self.lock, Globals.source_failures)
+                self.post_install_script_used = os.path.exists(self.post_install_script())
+                self.staging_dir = tempfile.mkdtemp(prefix='installer-conf-')
+                self.post_batch_size = 0
+                try:
+                    parse_batch(self.post_batch)
+                except ValueError as e:
+                    helpers.Logger.w('Размер волны post-скриптов не разобран (%s), post-скрипты идут все сразу' % e)
+                    self.post_batch = ''
+                self.pipelining = self.pipeline and self.transport.files_supported
+                if self.pipeline and not self.pipelining:
+                    helpers.Logger.w('Транспорт не умеет копировать по списку файлов, конвейер отключён')
+                self.incremental = not self.wipe and self.transport.files_supported
+                if self.distribution.archive and not self.transport.stream_supported:
+                    helpers.Logger.w('Транспорт не умеет копировать потоком, base распаковывается из архива')
+                    self.distribution.extract_base()
+                # base из архива копируется только потоком, с проверкой при записи.
+                self.streaming = ((self.verify_on_copy and self.do_verify or self.distribution.archive is not None)
+                                  and self.transport.stream_supported)
+                self.tarring = self.tar_copy and self.transport.tar_supported and not self.streaming
+                self.swarming = self.swarm and self.transport.files_supported
+                if self.swarm and not self.swarming:
+                    helpers.Logger.w('Транспорт не умеет копировать по списку файлов, рой отключён')
+                self.chaining = self.chain and self.transport.stream_supported and not self.swarming
+                if self.chain and not self.chaining:
+                    helpers.Logger.w('Цепочка отключена: транспорт не умеет копировать потоком или включён рой')
+                self.chained = False
+                self.pipelined = 0
+                if self.pipelining or self.incremental or self.streaming or self.swarming or self.chaining:
+                    self.scan_base()
+                self.tracker = self.make_tracker() if self.swarming else None
+                self.leftovers = {}
+                self.stamping = self.incremental
+                self.stamps = {}
+                if self.stamping:
+                    with open(self.distribution.base_txt, 'rb') as f:
+                        self.base_digest = hashlib.md5(f.read()).hexdigest()
+                    self.post_digest = ''
+                    if self.post_install_script_used:
+                        with open(self.post_install_script(), 'rb') as f:
+                            self.post_digest = hashlib.md5(f.read()).hexdigest()
+                self.executors = dict((phase, ThreadPoolExecutor(max_workers=max(1, limit),
+                                                                 thread_name_prefix=phase))
+                                      for phase, limit in self.workers.items())
+                if self.stamping:
+                    for host in self.index.hosts(Host.State.QUEUED):
+                        host.state = Host.State.CHECKING
+                        self.submit('base', self.do_check, host)
+                threading.Thread(target=self.heartbeat, args=(self.generation,), daemon=True).start()
+                self.on_started()
+            self.worker()
+
+    # Шаг планировщика идущей установки: после каждого события задач. Новую установку не запускает.
+    def worker(self):
+        with self.lock:
+            if self.stopped() or not self.running:
+                return
+            if self.schedule():
+                self.running = False
+                self.cancel_retries()
+                self.shutdown_executors()
+                self.remove_staging_dir()
+                self.transport.close()
+                self.on_finished()
+
+    def remove_staging_dir(self):
+        if self.staging_dir:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = ''
+
+    def shutdown_executors(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.executors = {}
+
+    # Общий для всех хостов таймер: счётчики времени и одна перерисовка в секунду.
+    def heartbeat(self, generation):
+        self.local.generation = generation
+        while self.running and not self.stopped():
+            time.sleep(1)
+            if not threading.main_thread().is_alive():
+                return
+            if not self.running or self.stopped():
+                return
+            for host in self.index.hosts(Host.State.BASE_INSTALLING_DESTINATION):
+                host.base_timer += 1
+            self.speculate()
+            if self.distribution:
+                self.distribution.installation_timer += 1
+            self.on_hosts_changed()
+            self.on_tick()
+
+    # Запуск задачи в пуле потоков фазы phase. Задача относится к запуску назначившего её потока.
+    def submit(self, phase, target, *args):
+        future = self.executors[phase].submit(self.run_task, self.thread_generation(), target, *args)
+        future.add_done_callback(self.on_task_done)
+
+    def run_task(self, generation, target, *args):
+        self.local.generation = generation
+        if not self.stopped():
+            target(*args)
+
+    @staticmethod
+    def on_task_done(future):
+        if not future.cancelled() and future.exception():
+            e = future.exception()
+            helpers.Logger.e(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+    def start_copy_base(self, source_host, destination_host):
+        if source_host:
+            source_host.outgoing += 1
+            source_host.state = Host.State.BASE_INSTALLING_SOURCE
+            helpers.Logger.i('Копирование base: %s -> %s' % (source_host.hostname, destination_host.hostname))
+        else:
+            helpers.Logger.i('Копирование base: localhost -> %s' % destination_host.hostname)
+            destination_host.base_timer = -1
+        destination_host.state = Host.State.BASE_INSTALLING_DESTINATION
+        self.submit('base', self.do_copy_base, source_host, destination_host)
+
+    # Шаг роя: новые хосты присоединяются, свободные каналы получают передачи кусков, получившие все куски хосты
+    # завершают base. Хосты с base (по отметке или уже получившие её) раздают любой кусок: в трекер они попадают
+    # при переходе в BASE_SUCCESS (do_check, do_finish_swarm). Возвращает True, если что-то запущено.
+    def schedule_swarm(self):
+        started = False
+        for host in self.index.hosts(Host.State.QUEUED):
+            host.state = Host.State.BASE_INSTALLING_DESTINATION
+            self.submit('base', self.do_join_swarm, host)
+            started = True
+        while self.tracker.transfers < self.workers['base']:
+            transfer = self.tracker.next_transfer()
+            if not transfer:
+                break
+            i, source, destination, files = transfer
+            self.submit('base', self.do_copy_chunk, i, self.index.by_hostname[source] if source else None,
+                        self.index.by_hostname[destination], files)
+            started = True
+        for hostname in self.tracker.finished():
+            self.submit('base', self.do_finish_swarm, self.index.by_hostname[hostname])
+            started = True
+        return started
+
+    # Один шаг планировщика. Возвращает True, если установка завершена.
+    def schedule(self):
+        # Пока идёт проверка отметок, неизвестно, какие хосты уже могут раздавать base.
+        if self.index.count(Host.State.CHECKING):
+            return False
+
+        # Копирование base
+        if self.chaining and not self.chained and self.index.count(Host.State.QUEUED):
+            self.chained = True
+            local_segment = self.topology.segment(self.hostname)
+            # Локальный компьютер, если он в списке, первым, затем хосты по сегментам, начиная с его сегмента:
+            # цепочка пересекает границы сегментов как можно реже.
+            hosts = sorted(self.index.hosts(Host.State.QUEUED),
+                           key=lambda host: (host.hostname != self.hostname,
+                                             self.topology.segment(host.hostname) != local_segment,
+                                             self.topology.segment(host.hostname) or '', host.hostname))
+            for host in hosts:
+                host.state = Host.State.BASE_INSTALLING_DESTINATION
+            self.submit('base', self.do_chain_base, hosts)
+            self.on_hosts_changed()
+            return False
+        if self.swarming:
+            if self.schedule_swarm():
+                self.on_hosts_changed()
+                return False
+        any_base_copy_started = False
+        # Копирований не больше, чем потоков в пуле base: остальные приёмники ждут в QUEUED.
+        while not self.swarming and self.index.count(Host.State.BASE_INSTALLING_DESTINATION) < self.workers['base']:
+            pair = self.index.next_pair()
+            if not pair:
+                break
+            self.start_copy_base(*pair)
+            any_base_copy_started = True
+        # Нет хостов с base и никуда не копируется - начинаем с локального компьютера.
+        if not self.swarming and not self.index.count(*HOLDING_STATES) and self.index.count(Host.State.QUEUED):
+            segment = self.topology.segment(self.hostname)
+            for i in range(min(self.fanout_rules.limit(self.hostname), self.workers['base'])):
+                first_host = None
+                if i == 0:
+                    first_host = self.index.queued_host(self.hostname)  # Начинаем с локального компьютера, если возможно
+                if not first_host:  # Затем с хоста из того же сегмента, что и локальный компьютер
+                    first_host = self.index.next_destination(segment)
+                if not first_host:
+                    break
+                self.start_copy_base(None, first_host)
+                any_base_copy_started = True
+        # Приёмникам, которым не подходит ни один источник (все не удались или ненадёжны), когда копирований
+        # больше нет и ждать нечего, - с локального компьютера.
+        if (not self.swarming and self.index.count(Host.State.QUEUED)
+                and not self.index.count(Host.State.BASE_INSTALLING_SOURCE, Host.State.BASE_INSTALLING_DESTINATION)):
+            for host in self.index.hosts(Host.State.QUEUED)[:min(self.fanout_rules.limit(self.hostname),
+                                                                 self.workers['base'])]:
+                self.start_copy_base(None, host)
+                any_base_copy_started = True
+        if any_base_copy_started:
+            self.on_hosts_changed()
+            return False
+
+        # Если хотя бы один QUEUED, то значит ещё не везде ещё скопирован base - выходим.
+        if self.index.count(Host.State.QUEUED, Host.State.BASE_INSTALLING_SOURCE,
+                            Host.State.BASE_INSTALLING_DESTINATION, Host.State.BASE_WAITING):
+            return False
+
+        # В конвейере conf и post уже поставлены по каждому хосту: ждём их и подводим итог.
+        if self.pipelining:
+            if self.pipelined:
+                return False
+            for host in self.index.hosts(Host.State.BASE_SUCCESS):
+                if (host.conf_state == Host.State.CONF_SUCCESS
+                        and (not self.post_install_script_used or host.post_state == Host.State.POST_SUCCESS)):
+                    host.state = Host.State.SUCCESS
+                else:
+                    host.state = Host.State.FAILURE
+            self.on_hosts_changed()
+            return True
+
+        # Если нет ни одного QUEUED, значит все так или иначе прошли копирование base - поэтому ищем BASE_SUCCESS
+        # и ставим копирование conf.
+        if self.index.count(Host.State.CONF_INSTALLING, Host.State.POST_RUNNING):
+            return False
+        if self.index.count(Host.State.BASE_SUCCESS):
+            any_conf_copy_started = False
+            for host in self.index.hosts(Host.State.BASE_SUCCESS):
+                if host.conf_state == Host.State.CONF_SUCCESS:  # conf уже стоит по отметке на хосте
+                    if self.post_install_script_used and host.post_state == Host.State.POST_SUCCESS:
+                        host.state = Host.State.POST_SUCCESS
+                    else:
+                        host.state = Host.State.CONF_SUCCESS
+                    continue
+                host.state = host.conf_state = Host.State.CONF_INSTALLING
+                self.submit('conf', self.do_copy_conf, host)
+                any_conf_copy_started = True
+            self.on_hosts_changed()
+            if any_conf_copy_started:
+                return False
+
+        # Выполнение post-скриптов
+        if self.post_install_script_used:
+            if self.index.count(Host.State.CONF_SUCCESS):
+                if not self.post_batch_size:
+                    self.post_batch_size = batch_size(self.post_batch, self.index.count(Host.State.CONF_SUCCESS))
+                # Следующая волна начинается, когда закончилась предыдущая.
+                for host in self.index.hosts(Host.State.CONF_SUCCESS)[:self.post_batch_size]:
+                    host.state = host.post_state = Host.State.POST_RUNNING
+                    self.submit('post', self.do_run_post_script, host)
+                self.on_hosts_changed()
+                return False
+            success_state = Host.State.POST_SUCCESS
+        else:
+            success_state = Host.State.CONF_SUCCESS
+
+        finished = self.index.count(Host.State.FAILURE, Host.State.SUCCESS, Host.State.IDLE, success_state)
+        if finished != len(self.index.keys):
+            return False
+        for host in self.index.hosts(success_state):
+            host.state = Host.State.SUCCESS
+        self.on_hosts_changed()
+        return True
@@ -5,3 +5,47 @@ class Globals:
     organization_name = 'xx'
     samba_login = 'xx'
     samba_password = 'xxxxxxxx'
+    # Сколько удалённых операций каждой фазы выполняется одновременно.
+    base_workers = 32
+    conf_workers = 16
+    post_workers = 16
+    # Post-скрипты волнами: '10%' или число хостов в волне, '' - все сразу.
+    post_batch = ''
+    # Конвейер: conf и post каждого хоста сразу после его base, не дожидаясь остальных.
+    pipeline = False
+    # Перед копированием base всегда очищать каталог установки (иначе копируются только изменения).
+    wipe = False
+    # Проверять суммы на приёмнике по мере записи, а не перечитывать base после копирования.
+    verify_on_copy = False
+    # Кэш распакованных дистрибутивов (каталог относительно установщика, '' - распаковывать рядом с архивом)
+    # и его предельный размер: сверх него удаляются давно не открывавшиеся дистрибутивы.
+    cache_dir = 'cache'
+    cache_budget = 50 * 1024 ** 3
+    # Не распаковывать base из zip-дистрибутива: первые хосты получают его tar-потоком прямо из архива.
+    stream_archive = False
+    # base целиком (пустой каталог установки) копировать tar-потоком вместо rsync; изменения по-прежнему rsync.
+    tar_copy = False
+    # Сжатие tar-потока: 'auto' - zstd или lz4, что есть на обеих сторонах; 'zstd', 'lz4' или '' - без сжатия.
+    compression = 'auto'
+    # Шаги установки на Linux-хосте выполняет одна сессия agent.py serve на хост (запросы по stdio),
+    # а не отдельная команда ssh на каждый шаг.
+    agent_session = False
+    # Рой: base кусками по swarm_chunk байт, хост получает куски с нескольких хостов сразу
+    # и раздаёт дальше уже проверенные куски, не дожидаясь всего base.
+    swarm = False
+    swarm_chunk = 64 * 1024 ** 2
+    # Цепочка: base одним потоком с этого компьютера через хосты по очереди, каждый пишет и передаёт дальше.
+    chain = False
+    # Повторы после неудачи: сколько раз по фазам (0 - без повторов), пауза перед первым повтором в секундах,
+    # удваивающаяся с каждым следующим, но не больше retry_backoff_max.
+    retries = {'base': 3, 'conf': 2, 'post': 0}
+    retry_backoff = 5
+    retry_backoff_max = 120
+    # Хост, с которого не удалось столько копирований base, источником больше не выбирается (0 - без ограничения).
+    source_failures = 3
+    # Отстающее копирование base: идёт дольше straggler_factor медиан уже законченных (их не меньше
+    # straggler_peers) и не меньше straggler_min секунд - отменяется и продолжается с другого источника
+    # (0 - выключено, например 3).
+    straggler_factor = 0
+    straggler_peers = 3
+    straggler_min = 30
@@ -9,10 +9,13 @@ import zipfile
 import subprocess
 import tempfile
 
+import agent
+
 
 class Logger:
     messages = []
     logfile = "installer.log"
+    logdir = "logs"  # Журналы отдельных хостов
 
     @staticmethod
     def reset():
@@ -30,6 +33,12 @@ class Logger:
     def e(message):
         Logger.write('*** %s' % message)
 
+    # Путь к журналу хоста hostname для шага step, например logs/host1.post.log.
+    @staticmethod
+    def host_log(hostname, step):
+        os.makedirs(Logger.logdir, exist_ok=True)
+        return os.path.join(Logger.logdir, '%s.%s.log' % (hostname, step))
+
     @staticmethod
     def write(message):
         pass
@@ -39,37 +48,6 @@ class Logger:
             f.write(message)
 
 
-def sync_remote_to_remote(source_hostname, source_path, destination_hostname, destination_path, login, password):
-    success = 0
-    if sys.platform == 'win32':
-        # cmd = 'PsExec64.exe -accepteula -nobanner \\\\%s -u %s -p %s robocopy %s \\\\%s\\%s /e /mt:32 /r:0 /w:0 /np /nfl /njh /njs /ndl /nc /ns > nul 2>&1' \
-        #       % (source_hostname,
-        #          login, password,
-        #          path, destination_hostname, path.replace(':', '$'))
-        cmd = 'PsExec64.exe -accepteula -nobanner \\\\%s -u %s -p %s xcopy "%s" "\\\\%s\\%s" /seyq > nul 2>&1' % (
-            source_hostname,
-            login, password,
-            source_path, destination_hostname, destination_path.replace(':', '$'))
-    else:
-        cmd = 'ssh root@%s "rsync -a --delete \"%s/\" root@%s:\"%s\""' \
-              % (source_hostname, source_path, destination_hostname, destination_path)
-    return subprocess.Popen(cmd, shell=True)
-
-
-def copy_from_local_to_remote(source_path, destinatin_hostname, destination_path, delete=False):
-    if sys.platform == 'win32':
-        # cmd = 'robocopy "%s" "\\\\%s\\%s" /e /mt:32 /r:0 /w:0 /np /nfl /njh /njs /ndl /nc /ns > nul 2>&1' \
-        #       % (source_path, destinatin_hostname, destination_path.replace(':', '$'))
-        cmd = 'xcopy "%s" "\\\\%s\\%s" /seyq > nul 2>&1' % (source_path, destinatin_hostname, destination_path.replace(':', '$'))
-    else:
-        additional_params = ''
-        if delete:
-            additional_params = '--delete'
-        cmd = 'rsync -a %s \"%s/\" root@%s:\"%s\"' \
-              % (additional_params, source_path, destinatin_hostname, destination_path)
-    return subprocess.Popen(cmd, shell=True)
-
-
 def git_revision(path=''):
     r = subprocess.run('git describe --always', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     print(r)
@@ -106,8 +84,32 @@ def open_folder(path):
         subprocess.run('xdg-open %s' % path, shell=True)
 
 
+# Идёт ли процесс pid на этом компьютере.
+def process_alive(pid):
+    if sys.platform == 'win32':
+        output = subprocess.run('tasklist /nh /fi "PID eq %d"' % pid, shell=True, capture_output=True, text=True)
+        return str(pid) in output.stdout.split()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Процесс есть, но чужой
+        return True
+    return True
+
+
 def open_txt(path):
     if sys.platform == 'win32':
         subprocess.run('notepad %s' % path, shell=True)
     else:
         subprocess.run('xdg-open %s' % path, shell=True)
+
+
+# Разбор манифеста base*.txt: путь файла -> "<алгоритм> <сумма>". Негодный манифест считается пустым.
+def parse_manifest(lines):
+    try:
+        entries = agent.read_manifest(lines)
+    except agent.ManifestError as e:
+        Logger.w(e)
+        return {}
+    return dict((os.path.normpath(path), '%s %s' % (algorithm, digest)) for algorithm, digest, path in entries)
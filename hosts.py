@@ -0,0 +1,259 @@
+# encoding: utf-8
+
+# Хосты и их индекс по состояниям. Хост сам сообщает индексу об изменении state/checked/outgoing,
+# поэтому планировщику не нужно на каждое событие перебирать все хосты.
+
+from enum import Enum, auto
+
+
+class Host:
+    class State(Enum):
+        DISCOVERED = auto()
+        IDLE = auto()
+        QUEUED = auto()
+        CHECKING = auto()  # Проверка отметки об установленной версии
+        BASE_INSTALLING_SOURCE = auto()
+        BASE_INSTALLING_DESTINATION = auto()
+        BASE_WAITING = auto()  # Пауза перед повтором неудавшегося копирования base
+        BASE_SUCCESS = auto()
+        CONF_NON_NEEDED = auto()
+        CONF_INSTALLING = auto()
+        CONF_SUCCESS = auto()
+        CONF_FAILURE = auto()
+        POST_NON_NEEDED = auto()
+        POST_RUNNING = auto()
+        POST_SUCCESS = auto()
+        POST_FAILURE = auto()
+        SUCCESS = auto()
+        FAILURE = auto()
+
+
+class TableData:
+    class Host:
+        def __init__(self, hostname, checked=True):
+            self.hostname = hostname.lower()
+            self.index = None  # HostIndex, в котором учтён хост
+
+            self.base_timer = None
+            self.conf_counter_overwrite = None
+            self.installation_timer = None
+            self.conf_state = None
+            self.post_state = None
+            self.state = None
+            self.checked = None
+            self.outgoing = None  # Сколько копирований base идёт с этого хоста
+            self.failures = None  # Сколько копирований base с этого хоста не удалось (за установку)
+            self.attempts = {}  # Фаза -> сколько повторов уже назначено
+            self.avoid = set()  # Источники, копирование с которых на этот хост не удалось
+            self.slow = 0  # Сколько раз копирование с этого хоста обогнало запасное (см. Engine.speculate)
+
+            self.reset()
+
+            self.checked = checked
+
+        def reset(self):
+            self.base_timer = -1
+            self.conf_counter_overwrite = 0
+            self.installation_timer = 0
+            self.conf_state = Host.State.IDLE
+            self.post_state = Host.State.IDLE
+            self.state = Host.State.IDLE
+            self.checked = False
+            self.outgoing = 0
+            self.failures = 0
+            self.attempts = {}
+            self.avoid = set()
+            self.slow = 0
+
+        @property
+        def state(self):
+            return self._state
+
+        @state.setter
+        def state(self, value):
+            self._state = value
+            if self.index:
+                self.index.update(self)
+
+        @property
+        def checked(self):
+            return self._checked
+
+        @checked.setter
+        def checked(self, value):
+            self._checked = value
+            if self.index:
+                self.index.update(self)
+
+        @property
+        def outgoing(self):
+            return self._outgoing
+
+        @outgoing.setter
+        def outgoing(self, value):
+            self._outgoing = value
+            if self.index:
+                self.index.update(self)
+
+        @property
+        def failures(self):
+            return self._failures
+
+        @failures.setter
+        def failures(self, value):
+            self._failures = value
+            if self.index:
+                self.index.update(self)
+
+    def __init__(self, source, destination=''):
+        self.source = source
+        self.destination = destination if destination else self.source
+        self.settings = []  # Строки settings.txt после первой, разбитые на слова
+        self.hosts = []
+
+    def add_host(self, hostname, checked=True):
+        self.hosts.append(TableData.Host(hostname, checked))
+        self.hosts.sort(key=lambda x: x.hostname)
+
+
+# Состояния, в которых на хосте есть base или он её уже получает.
+HOLDING_STATES = (Host.State.BASE_SUCCESS, Host.State.BASE_INSTALLING_SOURCE, Host.State.BASE_INSTALLING_DESTINATION)
+# Состояния, в которых хост может раздавать base.
+SOURCE_STATES = (Host.State.BASE_SUCCESS, Host.State.BASE_INSTALLING_SOURCE)
+
+
+# Отмеченные хосты, разложенные по состояниям и сегментам топологии.
+# Все изменения идут под lock (общим с движком), выбор пары и проверка барьеров не зависят от числа хостов.
+# Хост, с которого не удалось flaky копирований (0 - без ограничения), источником больше не выбирается.
+class HostIndex:
+    def __init__(self, hosts, topology, fanout, lock, flaky=0):
+        self.topology = topology
+        self.fanout = fanout
+        self.lock = lock
+        self.flaky = flaky
+        self.by_state = {state: {} for state in Host.State}  # состояние -> {хост: None}, упорядочено
+        self.by_hostname = {}
+        self.queued = {}  # сегмент -> {хост в QUEUED: None}
+        self.sources = {}  # сегмент -> {хост, который может раздавать ещё: None}
+        self.holders = {}  # сегмент -> сколько хостов с base или получающих её
+        self.keys = {}  # хост -> (состояние, сегмент, может раздавать)
+        with self.lock:
+            for host in hosts:
+                if host.index and host.index is not self:
+                    host.index.remove(host)
+                host.index = self
+                self.by_hostname[host.hostname] = host
+                self.update(host)
+
+    def update(self, host):
+        with self.lock:
+            self.remove(host)
+            if not host.checked:
+                return
+            state = host.state
+            segment = self.topology.segment(host.hostname)
+            source = (state in SOURCE_STATES and host.outgoing < self.fanout.limit(host.hostname)
+                      and not (self.flaky and host.failures >= self.flaky))
+            self.keys[host] = (state, segment, source)
+            self.by_state[state][host] = None
+            if state == Host.State.QUEUED:
+                self.queued.setdefault(segment, {})[host] = None
+            if state in HOLDING_STATES:
+                self.holders[segment] = self.holders.get(segment, 0) + 1
+            if source:
+                self.sources.setdefault(segment, {})[host] = None
+
+    def remove(self, host):
+        key = self.keys.pop(host, None)
+        if not key:
+            return
+        state, segment, source = key
+        del self.by_state[state][host]
+        if state == Host.State.QUEUED:
+            del self.queued[segment][host]
+            if not self.queued[segment]:
+                del self.queued[segment]
+        if state in HOLDING_STATES:
+            self.holders[segment] -= 1
+        if source:
+            del self.sources[segment][host]
+            if not self.sources[segment]:
+                del self.sources[segment]
+
+    def count(self, *states):
+        return sum(len(self.by_state[state]) for state in states)
+
+    def hosts(self, state):
+        return list(self.by_state[state])
+
+    def queued_host(self, hostname):
+        host = self.by_hostname.get(hostname)
+        return host if host in self.by_state[Host.State.QUEUED] else None
+
+    # Следующая пара (источник, приёмник) или None. Сначала пары внутри сегмента,
+    # затем одна копия в сегмент без base по самой быстрой связи.
+    def next_pair(self):
+        with self.lock:
+            for segment, queued in self.queued.items():
+                sources = self.sources.get(segment)
+                pair = self.match(sources, queued) if sources else None
+                if pair:
+                    return pair
+            best = None
+            for segment, queued in self.queued.items():
+                if self.holders.get(segment, 0):
+                    continue
+                for source_segment, sources in self.sources.items():
+                    capacity = self.topology.capacity(source_segment, segment)
+                    if best is None or capacity > best[0]:
+                        pair = self.match(sources, queued)
+                        if pair:
+                            best = (capacity,) + pair
+            return best[1:] if best else None
+
+    # Пара из источников sources и первого приёмника queued, кроме источников, с которых приёмнику уже
+    # не удалось скопировать. Из подходящих - источник, реже других оказывавшийся медленным.
+    @staticmethod
+    def match(sources, queued):
+        for destination in queued:
+            best = None
+            for source in sources:
+                if source.hostname not in destination.avoid and (best is None or source.slow < best.slow):
+                    best = source
+                    if not best.slow:
+                        break
+            if best:
+                return best, destination
+        return None
+
+    # Запасной источник для приёмника destination, копирование на который идёт с exclude: может раздавать,
+    # не exclude и не из destination.avoid. Сначала свободные, из сегмента приёмника или по самой быстрой связи,
+    # реже оказывавшиеся медленными. None, если такого нет.
+    def spare_source(self, destination, exclude):
+        with self.lock:
+            segment = self.topology.segment(destination.hostname)
+            best = None
+            for source_segment, sources in self.sources.items():
+                capacity = self.topology.capacity(source_segment, segment)
+                for source in sources:
+                    if source is exclude or source is destination or source.hostname in destination.avoid:
+                        continue
+                    key = (source.outgoing, source_segment != segment, -capacity, source.slow)
+                    if best is None or key < best[0]:
+                        best = (key, source)
+            return best[1] if best else None
+
+    # Приёмник для источника вне списка хостов (локальный компьютер) из сегмента segment.
+    def next_destination(self, segment):
+        with self.lock:
+            queued = self.queued.get(segment)
+            if queued:
+                return next(iter(queued))
+            best = None
+            for destination_segment, queued in self.queued.items():
+                if self.holders.get(destination_segment, 0):
+                    continue
+                capacity = self.topology.capacity(segment, destination_segment)
+                if best is None or capacity > best[0]:
+                    best = (capacity, next(iter(queued)))
+            return best[1] if best else None
@@ -2,12 +2,8 @@
 
 import os
 import sys
-import glob
 import time
-import shutil
-import random
 import threading
-import subprocess
 from enum import Enum, auto
 
 #import PyQt5
@@ -20,62 +16,8 @@ from PySide6 import QtWidgets, QtGui, QtCore
 
 import helpers
 from globals import Globals
-
-
-class Host:
-    class State(Enum):
-        DISCOVERED = auto()
-        IDLE = auto()
-        QUEUED = auto()
-        BASE_INSTALLING_SOURCE = auto()
-        BASE_INSTALLING_DESTINATION = auto()
-        BASE_SUCCESS = auto()
-        CONF_NON_NEEDED = auto()
-        CONF_INSTALLING = auto()
-        CONF_SUCCESS = auto()
-        CONF_FAILURE = auto()
-        POST_NON_NEEDED = auto()
-        POST_RUNNING = auto()
-        POST_SUCCESS = auto()
-        POST_FAILURE = auto()
-        SUCCESS = auto()
-        FAILURE = auto()
-
-
-class TableData:
-    class Host:
-        def __init__(self, hostname, checked=True):
-            self.hostname = hostname.lower()
-
-            self.base_timer = None
-            self.conf_counter_overwrite = None
-            self.installation_timer = None
-            self.conf_state = None
-            self.post_state = None
-            self.state = None
-            self.checked = None
-
-            self.reset()
-
-            self.checked = checked
-
-        def reset(self):
-            self.base_timer = -1
-            self.conf_counter_overwrite = 0
-            self.installation_timer = 0
-            self.conf_state = Host.State.IDLE
-            self.post_state = Host.State.IDLE
-            self.state = Host.State.IDLE
-            self.checked = False
-
-    def __init__(self, source, destination=''):
-        self.source = source
-        self.destination = destination if destination else self.source
-        self.hosts = []
-
-    def add_host(self, hostname, checked=True):
-        self.hosts.append(TableData.Host(hostname, checked))
-        self.hosts.sort(key=lambda x: x.hostname)
+from engine import Host, TableData, Engine
+from distribution import Distribution
 
 
 class TableModel(QtCore.QAbstractTableModel):
@@ -157,12 +99,34 @@ class SecondColumnDelegate(QtWidgets.QStyledItemDelegate):
             if host.state == Host.State.BASE_INSTALLING_DESTINATION:
                 text = 'Копирование base...%s' % base_time
                 background_color = '#FFFFCC'
+            elif host.state == Host.State.BASE_WAITING:
+                text = 'Ожидание повтора копирования base (попытка %d)' % host.attempts.get('base', 0)
+                background_color = '#FFFFCC'
             elif host.state == Host.State.BASE_SUCCESS or host.state == Host.State.BASE_INSTALLING_SOURCE:
                 text = 'Установлен base%s' % base_time
+                # В конвейере conf и post идут, пока хост ещё раздаёт base.
+                if host.conf_state == Host.State.CONF_INSTALLING:
+                    text += ', копирование conf...'
+                elif host.conf_state == Host.State.FAILURE or host.post_state == Host.State.FAILURE:
+                    text += ', ОШИБКА conf/post'
+                elif host.post_state == Host.State.POST_RUNNING:
+                    text += ', conf; выполняется post-скрипт...'
+                elif host.post_state == Host.State.POST_SUCCESS:
+                    text += ', conf; выполнен post-скрипт'
+                elif host.conf_state == Host.State.CONF_SUCCESS:
+                    text += ', conf'
+                if host.outgoing > 1:
+                    text += ', раздаёт на %d' % host.outgoing
+                background_color = '#FFFF66'
+            elif host.state == Host.State.CONF_INSTALLING:
+                text = 'Установлен base%s, копирование conf...' % base_time
                 background_color = '#FFFF66'
             elif host.state == Host.State.CONF_SUCCESS:
                 text = 'Установлен base%s, conf' % (base_time)
                 background_color = '#FFFF00'
+            elif host.state == Host.State.POST_RUNNING:
+                text = 'Установлен base%s, conf; выполняется post-скрипт...' % base_time
+                background_color = '#FFFF00'
             elif host.state == Host.State.POST_SUCCESS or host.state == Host.State.SUCCESS:
                 text = 'Установлен base%s, conf; выполнен post-скрипт' % (
                     base_time)
@@ -176,6 +140,9 @@ class SecondColumnDelegate(QtWidgets.QStyledItemDelegate):
             elif host.state == Host.State.QUEUED:
                 text = 'Поставлен в очередь на установку (кликните, чтобы удалить из очереди)'
                 background_color = '#ffffff'
+            elif host.state == Host.State.CHECKING:
+                text = 'Проверка установленной версии...'
+                background_color = '#ffffff'
             else:
                 text = 'Этого режима быть не должно'
                 background_color = '#ffffff'
@@ -209,19 +176,6 @@ class Installer(QtWidgets.QWidget):
         CONF_SELECTED = auto()  # выбрана конфигурация: всё разблокировано
         INSTALLING = auto()  # установка: start>stop, остальное заблокировано
 
-    class Distribution:
-
-        def __init__(self, uri):
-            self.uri = uri  # zip-дистрибутив или base*.txt
-            self.base_txt = ''  # Полный путь к base*.txt
-            self.configurations_dir = ''  # Полный путь к распакованному директории conf
-            self.name = ''  # Имя дистрибутива
-            self.base = ''
-            self.size = 0
-            self.prepare_timer = 0
-            self.installation_timer = 0  # <=0 - процесс не запущен, >0 - процесс идёт
-            self.executables = []
-
     configuration_changed = QtCore.Signal()
     state_changed = QtCore.Signal()
     row_changed = QtCore.Signal(int)
@@ -234,12 +188,10 @@ class Installer(QtWidgets.QWidget):
         self.distribution = None
         self.do_verify = True
         self.stop = False
-        self.pids = set()
         self.configurations = []
         self.table_data_dict = {}
         self.prepare_message = ''
         self.prepare_process_download = None
-        self.copy_conf_in_progress = False
         self.configurations_list.setModel(
             QtCore.QStringListModel(self.configurations))
         self.installation_path.setText('')
@@ -249,19 +201,23 @@ class Installer(QtWidgets.QWidget):
 
         self.version = open('version.txt').read().rstrip(
         ) if os.path.exists('version.txt') else 'DEV'
-        self.hostname = subprocess.check_output(
-            'hostname').decode(errors='ignore').strip().lower()
+
+        self.engine = Engine()
+        self.engine.on_hosts_changed = self.table_changed.emit
+        self.engine.on_started = self.on_engine_started
+        self.engine.on_finished = self.on_engine_finished
+        self.engine.on_tick = self.window_title_changed.emit
 
         self.post_install_scripts_dict = None
         self.distribution = None
         self.do_verify = None
+        self.pipeline = Globals.pipeline
+        self.wipe = Globals.wipe
         self.stop = None
-        self.pids = None
         self.configurations = None
         self.table_data_dict = None
         self.prepare_message = None
         self.prepare_process_download = None
-        self.copy_conf_in_progress = None
 
         self.configurations_list = QtWidgets.QListView()
         self.installation_path = QtWidgets.QLineEdit()
@@ -287,6 +243,13 @@ class Installer(QtWidgets.QWidget):
         self.button_conf = QtWidgets.QPushButton("conf")
         # С пробелам по краям чтобы в зачёркнутом состоянии было виднее.
         self.button_do_verify = QtWidgets.QPushButton(" md5 ")
+        self.button_pipeline = QtWidgets.QPushButton(" конвейер ")
+        if not self.pipeline:
+            self.button_pipeline.setStyleSheet("text-decoration: line-through;")
+        # Очистка каталога установки перед копированием base, без неё копируются только изменения.
+        self.button_wipe = QtWidgets.QPushButton(" очистка ")
+        if not self.wipe:
+            self.button_wipe.setStyleSheet("text-decoration: line-through;")
 
         gl = QtWidgets.QGridLayout(self)
 
@@ -299,12 +262,14 @@ class Installer(QtWidgets.QWidget):
         gl.addWidget(self.button_base, 0, 2, 1, 1)  #
         gl.addWidget(self.button_conf, 0, 3, 1, 1)  #
         gl.addWidget(self.button_do_verify, 0, 4, 1, 1)  #
+        gl.addWidget(self.button_pipeline, 0, 5, 1, 1)  #
+        gl.addWidget(self.button_wipe, 0, 6, 1, 1)  #
 
-        gl.addWidget(self.installation_path, 1, 0, 1, 5)  #
+        gl.addWidget(self.installation_path, 1, 0, 1, 7)  #
         gl.addWidget(self.configurations_list, 2, 0,
-                     1, 5)  # Элементы друг над другом
+                     1, 7)  # Элементы друг над другом
 
-        gl.addWidget(self.table, 0, 6, -1, 1)  # Контейнер: консоль или лог
+        gl.addWidget(self.table, 0, 8, -1, 1)  # Контейнер: консоль или лог
 
         self.setLayout(gl)
 
@@ -317,6 +282,8 @@ class Installer(QtWidgets.QWidget):
         self.button_base.clicked.connect(self.on_clicked_button_base)
         self.button_conf.clicked.connect(self.on_clicked_button_conf)
         self.button_do_verify.clicked.connect(self.on_clicked_button_do_verify)
+        self.button_pipeline.clicked.connect(self.on_clicked_button_pipeline)
+        self.button_wipe.clicked.connect(self.on_clicked_button_wipe)
         self.table.clicked.connect(self.on_clicked_table)
         self.state_changed.connect(self.on_state_changed)
         self.table_changed.connect(self.on_table_changed)
@@ -329,17 +296,6 @@ class Installer(QtWidgets.QWidget):
         self.state_changed.emit()
         self.window_title_changed.emit()
 
-        def installation_timer():
-            while True:
-                if self.state == Installer.State.INSTALLING:
-                    self.distribution.installation_timer += 1
-                    self.window_title_changed.emit()
-                time.sleep(1)
-                if not threading.main_thread().is_alive():
-                    sys.exit()
-
-        threading.Thread(target=installation_timer).start()
-
     def on_table_changed(self):
         self.table.model().updateTable()
 
@@ -353,6 +309,8 @@ class Installer(QtWidgets.QWidget):
             self.button_base.setEnabled(False)
             self.button_conf.setEnabled(False)
             self.button_do_verify.setEnabled(False)
+            self.button_pipeline.setEnabled(False)
+            self.button_wipe.setEnabled(False)
             self.table.setEnabled(False)
 
         elif self.state == Installer.State.PREPARING:
@@ -364,6 +322,8 @@ class Installer(QtWidgets.QWidget):
             self.button_base.setEnabled(False)
             self.button_conf.setEnabled(False)
             self.button_do_verify.setEnabled(False)
+            self.button_pipeline.setEnabled(False)
+            self.button_wipe.setEnabled(False)
             self.table.setEnabled(False)
 
         # Распакован архив
@@ -374,6 +334,8 @@ class Installer(QtWidgets.QWidget):
             self.button_base.setEnabled(True)
             self.button_conf.setEnabled(True)
             self.button_do_verify.setEnabled(True)
+            self.button_pipeline.setEnabled(True)
+            self.button_wipe.setEnabled(True)
             self.configurations_list.setEnabled(True)
             self.installation_path.setEnabled(True)
 
@@ -395,6 +357,8 @@ class Installer(QtWidgets.QWidget):
             self.button_base.setEnabled(False)
             self.button_conf.setEnabled(False)
             self.button_do_verify.setEnabled(False)
+            self.button_pipeline.setEnabled(False)
+            self.button_wipe.setEnabled(False)
             self.configurations_list.setEnabled(False)
             self.installation_path.setEnabled(False)
             self.button_start.setText('Стоп')
@@ -411,9 +375,7 @@ class Installer(QtWidgets.QWidget):
         if column == 0:
             host.checked = not host.checked
         elif column == 1:
-            if host.state == Host.State.IDLE or host.state == Host.State.SUCCESS or host.state == Host.State.FAILURE:
-                helpers.Logger.i('Запуск %s' % host.hostname)
-                host.state = Host.State.QUEUED
+            if self.engine.queue(host):
                 self.worker_needed.emit()
             elif host.state == Host.State.QUEUED:
                 host.state = Host.State.IDLE
@@ -472,7 +434,6 @@ class Installer(QtWidgets.QWidget):
                              args=(file,)).start()
         else:
             threading.Thread(target=self.prepare_distribution_stop).start()
-            self.reset()
 
     def on_clicked_button_start(self):
         if not self.state == Installer.State.INSTALLING:
@@ -490,16 +451,7 @@ class Installer(QtWidgets.QWidget):
         threading.Thread(target=self.do_stop_end).start()
 
     def do_stop_end(self):
-        cmd = r'taskkill /t /f'
-        for pid in self.pids:
-            cmd += r' /pid ' + str(pid)
-        self.pids.clear()
-        if cmd != r'taskkill /t /f':
-            subprocess.run(cmd, shell=True)
-
-        for host in self.table.model().dat.hosts:
-            host.state = Host.State.IDLE
-        self.table_changed.emit()
+        self.engine.do_stop()
 
         self.state = Installer.State.PREPARED
         self.state_changed.emit()
@@ -511,12 +463,32 @@ class Installer(QtWidgets.QWidget):
         self.installation_path.setEnabled(True)
 
     def do_start_spider(self):
-        for host in [host for host in self.table.model().dat.hosts if host.checked]:
-            if (host.state == Host.State.IDLE
-                    or host.state == Host.State.FAILURE
-                    or host.state == Host.State.SUCCESS):
-                host.state = Host.State.QUEUED
-        self.worker_needed.emit()
+        self.apply_to_engine()
+        self.engine.start()
+
+    # Передача в движок того, что выбрано в интерфейсе.
+    def apply_to_engine(self):
+        self.engine.distribution = self.distribution
+        self.engine.configuration = self.configurations[self.configurations_list.currentIndex().row()]
+        self.engine.installation_path = self.installation_path.text()
+        self.engine.hosts = self.table.model().dat.hosts
+        self.engine.do_verify = self.do_verify
+        self.engine.pipeline = self.pipeline
+        self.engine.wipe = self.wipe
+
+    def worker(self):
+        if not self.engine.running:
+            self.apply_to_engine()
+        self.engine.run()
+
+    def on_engine_started(self):
+        self.distribution.installation_timer = 0
+        self.state = Installer.State.INSTALLING
+        self.state_changed.emit()
+
+    def on_engine_finished(self):
+        self.state = Installer.State.PREPARED
+        self.state_changed.emit()
 
     def on_clicked_button_base(self):
         helpers.open_folder(self.distribution.base)
@@ -534,316 +506,30 @@ class Installer(QtWidgets.QWidget):
             self.button_do_verify.setStyleSheet("")
             self.do_verify = True
 
+    def on_clicked_button_pipeline(self):
+        if self.pipeline:
+            self.button_pipeline.setStyleSheet(
+                "text-decoration: line-through;")
+            self.pipeline = False
+        else:
+            self.button_pipeline.setStyleSheet("")
+            self.pipeline = True
+
+    def on_clicked_button_wipe(self):
+        if self.wipe:
+            self.button_wipe.setStyleSheet(
+                "text-decoration: line-through;")
+            self.wipe = False
+        else:
+            self.button_wipe.setStyleSheet("")
+            self.wipe = True
+
     @staticmethod
     def on_clicked_button_about(self):
         page = os.path.join(os.path.dirname(
             os.path.realpath(__file__)), 'about', 'about.html')
         os.system('start ' + page)
 
-    def remove_pid(self, pid):
-        try:
-            self.pids.remove(pid)
-        except:
-            pass
-
-    def do_copy_base(self, source_host, destination_host):
-        def timer():
-            while destination_host.state == Host.State.BASE_INSTALLING_DESTINATION:
-                if not threading.main_thread().is_alive():
-                    return
-                self.table_changed.emit()
-                time.sleep(1)
-                destination_host.base_timer += 1
-
-        destination_host.base_timer = 0
-        threading.Thread(target=timer).start()
-
-        # Останов процессов, запущенных из места установки.
-        if sys.platform == 'win32':
-            if self.hostname != destination_host.hostname:
-                auth = ' /node:"%s" /user:"%s" /password:"%s"' \
-                       % (destination_host.hostname, Globals.samba_login, Globals.samba_password)
-            else:
-                auth = ''
-            cmd = r'wmic%s process list full' % auth
-            helpers.Logger.i(cmd)
-            r = subprocess.run(
-                cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            processes = []
-            for line in list(filter(None, [line.strip() for line in r.stdout.decode(errors='ignore').splitlines()])):
-                if line.startswith('ExecutablePath='):
-                    processes.append([line.split('=')[1], None])
-                if line.startswith('Handle=') and not processes[-1][1]:
-                    processes[-1][1] = line.split('=')[1]
-            for process in processes:
-                path = process[0].lower()
-                if path.startswith(self.installation_path.text().lower()):
-                    pid = process[1]
-                    if self.hostname != destination_host.hostname:
-                        auth = ' /s %s /u %s /p %s' \
-                               % (destination_host.hostname, Globals.samba_login, Globals.samba_password)
-                    else:
-                        auth = ''
-                    cmd = 'taskkill%s /t /f /pid %s' % (auth, pid)
-                    helpers.Logger.i(cmd)
-                    subprocess.run(cmd, shell=True)
-        else:
-            pass  # TODO Сделать останов процессов из места установки для Linux!
-
-        # Удаление существующего каталога установки, если необходимо.
-        if sys.platform == 'win32':
-            if self.hostname != destination_host.hostname:
-                auth = r'PsExec64.exe -accepteula -nobanner \\%s -u %s -p %s -c -f ' \
-                       % (destination_host.hostname, Globals.samba_login, Globals.samba_password)
-            else:
-                auth = ''
-            cmd = r'%smake-empty.exe "%s"' % (auth,
-                                              self.installation_path.text())
-            helpers.Logger.i(cmd)
-            r = subprocess.Popen(cmd, shell=True)
-            self.pids.add(r.pid)
-            r.wait()
-            if self.stop:
-                return
-            self.remove_pid(r.pid)
-            if r.returncode != 0:
-                helpers.Logger.e(
-                    'На %s не удалось удалить %s' % (destination_host.hostname, self.installation_path.text()))
-                if source_host:
-                    source_host.state = Host.State.BASE_SUCCESS
-                destination_host.state = Host.State.FAILURE
-                self.worker_needed.emit()
-                return
-        else:
-            cmd = 'ssh root@%s "rm -rf \"%s\" ; mkdir -p \"%s\""' \
-                  % (destination_host.hostname, self.installation_path.text(), self.installation_path.text())
-            subprocess.run(cmd, shell=True)
-
-        # Шаг 2: Копирование base.
-        source_hostname = source_host.hostname if source_host else None
-        source_path = self.installation_path.text(
-        ) if source_host else self.distribution.base
-
-        if source_hostname:  # Копирование с удалённого хоста на удалённый.
-            r = helpers.sync_remote_to_remote(source_hostname, source_path, destination_host.hostname, source_path,
-                                              Globals.samba_login, Globals.samba_password)
-        else:  # Копирование с локального хоста на удалённый.
-            r = helpers.copy_from_local_to_remote(source_path, destination_host.hostname,
-                                                  self.installation_path.text().strip(), True)
-
-        self.pids.add(r.pid)
-        r.wait()
-        self.remove_pid(r.pid)
-
-        if r.returncode != 0:
-            if source_host:
-                source_host.state = Host.State.BASE_SUCCESS
-            destination_host.state = Host.State.FAILURE
-            self.worker_needed.emit()
-            return
-
-        # Шаг 3: проверка md5 по base.txt.
-        result = Host.State.BASE_SUCCESS
-        if self.do_verify:
-            if sys.platform == 'win32':
-                if self.hostname != destination_host.hostname:
-                    cmd = (r'PsExec64.exe -accepteula -nobanner \\%s -u %s -p %s -w %s -c -f verify-md5.exe %s'
-                           % (destination_host.hostname, Globals.samba_login, Globals.samba_password,
-                              self.installation_path.text(), os.path.basename(self.distribution.base_txt)))
-                else:
-                    cmd = (r'cd /d %s & %s'
-                           % (self.installation_path.text(),
-                              os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                           'verify-md5.exe %s' % os.path.basename(self.distribution.base_txt))))
-                helpers.Logger.i(cmd)
-                r = subprocess.run(
-                    cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-            else:
-                cmd = 'scp %s root@%s:%s' \
-                      % (os.path.join(os.path.dirname(os.path.realpath(__file__)), 'verify-md5'),
-                         destination_host.hostname, self.installation_path.text())
-                helpers.Logger.i(cmd)
-                subprocess.run(cmd, shell=True)
-                cmd = 'ssh root@%s "cd \"%s\";chmod +x verify-md5;./verify-md5 %s"' % (
-                    destination_host.hostname, self.installation_path.text(), os.path.basename(self.distribution.base_txt))
-                helpers.Logger.i(cmd)
-                r = subprocess.run(
-                    cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-                os.system('ssh root@%s rm "%s/verify-md5"' %
-                          (destination_host.hostname, self.installation_path.text()))
-            returncode = r.returncode
-            stdout = r.stdout.decode(errors='ignore')
-            files_with_mismatched_md5 = list(
-                filter(None, [file.strip() for file in (stdout.split('\n'))]))
-            if returncode:
-                result = Host.State.FAILURE
-                if files_with_mismatched_md5:
-                    for file in files_with_mismatched_md5:
-                        helpers.Logger.e('%s: ошибка md5: %s' %
-                                         (destination_host.hostname, file))
-        destination_host.state = result
-        if source_host:
-            source_host.state = Host.State.BASE_SUCCESS
-        self.worker_needed.emit()
-
-    def do_copy_conf(self):
-        hosts = []  # Заполним хостами, на которые надо будет установить conf
-        for host in [host for host in self.table.model().dat.hosts if host.checked]:
-            if host.state == Host.State.BASE_SUCCESS:
-                hosts.append(host)
-        conf_name = self.configurations[self.configurations_list.currentIndex(
-        ).row()]
-        common_path = os.path.join(
-            self.distribution.configurations_dir, conf_name, 'common')
-        for host in hosts:
-            self.table_changed.emit()
-            hostname = host.hostname
-
-            # Подкаталог конфигураций common не обязателен!
-
-            if os.path.isdir(common_path):
-                r = helpers.copy_from_local_to_remote(common_path, hostname,
-                                                      self.installation_path.text().strip(), False)
-                r.wait()
-                if r.returncode != 0:
-                    host.state = Host.State.FAILURE
-                    continue
-
-            personal_path = os.path.join(
-                self.distribution.configurations_dir, conf_name, hostname)
-            r = helpers.copy_from_local_to_remote(personal_path, hostname,
-                                                  self.installation_path.text().strip(), False)
-            r.wait()
-            if r.returncode != 0:
-                host.state = Host.State.FAILURE
-                continue
-            host.state = host.conf_state = Host.State.CONF_SUCCESS
-        self.worker_needed.emit()
-
-    def do_run_post_script(self):
-        etc = os.path.join(self.installation_path.text(), 'etc')
-        s = os.path.join(etc, 'post-install')
-        if sys.platform == 'win32':
-            s += '.bat'
-        else:
-            s += '.sh'
-        for host in [host for host in self.table.model().dat.hosts if host.checked]:
-            if host.state == Host.State.CONF_SUCCESS:
-                if sys.platform == 'win32':
-                    cmd = r'PsExec64.exe \\' + host.hostname + ' -u ' + Globals.samba_login + ' -p ' \
-                          + Globals.samba_password + ' ' + s
-                else:
-                    cmd = 'ssh root@%s "chmod +x \"%s/*.sh\"; \"%s\""' % (
-                        host.hostname, etc, s)
-                r = subprocess.run(cmd, shell=True)
-                if r.returncode:
-                    host.state = host.post_state = Host.State.FAILURE
-                    helpers.Logger.i(
-                        'Ошибка выполнения post-скрипта: command=%s returncode=%d' % (cmd, r.returncode))
-                else:
-                    host.state = host.post_state = Host.State.POST_SUCCESS
-                self.table_changed.emit()
-        self.worker_needed.emit()
-
-    def worker(self):
-        if not self.state == Installer.State.INSTALLING:
-            self.distribution.installation_timer = 0
-            self.state = Installer.State.INSTALLING
-            self.state_changed.emit()
-
-        # Копирование base
-        have_source_host = False
-        any_base_copy_started = False
-        for source_host in [host for host in self.table.model().dat.hosts if host.checked]:
-            if source_host.state == Host.State.BASE_SUCCESS:
-                have_source_host = True
-                possible_destination_hosts = []
-                for destination_host in [host for host in self.table.model().dat.hosts if host.checked]:
-                    if destination_host.state == Host.State.QUEUED:
-                        possible_destination_hosts.append(destination_host)
-                if possible_destination_hosts:
-                    destination_host = random.choice(
-                        possible_destination_hosts)
-                    source_host.state = Host.State.BASE_INSTALLING_SOURCE
-                    destination_host.state = Host.State.BASE_INSTALLING_DESTINATION
-                    helpers.Logger.i('Копирование base: %s -> %s' % (source_host.hostname,
-                                                                     destination_host.hostname))
-                    threading.Thread(target=self.do_copy_base, args=(
-                        source_host, destination_host)).start()
-                    any_base_copy_started = True
-        if not have_source_host:  # Нет source-хоста но возможно уже запущенно какое-то копирование
-            for host in [host for host in self.table.model().dat.hosts if host.checked]:
-                if host.state == Host.State.BASE_INSTALLING_DESTINATION:
-                    have_source_host = True
-                    break
-        if not have_source_host:
-            first_host = None
-            for destination_host in [host for host in self.table.model().dat.hosts if host.checked]:
-                if destination_host.hostname == self.hostname and destination_host.state == destination_host.state.QUEUED:
-                    first_host = destination_host  # Начинаем с локального компьютера, если возможно
-                    break
-            if not first_host:
-                for destination_host in [host for host in self.table.model().dat.hosts if host.checked]:
-                    if destination_host.state == destination_host.state.QUEUED:
-                        first_host = destination_host
-                        break
-            if first_host:
-                first_host.state = Host.State.BASE_INSTALLING_DESTINATION
-                helpers.Logger.i(
-                    'Копирование base: localhost -> %s' % first_host.hostname)
-                first_host.base_timer = -1
-                threading.Thread(target=self.do_copy_base,
-                                 args=(None, first_host)).start()
-                any_base_copy_started = True
-        if any_base_copy_started:
-            return
-
-        # Если хотя бы один QUEUED, то значит ещё не везде ещё скопирован base - выходим.
-        for host in [host for host in self.table.model().dat.hosts if host.checked]:
-            if (host.state == Host.State.QUEUED or host.state == Host.State.BASE_INSTALLING_SOURCE
-                    or host.state == Host.State.BASE_INSTALLING_DESTINATION):
-                return
-
-        # Если нет ни одного QUEUED, значит все так или иначе прошли копирование base - поэтому ищем BASE_SUCCESS
-        # и ставим копирование conf.
-        for host in [host for host in self.table.model().dat.hosts if host.checked]:
-            if host.state == Host.State.BASE_SUCCESS:
-                threading.Thread(target=self.do_copy_conf).start()
-                return
-
-        # Выполнение post-скриптов
-        s = os.path.join(self.distribution.configurations_dir,
-                         self.configurations[self.configurations_list.currentIndex(
-                         ).row()],
-                         'common', 'etc', 'post-install')
-        if sys.platform == 'win32':
-            s += '.bat'
-        else:
-            s += '.sh'
-        is_prepare_script_used = False
-        if os.path.exists(s):
-            is_prepare_script_used = True
-            for host in [host for host in self.table.model().dat.hosts if host.checked]:
-                if host.state == Host.State.CONF_SUCCESS:
-                    threading.Thread(target=self.do_run_post_script).start()
-                    return
-        success_state = Host.State.BASE_SUCCESS
-        if is_prepare_script_used:
-            success_state = Host.State.POST_SUCCESS
-        else:
-            success_state = Host.State.CONF_SUCCESS
-
-        for host in [host for host in self.table.model().dat.hosts if host.checked]:
-            if host.state != Host.State.FAILURE and host.state != Host.State.SUCCESS and host.state != Host.State.IDLE:
-                if host.state == success_state:
-                    host.state = Host.State.SUCCESS
-                    self.table_changed.emit()
-                else:
-                    return
-
-        self.state = Installer.State.PREPARED
-        self.state_changed.emit()
-
     def prepare_distribution(self, uri):
         def timer():
             while self.state == Installer.State.PREPARING:
@@ -861,76 +547,23 @@ class Installer(QtWidgets.QWidget):
         helpers.Logger.reset()
         helpers.Logger.i('Открываем %s' % uri)
 
-        self.distribution = Installer.Distribution(uri)
+        self.distribution = Distribution(uri)
 
         self.configurations.clear()
         self.table_data_dict.clear()
         self.post_install_scripts_dict.clear()
         self.state_changed.emit()
 
-        if os.path.basename(uri).startswith('base') and os.path.basename(uri).endswith('.txt'):
-            base_txt = uri
-        else:
-            unpack_to = self.unpack_distribution(uri)
-            g = glob.glob(os.path.join(unpack_to, 'base', 'base*.txt'))
-            if len(g) != 1:  # файл вида base*.txt в корне распакованного дистрибутива должен быть только один!
-                self.state = Installer.State.DEFAULT
-                helpers.Logger.e('После распаковки не найден base*.txt')
-                self.state_changed.emit()
-                return
-            base_txt = g[0]
-
-        conf = os.path.join(os.path.dirname(base_txt), '..', 'conf')
-        if os.path.isdir(conf):
-            for name in os.listdir(conf):
-                destination = ''
-                settings_txt = os.path.join(conf, name, 'settings.txt')
-                if os.path.isfile(settings_txt):
-                    destination = open(
-                        settings_txt).readline().strip().split()[1]
-                table_data = TableData(os.path.dirname(base_txt), destination)
-                for hostname in os.listdir(os.path.join(conf, name)):
-                    if (hostname == 'common' or
-                            not os.path.isdir(os.path.join(conf, name, hostname))):
-                        continue
-                    table_data.add_host(hostname)
-                self.configurations.append(name)
-                self.table_data_dict[name] = table_data
-
-        self.configurations.sort()
-
-        configurations_dir = os.path.abspath(
-            os.path.join(os.path.dirname(base_txt), '..', 'conf'))
-        if os.path.isdir(configurations_dir):
-            self.distribution.configurations_dir = configurations_dir
-        for line in open(base_txt, errors='ignore').readlines():
-            if line.startswith('name '):
-                self.distribution.name = line.split(' ')[1].strip()
-                continue
-        if not self.distribution.name:
-            self.distribution.name = os.path.basename(self.distribution.uri)
-        self.distribution.base_txt = base_txt
-        self.distribution.base = os.path.dirname(self.distribution.base_txt)
-
-        # Сканируем дистрибутив и создаём список исполняемых файлов для отстрела перед установкой
-        for root, dirs, files in os.walk(self.distribution.base):
-            for file in files:
-                if file.endswith('.exe'):
-                    self.distribution.executables.append(file)
-
-        def get_path_size():
-            for dirpath, dirnames, filenames in os.walk(self.distribution.base):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    try:
-                        self.distribution.size += os.path.getsize(fp)
-                    except OSError as e:
-                        helpers.Logger.w(e)
-                    self.window_title_changed.emit()
-            self.distribution.size = -self.distribution.size
-            self.window_title_changed.emit()
-
-        threading.Thread(target=get_path_size).start()
+        if not self.distribution.prepare():
+            self.state = Installer.State.DEFAULT
+            self.state_changed.emit()
+            return
+
+        self.configurations.extend(self.distribution.configurations)
+        self.table_data_dict.update(self.distribution.table_data_dict)
+
+        threading.Thread(target=self.distribution.compute_size,
+                         args=(self.window_title_changed.emit,)).start()
 
         # Очищаем все добавленные хосты от какой-либо информации, оставшейся с прошлого раза (если есть)
         for host in self.table.model().dat.hosts:
@@ -941,23 +574,10 @@ class Installer(QtWidgets.QWidget):
 
         return
 
+    # Отмена открытия дистрибутива: распаковка прерывается, prepare_distribution возвращает окно в DEFAULT.
     def prepare_distribution_stop(self):
-        pass
-
-    @staticmethod
-    def unpack_distribution(file):
-        unpack_to = os.path.splitext(file)[0]  # отрезаем .zip
-        if os.path.exists(unpack_to):
-            helpers.Logger.i('Удаление каталога распаковки')
-            shutil.rmtree(unpack_to)
-        helpers.Logger.i('Создание каталога распаковки %s' % unpack_to)
-        os.makedirs(unpack_to)
-        cmd = '7za x "' + file + '" -aoa -o"' + unpack_to + '"'
-        helpers.Logger.i(cmd)
-        r = subprocess.run(cmd, shell=True)
-        if r.returncode != 0:
-            helpers.Logger.w('Сбой при распаковке архива, архив битый?')
-        return unpack_to
+        if self.distribution:
+            self.distribution.stop()
 
     def on_title_changed(self):
         title = QtCore.QCoreApplication.applicationName() + ' ' + self.version
@@ -967,8 +587,10 @@ class Installer(QtWidgets.QWidget):
             return
 
         if not self.distribution.name:  # Имя дистрибутива ещё не доступно - занчит происходит его открытие
-            title += ' • Распаковка: ' + self.distribution.uri + '... ' \
-                     + helpers.seconds_to_human(self.distribution.prepare_timer)
+            title += ' • Распаковка: ' + self.distribution.uri + '... '
+            if self.distribution.unpack_total:
+                title += '%d%% ' % (100 * self.distribution.unpacked // self.distribution.unpack_total)
+            title += helpers.seconds_to_human(self.distribution.prepare_timer)
             self.setWindowTitle(title)
             return
 
@@ -978,7 +600,7 @@ class Installer(QtWidgets.QWidget):
             title += ' распакован за %s' % helpers.seconds_to_human(
                 self.distribution.prepare_timer)
 
-        title += ' ' + helpers.bytes_to_human(abs(self.distribution.size))
+        title += ' %d файлов %s' % (self.distribution.files, helpers.bytes_to_human(abs(self.distribution.size)))
         if self.distribution.size > 0:
             title += '...'
 
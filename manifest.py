@@ -0,0 +1,191 @@
+# encoding: utf-8
+
+# Построение манифеста base*.txt дистрибутива и проверка дистрибутива по нему.
+#   python manifest.py build base [--algorithm md5] [--name NAME] [-j N]
+#   python manifest.py verify base [-j N]
+# Суммы хранятся в индексе рядом с каталогом (.<каталог>.index) по ключу (путь, размер, mtime, inode):
+# считаются только новые и изменившиеся файлы, остальные берутся из индекса.
+
+import os
+import sys
+import glob
+import time
+import pickle
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import agent
+
+
+# Индекс по умолчанию: рядом с каталогом, а не в нём, чтобы не попасть в дистрибутив.
+def index_path(root):
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), '.%s.index' % os.path.basename(root))
+
+
+# Индекс: путь -> (размер, mtime в нс, inode, {алгоритм: сумма}), хранится pickle: загрузка индекса
+# на миллион файлов не должна занимать больше, чем обход каталога. Нечитаемый индекс считается пустым.
+def load_index(path):
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    except Exception:
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def save_index(path, index):
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+# Обычные файлы каталога root: путь относительно root (через /) -> (размер, mtime в нс, inode).
+# Подкаталоги обходятся параллельно: на сетевых и NVMe дисках stat хорошо распараллеливается.
+def scan(root, exclude=(), jobs=0):
+    jobs = jobs if jobs > 0 else min(32, (os.cpu_count() or 1) * 2)
+    files = {}
+
+    def scan_dir(relative):
+        found = []
+        subdirs = []
+        with os.scandir(os.path.join(root, relative)) as entries:
+            for entry in entries:
+                name = relative + '/' + entry.name if relative else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(name)
+                elif entry.is_file(follow_symlinks=False) and name not in exclude:
+                    st = entry.stat(follow_symlinks=False)
+                    found.append((name, (st.st_size, st.st_mtime_ns, entry.inode())))
+        return found, subdirs
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(scan_dir, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, subdirs = future.result()
+                files.update(found)
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan_dir, subdir))
+    return files
+
+
+# Суммы файлов files (результат scan) алгоритмом algorithm: из индекса, если ключ совпал, иначе считаются
+# параллельно и заносятся в индекс. Возвращает (путь -> сумма, сколько файлов посчитано).
+def digests(root, files, algorithm, index, jobs=0):
+    result = {}
+    changed = []
+    for relative, key in files.items():
+        record = index.get(relative)
+        if record and record[:3] == key and algorithm in record[3]:
+            result[relative] = record[3][algorithm]
+        else:
+            changed.append(relative)
+
+    def compute(relative):
+        return relative, agent.hash_file(os.path.join(root, relative), algorithm)
+
+    for relative, digest in agent.parallel(compute, changed, jobs):
+        result[relative] = digest
+        if not digest:  # Не прочитан - в индекс не попадает
+            continue
+        key = files[relative]
+        record = index.get(relative)
+        if not record or record[:3] != key:
+            record = index[relative] = key + ({},)
+        record[3][algorithm] = digest
+    for relative in list(index):
+        if relative not in files:
+            del index[relative]
+    return result, len(changed)
+
+
+# Манифест каталога: единственный base*.txt в нём или новый base.txt.
+def manifest_path(root):
+    g = glob.glob(os.path.join(root, 'base*.txt'))
+    return g[0] if len(g) == 1 else os.path.join(root, 'base.txt')
+
+
+# Построение (обновление) манифеста каталога root. Строка name сохраняется из прежнего манифеста,
+# если не задана. Возвращает (путь к манифесту, сколько файлов посчитано, сколько всего).
+def build(root, algorithm='md5', name='', jobs=0, index_file=''):
+    index_file = index_file or index_path(root)
+    output = manifest_path(root)
+    relative_output = os.path.relpath(output, root).replace(os.sep, '/')
+    if not name and os.path.isfile(output):
+        for line in open(output, errors='ignore'):
+            if line.startswith('name '):
+                name = line.split(' ', 1)[1].strip()
+                break
+    index = load_index(index_file)
+    files = scan(root, (relative_output,), jobs)
+    result, hashed = digests(root, files, algorithm, index, jobs)
+    save_index(index_file, index)
+
+    lines = []
+    if algorithm != 'md5':  # Старые проверяющие понимают только md5, см. agent.py
+        lines.append('manifest %d' % agent.MANIFEST_VERSION)
+    if name:
+        lines.append('name %s' % name)
+    for relative in sorted(result):
+        lines.append('%s %s %s' % (algorithm, result[relative], relative))
+    temporary = output + '.tmp'
+    with open(temporary, 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temporary, output)
+    return output, hashed, len(files)
+
+
+# Проверка каталога root по его манифесту с использованием индекса: перечитываются только файлы,
+# изменившиеся с момента, когда их сумма попала в индекс. Возвращает список несовпавших файлов.
+def verify(root, jobs=0, index_file=''):
+    index_file = index_file or index_path(root)
+    output = manifest_path(root)
+    with open(output, encoding='utf-8', errors='ignore') as f:
+        entries = agent.read_manifest(f)
+    index = load_index(index_file)
+    files = scan(root, (os.path.relpath(output, root).replace(os.sep, '/'),), jobs)
+    mismatched = []
+    for algorithm in set(entry[0] for entry in entries):
+        result, hashed = digests(root, files, algorithm, index, jobs)
+        for entry_algorithm, digest, relative in entries:
+            if entry_algorithm == algorithm and result.get(relative.replace(os.sep, '/')) != digest:
+                mismatched.append(relative)
+    save_index(index_file, index)
+    return mismatched
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Манифест base*.txt дистрибутива.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('build', help='построить или обновить манифест каталога')
+    command.add_argument('root')
+    command.add_argument('--algorithm', default='md5', choices=agent.ALGORITHMS)
+    command.add_argument('--name', default='', help='строка name манифеста (по умолчанию из прежнего)')
+    command.add_argument('--index', default='', help='файл индекса (по умолчанию .<каталог>.index рядом)')
+    command.add_argument('-j', '--jobs', type=int, default=0)
+    command = commands.add_parser('verify', help='проверить каталог по манифесту')
+    command.add_argument('root')
+    command.add_argument('--index', default='')
+    command.add_argument('-j', '--jobs', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    if args.command == 'build':
+        output, hashed, total = build(args.root, args.algorithm, args.name, args.jobs, args.index)
+        print('%s: %d файлов, посчитано %d, %.1fs' % (output, total, hashed, time.time() - started))
+        return 0
+    try:
+        mismatched = verify(args.root, args.jobs, args.index)
+    except (OSError, agent.ManifestError) as e:
+        sys.stderr.write('%s\n' % e)
+        return 2
+    for relative in mismatched:
+        print(relative)
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,117 @@
+# encoding: utf-8
+
+# Выбор пар источник -> приёмник для копирования base.
+#
+# Топология задаётся в settings.txt конфигурации (необязательно):
+#   segment rack1 r1-* 10.0.1.0/24   # сегмент: маски имён хостов и/или подсети
+#   uplink rack1 1000                # пропускная способность выхода сегмента, Мбит/с
+# Хосты, не попавшие ни в один сегмент, образуют общий сегмент без имени.
+# Связи между сегментами считаются медленными: в каждый сегмент идёт одна копия извне,
+# дальше base расходится внутри сегмента.
+#
+# Там же задаётся, скольким приёмникам источник раздаёт base одновременно:
+#   fanout 2                         # для всех хостов (по умолчанию 1)
+#   fanout 4 big-* 10.0.9.0/24       # для хостов по маскам и/или подсетям
+
+import socket
+import fnmatch
+import ipaddress
+
+import helpers
+
+
+def matches(hostname, patterns, networks, resolve):
+    if any(fnmatch.fnmatchcase(hostname, pattern) for pattern in patterns):
+        return True
+    if networks:
+        try:
+            address = ipaddress.ip_address(resolve(hostname))
+        except (OSError, ValueError):
+            return False
+        return any(address in network for network in networks)
+    return False
+
+
+# Строка settings.txt с негодным значением пропускается, как строки с неизвестным словом.
+def skip(words):
+    helpers.Logger.w('settings.txt: строка пропущена, негодное значение: %s' % ' '.join(words))
+
+
+# Разделение масок на маски имён и подсети.
+def parse_patterns(words):
+    patterns = []
+    networks = []
+    for pattern in words:
+        try:
+            networks.append(ipaddress.ip_network(pattern, strict=False))
+        except ValueError:
+            patterns.append(pattern.lower())
+    return patterns, networks
+
+
+class Topology:
+    def __init__(self, settings=(), resolve=socket.gethostbyname):
+        self.segments = []  # [(имя, [маски имён], [подсети])]
+        self.uplinks = {}  # имя сегмента -> Мбит/с
+        self.resolve = resolve
+        self.cache = {}  # hostname -> имя сегмента
+        for words in settings:
+            if words[0] == 'segment' and len(words) > 2:
+                patterns, networks = parse_patterns(words[2:])
+                self.segments.append((words[1], patterns, networks))
+            elif words[0] == 'uplink' and len(words) == 3:
+                try:
+                    speed = float(words[2])
+                except ValueError:
+                    speed = -1
+                if 0 <= speed < float('inf'):
+                    self.uplinks[words[1]] = speed
+                else:
+                    skip(words)
+
+    def segment(self, hostname):
+        if hostname in self.cache:
+            return self.cache[hostname]
+        result = None
+        for name, patterns, networks in self.segments:
+            if matches(hostname, patterns, networks, self.resolve):
+                result = name
+                break
+        self.cache[hostname] = result
+        return result
+
+    # Скорость связи между сегментами: меньшая из скоростей их выходов (0 - неизвестна).
+    def capacity(self, a, b):
+        return min(self.uplinks.get(a, 0), self.uplinks.get(b, 0))
+
+
+class Fanout:
+    # default - значение для всех хостов, если не 0, то перекрывает "fanout k" без масок.
+    def __init__(self, settings=(), default=0, resolve=socket.gethostbyname):
+        self.default = 1
+        self.rules = []  # [(k, [маски имён], [подсети])]
+        self.resolve = resolve
+        self.cache = {}
+        for words in settings:
+            if words[0] == 'fanout' and len(words) > 1:
+                try:
+                    k = max(1, int(words[1]))
+                except ValueError:
+                    skip(words)
+                    continue
+                if len(words) == 2:
+                    self.default = k
+                else:
+                    patterns, networks = parse_patterns(words[2:])
+                    self.rules.append((k, patterns, networks))
+        if default:
+            self.default = max(1, default)
+
+    def limit(self, hostname):
+        if hostname not in self.cache:
+            self.cache[hostname] = self.default
+            for k, patterns, networks in self.rules:
+                if matches(hostname, patterns, networks, self.resolve):
+                    self.cache[hostname] = k
+                    break
+        return self.cache[hostname]
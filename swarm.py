@@ -0,0 +1,198 @@
+# encoding: utf-8
+
+# Рой: base делится на куски - группы файлов подряд по манифесту, и хост получает куски с нескольких хостов,
+# у которых они уже есть, а свои куски раздаёт дальше сразу после их проверки, не дожидаясь всего base.
+# Так работают все исходящие каналы сразу, а не только у хостов, уже получивших base целиком.
+# Кусок определяется содержимым: его номер - md5 строк манифеста его файлов, поэтому у одинаковых
+# дистрибутивов куски одинаковые. Манифест - всегда отдельный первый кусок: приёмник проверяет по нему
+# остальные куски, поэтому получает его раньше них.
+
+import os
+import zlib
+import hashlib
+
+DOWNLOADS = 2  # Сколько кусков хост получает одновременно (с разных источников)
+RETRIES = 3  # Сколько неудачных передач кусков хосту допускается, дальше хост считается неудачным
+
+
+class Chunk:
+    def __init__(self, files, sizes, manifest):
+        self.files = files  # Пути относительно base
+        self.size = sum(sizes.get(f, 0) for f in files)
+        digest = hashlib.md5()
+        for f in files:
+            digest.update(('%s %s\n' % (manifest.get(f) or '- %d' % sizes.get(f, 0), f.replace(os.sep, '/'))).encode())
+        self.id = digest.hexdigest()
+
+
+# Куски base: файлы files по порядку путей, пока кусок не наберёт size байт; первый кусок - манифест first.
+# sizes - путь -> размер, manifest - путь -> "алгоритм сумма" (файлы вне манифеста отличаются размером).
+def split(files, sizes, manifest, size, first):
+    chunks = [Chunk([first], sizes, manifest)]
+    part = []
+    part_size = 0
+    for f in sorted(files):
+        if f == first:
+            continue
+        part.append(f)
+        part_size += sizes.get(f, 0)
+        if part_size >= size:
+            chunks.append(Chunk(part, sizes, manifest))
+            part = []
+            part_size = 0
+    if part:
+        chunks.append(Chunk(part, sizes, manifest))
+    return chunks
+
+
+# Кто какие куски держит и кому какие нужны; выбор следующей передачи. Источник None - локальный компьютер,
+# у него есть все куски. Как и у "паука", связи между сегментами топологии считаются медленными: кусок входит
+# в сегмент один раз и дальше расходится внутри него. Не потокобезопасен: движок вызывает его под своим lock.
+class Tracker:
+    def __init__(self, chunks, limit, topology, local_hostname):
+        self.chunks = chunks
+        self.limit = limit  # hostname -> сколько приёмников у источника одновременно (fanout)
+        self.topology = topology  # scheduler.Topology
+        self.local_hostname = local_hostname
+        self.holders = [{} for chunk in chunks]  # кусок -> {хост с проверенным куском: None}
+        self.copies = [0] * len(chunks)  # кусок -> сколько передач его сейчас идёт
+        self.need = {}  # приёмник -> {кусок: файлы куска, которые нужно скопировать}
+        self.active = {}  # приёмник -> {кусок, который сейчас получает: None}
+        self.uploads = {}  # источник -> сколько передач с него идёт
+        self.incoming = {}  # (кусок, сегмент) -> сколько передач куска идёт в сегмент
+        self.failures = {}  # приёмник -> сколько передач ему не удалось
+        self.avoid = {}  # приёмник -> {источник, передача с которого ему не удалась: None}
+        self.seeded = set()  # Хосты, у которых есть весь base
+        self.transfers = 0
+
+    # Хост со всем base: раздаёт любой кусок.
+    def seed(self, hostname):
+        if hostname in self.seeded or hostname in self.need:
+            return
+        self.seeded.add(hostname)
+        for holders in self.holders:
+            holders[hostname] = None
+
+    # Приёмник files - нужные ему файлы base (None - все). Куски, где ничего не нужно, у него уже есть.
+    def join(self, hostname, files=None):
+        self.seeded.discard(hostname)
+        files = set(files) if files is not None else None
+        need = {}
+        for i, chunk in enumerate(self.chunks):
+            part = chunk.files if files is None else [f for f in chunk.files if f in files]
+            if part:
+                need[i] = part
+                self.holders[i].pop(hostname, None)
+            else:
+                self.holders[i][hostname] = None
+        self.need[hostname] = need
+        self.active[hostname] = {}
+        self.failures[hostname] = 0
+        self.avoid[hostname] = {}
+
+    # Хост выбывает (ошибка): его куски больше не раздаются, передачи ему уже не нужны.
+    def drop(self, hostname):
+        self.seeded.discard(hostname)
+        self.need.pop(hostname, None)
+        self.active.pop(hostname, None)
+        self.avoid.pop(hostname, None)
+        for holders in self.holders:
+            holders.pop(hostname, None)
+
+    # Приёмники, которые получили все куски: больше не отслеживаются как приёмники, но раздают всё.
+    def finished(self):
+        hostnames = [hostname for hostname, need in self.need.items() if not need and not self.active[hostname]]
+        for hostname in hostnames:
+            del self.need[hostname]
+            del self.active[hostname]
+            del self.avoid[hostname]
+            self.seeded.add(hostname)
+        return hostnames
+
+    def free(self, source):
+        return self.uploads.get(source, 0) < self.limit(source or self.local_hostname)
+
+    def usable(self, source, destination):
+        return self.free(source) and source not in self.avoid[destination]
+
+    # Источник куска i для приёмника или False, если сейчас его нет. Если кусок уже есть в сегменте приёмника -
+    # свободный хост оттуда с наименьшим числом передач (или локальный компьютер, если он в том же сегменте).
+    # Иначе, если кусок в сегмент ещё не идёт, - свободный хост или локальный компьютер по самой быстрой связи.
+    def source(self, i, destination):
+        segment = self.topology.segment(destination)
+        local_segment = self.topology.segment(self.local_hostname)
+        inside = False
+        best = None
+        for hostname in self.holders[i]:
+            if hostname == destination:
+                continue
+            same = self.topology.segment(hostname) == segment
+            inside = inside or same
+            if not self.usable(hostname, destination):
+                continue
+            key = (not same, -self.topology.capacity(self.topology.segment(hostname), segment),
+                   self.uploads.get(hostname, 0))
+            if best is None or key < best[0]:
+                best = (key, hostname)
+        if inside:
+            if best and not best[0][0]:
+                return best[1]
+            return None if local_segment == segment and self.usable(None, destination) else False
+        if self.incoming.get((i, segment)):
+            return False
+        if self.usable(None, destination) and (best is None or self.topology.capacity(local_segment, segment) > -best[0][1]):
+            return None
+        return best[1] if best else False
+
+    # Следующая передача (кусок, источник, приёмник, файлы) или None. Сначала самые редкие куски (меньше всего
+    # держателей и идущих передач); при равенстве приёмники начинают с разных кусков, чтобы сразу обмениваться.
+    def next_transfer(self):
+        for destination in sorted(self.need, key=lambda hostname: len(self.active[hostname])):
+            need = self.need[destination]
+            active = self.active[destination]
+            if not need or len(active) >= DOWNLOADS:
+                continue
+            if 0 in active:  # Пока нет манифеста, проверять нечем
+                continue
+            candidates = [0] if 0 in need else [i for i in need if i not in active]
+            offset = zlib.crc32(destination.encode()) % len(self.chunks)
+            best = None
+            for i in candidates:
+                key = (len(self.holders[i]) + self.copies[i], (i - offset) % len(self.chunks))
+                if best is not None and key >= best[0]:
+                    continue
+                source = self.source(i, destination)
+                if source is not False:
+                    best = (key, i, source)
+            if best:
+                key, i, source = best
+                self.start(i, source, destination)
+                return i, source, destination, need[i]
+        return None
+
+    def start(self, i, source, destination):
+        self.copies[i] += 1
+        self.uploads[source] = self.uploads.get(source, 0) + 1
+        key = (i, self.topology.segment(destination))
+        self.incoming[key] = self.incoming.get(key, 0) + 1
+        self.active[destination][i] = None
+        self.transfers += 1
+
+    # Передача закончена. Возвращает True, если приёмник исчерпал попытки и должен быть снят. С источника,
+    # передача с которого не удалась, приёмник больше ничего не получает (кроме локального компьютера).
+    def done(self, i, source, destination, success):
+        self.copies[i] -= 1
+        self.uploads[source] -= 1
+        self.incoming[(i, self.topology.segment(destination))] -= 1
+        self.transfers -= 1
+        if destination not in self.need:  # Приёмник уже снят
+            return False
+        del self.active[destination][i]
+        if success:
+            del self.need[destination][i]
+            self.holders[i][destination] = None
+            return False
+        self.failures[destination] += 1
+        if source is not None:
+            self.avoid[destination][source] = None
+        return self.failures[destination] > RETRIES
@@ -0,0 +1,97 @@
+# encoding: utf-8
+
+# agent.py: приём tar-потока с проверкой при записи и цепочка.
+#   python -m pytest -q tests
+
+import io
+import os
+import sys
+import json
+import tarfile
+import hashlib
+import subprocess
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import agent
+
+AGENT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'agent.py')
+FILES = {'a.bin': b'a' * 1000, 'd/b.bin': b'b' * 100, 'd/c.bin': b'c' * 10}
+
+
+def manifest(files):
+    return ''.join('md5 %s %s\n' % (hashlib.md5(data).hexdigest(), name) for name, data in sorted(files.items()))
+
+
+# tar из (имя, содержимое) по порядку: манифест отправитель передаёт первым.
+def make_tar(members):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w|') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+def test_receive(tmp_path):
+    stream = make_tar([('base.txt', manifest(FILES).encode())] + sorted(FILES.items()))
+    found = []
+    assert agent.receive(str(tmp_path), io.BytesIO(stream), 'base.txt', found=found.append) == 0
+    assert found == []
+    for name, data in FILES.items():
+        assert (tmp_path / name).read_bytes() == data
+
+
+def test_receive_mismatch_and_delete(tmp_path):
+    (tmp_path / 'stale.txt').write_text('stale')
+    (tmp_path / 'd').mkdir()
+    (tmp_path / 'd' / 'c.bin').write_bytes(b'x')  # Не из потока, испорчен: находится только с rest
+    members = [('base.txt', manifest(FILES).encode()), ('a.bin', b'broken'), ('d/b.bin', FILES['d/b.bin'])]
+    found = []
+    mismatched = agent.receive(str(tmp_path), io.BytesIO(make_tar(members)), 'base.txt', rest=True, delete=True,
+                               found=found.append)
+    assert mismatched == 2
+    assert sorted(found) == ['a.bin', 'd/c.bin']
+    # delete оставляет только пришедшее в потоке.
+    assert not (tmp_path / 'stale.txt').exists()
+    assert not (tmp_path / 'd' / 'c.bin').exists()
+    assert (tmp_path / 'd' / 'b.bin').exists()
+
+
+def test_receive_rejects_escape(tmp_path):
+    with pytest.raises(tarfile.TarError):
+        agent.receive(str(tmp_path / 'root'), io.BytesIO(make_tar([('../x', b'x')])), 'base.txt')
+    assert not (tmp_path / 'x').exists()
+
+
+def test_receive_command(tmp_path):
+    files = dict(FILES, **{'a.bin': b'changed'})
+    stream = make_tar([('base.txt', manifest(FILES).encode())] + sorted(files.items()))
+    r = subprocess.run([sys.executable, AGENT, 'receive', 'base.txt'], cwd=str(tmp_path), input=stream,
+                       stdout=subprocess.PIPE)
+    assert r.returncode == 1
+    assert r.stdout.decode().split() == ['a.bin']
+
+
+# Три звена и одно незапускающееся между ними: tar доходит до всех запустившихся, каждое сообщает результат.
+def test_chain(tmp_path):
+    command = [sys.executable, AGENT, 'chain']
+    hops = [{'host': 'h1', 'path': str(tmp_path / 'h1')},
+            {'host': 'h2', 'path': str(tmp_path / 'h2'), 'command': command},
+            {'host': 'broken', 'path': str(tmp_path / 'broken'), 'command': [sys.executable, '-c', 'pass']},
+            {'host': 'h3', 'path': str(tmp_path / 'h3'), 'command': command}]
+    files = dict(FILES, **{'a.bin': b'changed'})
+    header = json.dumps({'hops': hops, 'manifest': 'base.txt'}) + '\n'
+    stream = header.encode() + make_tar([('base.txt', manifest(FILES).encode())] + sorted(files.items()))
+    r = subprocess.run(command, input=stream, stdout=subprocess.PIPE, timeout=120)
+    messages = [json.loads(line) for line in r.stdout.decode().splitlines()]
+    results = dict((message['host'], message['rc']) for message in messages if 'rc' in message)
+    assert results == {'h1': 1, 'h2': 1, 'h3': 1, 'broken': 255}
+    assert sorted(message['host'] for message in messages if message.get('found') == 'a.bin') == ['h1', 'h2', 'h3']
+    for host in ('h1', 'h2', 'h3'):
+        for name, data in files.items():
+            assert (tmp_path / host / name).read_bytes() == data
+    assert not (tmp_path / 'broken').exists()
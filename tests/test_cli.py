@@ -0,0 +1,25 @@
+# encoding: utf-8
+
+# Разбор аргументов cli.py.
+#   python -m pytest -q tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import cli
+from engine import batch_size
+
+
+@pytest.mark.parametrize('value', ['abc', '10 %', '0', '-1', '0%', '150%', 'inf%', 'nan%'])
+def test_post_batch_rejected(value):
+    with pytest.raises(SystemExit):
+        cli.parse_args(['d.zip', 'c', '--post-batch', value])
+
+
+def test_post_batch():
+    assert cli.parse_args(['d.zip', 'c', '--post-batch', '10%']).post_batch == '10%'
+    assert [batch_size(spec, 25) for spec in ('10%', '100%', '3', '')] == [3, 25, 3, 25]
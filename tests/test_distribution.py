@@ -0,0 +1,242 @@
+# encoding: utf-8
+
+# Распаковка zip-дистрибутива.
+#   python -m pytest -q tests
+
+import os
+import sys
+import io
+import stat
+import time
+import tarfile
+import zipfile
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import helpers
+import distribution
+from globals import Globals
+
+
+def test_unzip_links(tmp_path):
+    archive = str(tmp_path / 'd.zip')
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('lib/real/x.so', 'x')
+        for name, target in (('lib/current', 'real'), ('lib/x.so', 'real/x.so')):
+            info = zipfile.ZipInfo(name)
+            info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            z.writestr(info, target)
+    distribution.unzip(archive, str(tmp_path / 'd'), lambda done, total: None, lambda: False)
+    assert os.readlink(tmp_path / 'd' / 'lib' / 'current') == 'real'
+    assert os.readlink(tmp_path / 'd' / 'lib' / 'x.so') == 'real/x.so'
+    assert (tmp_path / 'd' / 'lib' / 'current' / 'x.so').read_text() == 'x'
+
+
+def test_unpack_leftovers(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    archive = str(tmp_path / 'd.zip')
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('base/base.txt', 'name d\n')
+    finished = subprocess.Popen([sys.executable, '-c', 'pass'])
+    finished.wait()
+    unpack_to = str(tmp_path / 'd')
+    # Временный каталог идущей распаковки другого экземпляра (здесь - этого процесса) остаётся,
+    # завершившегося процесса и прежний каталог удаляются.
+    running = '%s.installer-tmp-%d-1' % (unpack_to, os.getpid())
+    leftovers = ['%s.installer-tmp-%d-1' % (unpack_to, finished.pid), unpack_to + '.installer-old-1']
+    for path in [running] + leftovers:
+        os.makedirs(path)
+    assert distribution.unpack_distribution(archive) == unpack_to
+    deadline = time.time() + 10
+    while any(os.path.exists(path) for path in leftovers) and time.time() < deadline:
+        time.sleep(0.05)
+    assert [path for path in leftovers if os.path.exists(path)] == []
+    assert os.path.isdir(running)
+    assert os.path.isfile(os.path.join(unpack_to, 'base', 'base.txt'))
+
+
+def zip_distribution(archive, files=4, size=3 * distribution.UNPACK_CHUNK):
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('base/base.txt', 'name d\n')
+        for i in range(files):
+            z.writestr('base/d/f%d.bin' % i, os.urandom(size))
+        z.writestr('conf/c/settings.txt', 'destination /opt/d\n')
+
+
+def wait_removed(paths):
+    deadline = time.time() + 10
+    while any(os.path.exists(path) for path in paths) and time.time() < deadline:
+        time.sleep(0.05)
+    return [path for path in paths if os.path.exists(path)]
+
+
+def test_unpack_progress(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    archive = str(tmp_path / 'd.zip')
+    zip_distribution(archive)
+    reports = []
+    unpack_to = distribution.unpack_distribution(archive, lambda done, total: reports.append((done, total)))
+    assert unpack_to == str(tmp_path / 'd')
+    total = 4 * 3 * distribution.UNPACK_CHUNK + len('name d\n') + len('destination /opt/d\n')
+    assert reports[0] == (0, total) and reports[-1] == (total, total)
+    assert [done for done, _ in reports] == sorted(done for done, _ in reports)
+    with zipfile.ZipFile(archive) as z:
+        for member in z.infolist():
+            assert open(os.path.join(unpack_to, member.filename), 'rb').read() == z.read(member)
+    # Повторная распаковка заменяет прежний каталог, прежний удаляется.
+    (tmp_path / 'd' / 'junk').write_text('junk')
+    assert distribution.unpack_distribution(archive) == unpack_to
+    assert not os.path.exists(tmp_path / 'd' / 'junk')
+    assert wait_removed([str(path) for path in tmp_path.glob('d.installer-*')]) == []
+
+
+def test_unpack_cancel(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    archive = str(tmp_path / 'd.zip')
+    zip_distribution(archive)
+    reports = []
+
+    # Отмена после первого мегабайта.
+    def progress(done, total):
+        reports.append(done)
+    assert distribution.unpack_distribution(archive, progress, lambda: reports[-1] > 0) == ''
+    assert not os.path.exists(tmp_path / 'd')
+    assert wait_removed([str(path) for path in tmp_path.glob('d.installer-*')]) == []
+
+
+def test_unpack_broken(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    archive = str(tmp_path / 'd.zip')
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('base/base.txt', 'name d\n')
+        z.writestr('../escape.txt', 'x')
+    assert distribution.unpack_distribution(archive) == ''
+    assert not os.path.exists(tmp_path / 'escape.txt')
+    assert not os.path.exists(tmp_path / 'd')
+    # Испорченное содержимое: не сходится CRC.
+    zip_distribution(archive)
+    with open(archive, 'r+b') as f:
+        f.seek(os.path.getsize(archive) // 2)
+        f.write(b'broken')
+    assert distribution.unpack_distribution(archive) == ''
+    assert wait_removed([str(path) for path in tmp_path.glob('d.installer-*')]) == []
+
+
+def test_cache_reuse(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    monkeypatch.setattr(Globals, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(Globals, 'cache_budget', 1 << 40)
+    unpacks = []
+    unpack = distribution.unpack_distribution
+
+    def counted(*args):
+        unpacks.append(args[0])
+        return unpack(*args)
+    monkeypatch.setattr(distribution, 'unpack_distribution', counted)
+    archive = str(tmp_path / 'd.zip')
+    zip_distribution(archive, size=10)
+    unpack_to, streamed = distribution.cached_distribution(archive)
+    assert os.path.dirname(unpack_to) == str(tmp_path / 'cache') and not streamed
+    assert os.path.isfile(os.path.join(unpack_to, 'base', 'base.txt'))
+    assert distribution.cached_distribution(archive) == (unpack_to, False)
+    assert len(unpacks) == 1
+    # Пересобранный архив с тем же именем распаковывается заново, в свой каталог.
+    zip_distribution(archive, size=20)
+    os.utime(archive, ns=(0, os.stat(archive).st_mtime_ns + 1))
+    assert distribution.cached_distribution(archive)[0] != unpack_to
+    assert len(unpacks) == 2
+
+
+def test_cache_evict(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    cache = tmp_path / 'cache'
+    # Каталоги по 1000 байт, a использовался давнее всех, c - последним.
+    for age, name in enumerate(['c', 'b', 'a']):
+        os.makedirs(cache / name)
+        (cache / name / 'f').write_bytes(b'x' * 1000)
+        os.utime(cache / name, (time.time() - 100 * (age + 1),) * 2)
+    (cache / 'a.index.json').write_text('{}')
+    distribution.evict(str(cache), 2500)
+    assert sorted(os.listdir(cache)) == ['b', 'b.size', 'c', 'c.size']
+    assert (cache / 'b.size').read_text() == '1000'
+    # Каталог keep остаётся, даже если он старше прочих.
+    distribution.evict(str(cache), 500, str(cache / 'b'))
+    assert sorted(os.listdir(cache)) == ['b', 'b.size']
+
+
+def test_stream_archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    monkeypatch.setattr(Globals, 'stream_archive', True)
+    monkeypatch.setattr(Globals, 'cache_dir', '')
+    archive = str(tmp_path / 'd.zip')
+    zip_distribution(archive, size=10)
+    prepared = distribution.Distribution(archive)
+    assert prepared.prepare()
+    # Из base распакован только манифест, остальное копируется прямо из архива.
+    assert prepared.base == str(tmp_path / ('d' + distribution.STREAM_SUFFIX) / 'base')
+    assert os.listdir(prepared.base) == ['base.txt']
+    assert prepared.configurations == ['c']
+    prepared.compute_size()
+    assert prepared.files == 5 and prepared.size == -(4 * 10 + len('name d\n'))
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        prepared.archive.send(tar, [os.path.join('d', 'f1.bin')])
+    buffer.seek(0)
+    with tarfile.open(fileobj=buffer) as tar, zipfile.ZipFile(archive) as z:
+        assert tar.extractfile('d/f1.bin').read() == z.read('base/d/f1.bin')
+    # Транспорту, не умеющему копировать потоком, base распаковывается.
+    assert prepared.extract_base()
+    assert prepared.archive is None
+    assert sorted(os.listdir(os.path.join(prepared.base, 'd'))) == ['f%d.bin' % i for i in range(4)]
+
+
+def test_stream_archive_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    monkeypatch.setattr(Globals, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(Globals, 'cache_budget', 1 << 40)
+    archive = str(tmp_path / 'd.zip')
+    zip_distribution(archive, size=10)
+    unpack_to, streamed = distribution.cached_distribution(archive, streamed=True)
+    assert streamed and unpack_to.endswith(distribution.STREAM_SUFFIX)
+    assert os.listdir(os.path.join(unpack_to, 'base')) == ['base.txt']
+    assert distribution.cached_distribution(archive, streamed=True) == (unpack_to, True)
+    # Без потока нужен полный каталог; после него полный каталог годится и для потока.
+    full, streamed = distribution.cached_distribution(archive)
+    assert not streamed and full + distribution.STREAM_SUFFIX == unpack_to
+    assert distribution.cached_distribution(archive, streamed=True) == (full, False)
+
+
+def test_index_reuse(tmp_path, monkeypatch):
+    messages = []
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(messages.append))
+    base = tmp_path / 'd' / 'base'
+    os.makedirs(base / 'bin')
+    (base / 'base.txt').write_text('name d\n')
+    (base / 'bin' / 'run.exe').write_bytes(b'x' * 100)
+    for i in range(distribution.INDEX_LARGEST + 5):
+        (base / ('f%02d.bin' % i)).write_bytes(b'x' * i)
+
+    def opened():
+        prepared = distribution.Distribution(str(base / 'base.txt'))
+        assert prepared.prepare()
+        messages.clear()
+        prepared.compute_size()
+        return prepared, any('Индекс дистрибутива' in message for message in messages)
+    first, indexed = opened()
+    assert not indexed and os.path.isfile(tmp_path / 'd.index.json')
+    assert first.files == distribution.INDEX_LARGEST + 7
+    assert first.executables == ['run.exe']
+    assert first.largest[0] == (100, os.path.join('bin', 'run.exe'))
+    assert len(first.largest) == distribution.INDEX_LARGEST
+    # Повторное открытие берёт всё из индекса, base не обходится.
+    (base / 'bin' / 'new.exe').write_bytes(b'x')
+    second, indexed = opened()
+    assert indexed
+    assert (second.files, second.size, second.executables, second.largest) == \
+           (first.files, first.size, first.executables, first.largest)
+    # Изменённый манифест - другой дистрибутив: индекс строится заново.
+    (base / 'base.txt').write_text('name d2\n')
+    third, indexed = opened()
+    assert not indexed and third.files == first.files + 1
+    assert sorted(third.executables) == ['new.exe', 'run.exe']
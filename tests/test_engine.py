@@ -0,0 +1,304 @@
+# encoding: utf-8
+
+# Сквозные проверки движка на LocalTransport: хосты - каталоги во временном каталоге, сети нет.
+#   python -m pytest -q tests
+
+import os
+import sys
+import time
+import importlib.util
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import agent
+import helpers
+from globals import Globals
+
+# Дистрибутив и запуск установки берутся из замера tools/bench-spider.py (имя модуля с дефисом).
+_spec = importlib.util.spec_from_file_location(
+    'bench_spider', os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tools', 'bench-spider.py'))
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+HOSTS = 12
+FILES = 20
+
+# Режимы копирования base: настройки Engine.
+MODES = {
+    'stamp': {},
+    'pipeline': {'pipeline': True},
+    'verify-on-copy': {'verify_on_copy': True},
+    'tar': {'tar_copy': True},
+    'wipe': {'wipe': True},
+    'swarm': {'swarm': True, 'swarm_chunk': 3000},
+    'swarm-pipeline': {'swarm': True, 'swarm_chunk': 3000, 'pipeline': True},
+    'chain': {'chain': True},
+}
+
+# Сообщения журнала текущей проверки.
+messages = []
+
+
+@pytest.fixture
+def work(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    messages.clear()
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(messages.append))
+    monkeypatch.setattr(Globals, 'retry_backoff', 0.1)
+    return tmp_path
+
+
+def distribution(work):
+    base_txt = bench.make_distribution(str(work / 'dist'), HOSTS, FILES, 1000)
+    # Личный файл каждого хоста поверх файла base.
+    conf = work / 'dist' / 'conf' / 'bench'
+    for hostname in os.listdir(conf):
+        if hostname.startswith('h'):
+            os.makedirs(conf / hostname / 'd00')
+            (conf / hostname / 'd00' / 'f000000.bin').write_text('personal ' + hostname)
+    return base_txt
+
+
+def install(work, base_txt, **options):
+    def setup(engine):
+        engine.fanout = 2
+        for name, value in options.items():
+            setattr(engine, name, value)
+        setup.engine = engine
+    messages.clear()
+    _, failed = bench.run(base_txt, str(work / 'hosts'), setup)
+    assert failed == []
+    return setup.engine
+
+
+def installed(work, hostname):
+    return work / 'hosts' / hostname / 'opt' / 'bench'
+
+
+# Все хосты получили base по манифесту (кроме файла, заменённого личным conf) и свой conf.
+def check(work, base_txt):
+    entries = agent.read_manifest(open(base_txt))
+    for hostname in os.listdir(work / 'hosts'):
+        root = installed(work, hostname)
+        assert (root / 'd00' / 'f000000.bin').read_text() == 'personal ' + hostname
+        for algorithm, digest, path in entries:
+            if path != 'd00/f000000.bin':
+                assert agent.hash_file(str(root / path), algorithm) == digest, (hostname, path)
+
+
+def copies():
+    return sum(1 for message in messages if 'Копирование base' in message)
+
+
+def test_pipeline_post(work):
+    base_txt = distribution(work)
+    post = work / 'dist' / 'conf' / 'bench' / 'common' / 'etc' / 'post-install.sh'
+    post.write_text('echo ok > post.txt\n')
+    install(work, base_txt, pipeline=True)
+    check(work, base_txt)
+    for hostname in os.listdir(work / 'hosts'):
+        assert (installed(work, hostname) / 'post.txt').read_text().strip() == 'ok'
+
+
+@pytest.mark.parametrize('mode', ['stamp', 'pipeline', 'verify-on-copy', 'swarm', 'chain'])
+def test_incremental(work, mode):
+    base_txt = distribution(work)
+    install(work, base_txt, **MODES[mode])
+    # Из дистрибутива удалён файл, часть файлов изменена, манифест переименован.
+    lines = [line for line in open(base_txt).read().splitlines() if 'f000002.bin' not in line]
+    os.remove(work / 'dist' / 'base' / 'd02' / 'f000002.bin')
+    os.remove(base_txt)
+    base_txt = str(work / 'dist' / 'base' / 'base-2.txt')
+    with open(base_txt, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    assert bench.change_distribution(base_txt, 10) > 0
+    install(work, base_txt, **MODES[mode])
+    check(work, base_txt)
+    for hostname in os.listdir(work / 'hosts'):
+        root = installed(work, hostname)
+        assert not os.path.exists(root / 'd02' / 'f000002.bin')
+        assert sorted(name for name in os.listdir(root) if name.startswith('base')) == ['base-2.txt']
+
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+def test_stale_files_removed(work, mode):
+    base_txt = distribution(work)
+    # Лишний файл есть и на хостах, получающих base с локального компьютера, и на получающих его от соседей.
+    for i in range(HOSTS):
+        root = installed(work, 'h%05d' % i)
+        os.makedirs(root)
+        (root / 'junk.txt').write_text('junk')
+    install(work, base_txt, **MODES[mode])
+    check(work, base_txt)
+    assert [hostname for hostname in os.listdir(work / 'hosts')
+            if os.path.exists(installed(work, hostname) / 'junk.txt')] == []
+
+
+def test_stale_files_removed_agent(work, monkeypatch):
+    monkeypatch.setattr(Globals, 'agent_session', True)
+    test_stale_files_removed(work, 'stamp')
+
+
+def test_stamp_skip(work):
+    base_txt = distribution(work)
+    install(work, base_txt)
+    assert copies() == HOSTS
+    install(work, base_txt)
+    assert copies() == 0
+    # Хост с испорченной отметкой base получает base заново, остальные пропускаются.
+    (work / 'hosts' / 'h00003' / 'opt' / 'bench.installer-stamp').write_text('base junk\n')
+    install(work, base_txt)
+    assert copies() == 1
+    check(work, base_txt)
+
+
+def test_retry_from_another_source(work):
+    base_txt = distribution(work)
+    bad = 'h00001'
+    calls = []
+
+    def setup(engine):
+        relay = engine.transport.relay
+
+        # Любое копирование с bad не удаётся.
+        def bad_relay(source_hostname, source_path, hostname, path, files=None):
+            if source_hostname == bad:
+                calls.append(hostname)
+                return 1
+            return relay(source_hostname, source_path, hostname, path, files)
+        engine.transport.relay = bad_relay
+        engine.fanout = 2
+        setup.engine = engine
+    _, failed = bench.run(base_txt, str(work / 'hosts'), setup)
+    assert failed == []
+    assert calls
+    check(work, base_txt)
+    hosts = {host.hostname: host for host in setup.engine.hosts}
+    for hostname in calls:
+        assert bad in hosts[hostname].avoid
+    assert hosts[bad].failures == len(calls)
+
+
+def test_speculation(work, monkeypatch):
+    monkeypatch.setattr(Globals, 'straggler_factor', 3)
+    monkeypatch.setattr(Globals, 'straggler_min', 1)
+    base_txt = bench.make_distribution(str(work / 'dist'), 24, FILES, 1000)
+    slow = 'h00001'
+
+    def setup(engine):
+        transport = engine.transport
+        relay = transport.relay
+
+        # Копирование с медленного источника ждёт отмены (не дольше 30 секунд).
+        def slow_relay(source_hostname, source_path, hostname, path, files=None):
+            if source_hostname == slow:
+                halted = transport.halted()
+                deadline = time.time() + 30
+                while time.time() < deadline:
+                    if halted():
+                        return 1
+                    time.sleep(0.05)
+            return relay(source_hostname, source_path, hostname, path, files)
+        transport.relay = slow_relay
+        engine.fanout = 2
+        setup.engine = engine
+    started = time.time()
+    _, failed = bench.run(base_txt, str(work / 'hosts'), setup)
+    assert failed == []
+    assert time.time() - started < 30
+    assert any('переносится на' in message for message in messages)
+    assert [host.hostname for host in setup.engine.hosts if host.slow] == [slow]
+    entries = agent.read_manifest(open(base_txt))
+    for hostname in os.listdir(work / 'hosts'):
+        for algorithm, digest, path in entries:
+            assert agent.hash_file(str(installed(work, hostname) / path), algorithm) == digest
+
+
+def test_stop(work):
+    base_txt = distribution(work)
+    hung = []
+
+    def setup(engine):
+        transport = engine.transport
+        relay, push = transport.relay, transport.push
+
+        # Копирования первой установки ждут останова и заканчиваются ошибкой, как убитые процессы.
+        def hang():
+            if not setup.hanging:
+                return False
+            hung.append(1)
+            halted = transport.halted()
+            deadline = time.time() + 30
+            while not halted() and time.time() < deadline:
+                time.sleep(0.05)
+            return True
+
+        def hung_relay(source_hostname, source_path, hostname, path, files=None):
+            return 1 if hang() else relay(source_hostname, source_path, hostname, path, files)
+
+        def hung_push(source_path, hostname, path, delete=False, files=None):
+            return 1 if hang() else push(source_path, hostname, path, delete, files)
+        transport.relay, transport.push = hung_relay, hung_push
+        engine.fanout = 2
+        setup.engine = engine
+    setup.hanging = True
+    # Как bench.run, но без ожидания конца: установка останавливается посередине и запускается снова.
+    prepared = bench.Distribution(base_txt)
+    prepared.prepare()
+    table_data = prepared.table_data_dict['bench']
+    for host in table_data.hosts:
+        host.checked = True
+    engine = bench.Engine(hostname='orchestrator', transport=bench.LocalTransport(str(work / 'hosts')))
+    engine.distribution = prepared
+    engine.configuration = 'bench'
+    engine.installation_path = table_data.destination
+    engine.hosts = table_data.hosts
+    setup(engine)
+    finished = []
+    engine.on_finished = lambda: finished.append(1)
+    engine.start()
+    deadline = time.time() + 10
+    while not hung and time.time() < deadline:
+        time.sleep(0.05)
+    assert hung
+    engine.do_stop()
+    # Прерванные копирования не запускают установку заново.
+    time.sleep(1)
+    assert not engine.running
+    assert [host.hostname for host in engine.hosts if host.state != bench.Host.State.IDLE] == []
+    # Следующий запуск проходит полностью.
+    setup.hanging = False
+    engine.start()
+    deadline = time.time() + 30
+    while not finished and time.time() < deadline:
+        time.sleep(0.05)
+    assert finished
+    assert [host.hostname for host in engine.hosts if host.state != bench.Host.State.SUCCESS] == []
+    check(work, base_txt)
+
+
+@pytest.mark.parametrize('session', [False, True])
+def test_conf_links(work, monkeypatch, session):
+    monkeypatch.setattr(Globals, 'agent_session', session)
+    base_txt = distribution(work)
+    lib = work / 'dist' / 'conf' / 'bench' / 'common' / 'lib'
+    os.makedirs(lib / 'real')
+    (lib / 'real' / 'x.so').write_text('x')
+    os.symlink('real', lib / 'current')
+    os.symlink('real/x.so', lib / 'x.so')
+    # Личный каталог хоста заменяет ссылку common.
+    own = work / 'dist' / 'conf' / 'bench' / 'h00001' / 'lib' / 'current'
+    os.makedirs(own)
+    (own / 'own').write_text('own')
+    install(work, base_txt)
+    for hostname in os.listdir(work / 'hosts'):
+        root = installed(work, hostname) / 'lib'
+        assert os.readlink(root / 'x.so') == 'real/x.so'
+        if hostname == 'h00001':
+            assert not os.path.islink(root / 'current')
+            assert os.listdir(root / 'current') == ['own']
+        else:
+            assert os.readlink(root / 'current') == 'real'
+    assert os.listdir(lib / 'real') == ['x.so']
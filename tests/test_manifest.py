@@ -0,0 +1,83 @@
+# encoding: utf-8
+
+# Построение манифеста base*.txt и проверка по нему: manifest.py.
+#   python -m pytest -q tests
+
+import os
+import sys
+import hashlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import agent
+import manifest
+
+
+def make_base(root):
+    for i in range(10):
+        os.makedirs(root / ('d%d' % (i % 3)), exist_ok=True)
+        (root / ('d%d' % (i % 3)) / ('f%d.bin' % i)).write_bytes(b'%d' % i * 1000)
+    (root / 'base-1.txt').write_text('name dist\n')
+
+
+def test_build(tmp_path):
+    root = tmp_path / 'base'
+    make_base(root)
+    output, hashed, total = manifest.build(str(root))
+    assert (output, hashed, total) == (str(root / 'base-1.txt'), 10, 10)
+    lines = open(output).read().splitlines()
+    assert lines[0] == 'name dist'
+    with open(output) as f:
+        entries = agent.read_manifest(f)
+    assert len(entries) == 10
+    for algorithm, digest, path in entries:
+        assert algorithm == 'md5'
+        assert digest == hashlib.md5((root / path).read_bytes()).hexdigest()
+    # Повторное построение берёт суммы из индекса, считаются только изменившиеся и новые файлы.
+    assert os.path.isfile(tmp_path / '.base.index')
+    (root / 'd1' / 'f1.bin').write_bytes(b'changed')
+    (root / 'd2' / 'new.bin').write_bytes(b'new')
+    os.remove(root / 'd0' / 'f0.bin')
+    output, hashed, total = manifest.build(str(root))
+    assert (hashed, total) == (2, 10)
+    with open(output) as f:
+        entries = {path: digest for algorithm, digest, path in agent.read_manifest(f)}
+    assert entries['d1/f1.bin'] == hashlib.md5(b'changed').hexdigest()
+    assert 'd2/new.bin' in entries and 'd0/f0.bin' not in entries
+    assert 'd0/f0.bin' not in manifest.load_index(str(tmp_path / '.base.index'))
+
+
+def test_build_algorithm(tmp_path):
+    root = tmp_path / 'base'
+    make_base(root)
+    manifest.build(str(root), 'sha256', 'other')
+    lines = (root / 'base-1.txt').read_text().splitlines()
+    assert lines[:2] == ['manifest %d' % agent.MANIFEST_VERSION, 'name other']
+    assert lines[2] == 'sha256 %s d0/f0.bin' % hashlib.sha256((root / 'd0' / 'f0.bin').read_bytes()).hexdigest()
+    # Суммы другим алгоритмом хранятся в индексе рядом с прежними.
+    assert manifest.build(str(root))[1] == 10
+    assert manifest.build(str(root), 'sha256')[1] == 0
+
+
+def test_verify(tmp_path, capsys):
+    root = tmp_path / 'base'
+    make_base(root)
+    index = str(tmp_path / 'index')
+    assert manifest.main(['build', str(root), '--index', index]) == 0
+    assert manifest.main(['verify', str(root), '--index', index]) == 0
+    # Изменённый файл перечитывается, хотя в индексе есть его прежняя сумма; пропавший файл тоже не совпадает.
+    (root / 'd1' / 'f1.bin').write_bytes(b'changed')
+    os.remove(root / 'd2' / 'f2.bin')
+    capsys.readouterr()
+    assert manifest.main(['verify', str(root), '--index', index]) == 1
+    assert sorted(capsys.readouterr().out.split()) == ['d1/f1.bin', 'd2/f2.bin']
+    (root / 'base-1.txt').write_text('manifest 99\n')
+    assert manifest.main(['verify', str(root), '--index', index]) == 2
+
+
+def test_broken_index(tmp_path):
+    root = tmp_path / 'base'
+    make_base(root)
+    (tmp_path / '.base.index').write_bytes(b'not a pickle')
+    assert manifest.build(str(root))[1:] == (10, 10)
+    assert len(manifest.load_index(str(tmp_path / '.base.index'))) == 10
@@ -0,0 +1,26 @@
+# encoding: utf-8
+
+# Топология и fanout из settings.txt.
+#   python -m pytest -q tests
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import helpers
+from scheduler import Topology, Fanout
+
+
+def test_bad_settings_skipped(monkeypatch):
+    messages = []
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(messages.append))
+    settings = [line.split() for line in ('segment r1 r1-*', 'uplink r1 1O00', 'uplink r2 100', 'uplink r3 nan',
+                                          'fanout x2', 'fanout 3 big-*')]
+    topology = Topology(settings)
+    fanout = Fanout(settings)
+    assert topology.uplinks == {'r2': 100}
+    assert topology.segment('r1-h1') == 'r1'
+    assert fanout.limit('h1') == 1
+    assert fanout.limit('big-1') == 3
+    assert len([message for message in messages if 'строка пропущена' in message]) == 3
@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+# Рой: деление base на куски и выбор передач.
+#   python -m pytest -q tests
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import swarm
+from scheduler import Topology
+
+FILES = ['d%d/f%02d' % (i % 3, i) for i in range(20)]
+SIZES = dict((f, 100) for f in FILES + ['base.txt'])
+MANIFEST = dict((f, 'md5 %032x' % i) for i, f in enumerate(FILES))
+
+
+def test_split():
+    chunks = swarm.split(FILES + ['base.txt'], SIZES, MANIFEST, 300, 'base.txt')
+    assert chunks[0].files == ['base.txt']
+    assert sorted(f for chunk in chunks[1:] for f in chunk.files) == sorted(FILES)
+    assert all(chunk.size <= 300 for chunk in chunks)
+    # Номер куска - по содержимому: тот же base даёт те же куски, изменённый файл меняет только свой кусок.
+    again = swarm.split(FILES + ['base.txt'], SIZES, MANIFEST, 300, 'base.txt')
+    assert [chunk.id for chunk in again] == [chunk.id for chunk in chunks]
+    changed = dict(MANIFEST, **{FILES[0]: 'md5 ' + 'f' * 32})
+    ids = [chunk.id for chunk in swarm.split(FILES + ['base.txt'], SIZES, changed, 300, 'base.txt')]
+    assert sum(1 for a, b in zip(ids, [chunk.id for chunk in chunks]) if a != b) == 1
+
+
+# Передачи до конца: все приёмники получают все куски, манифест - первым, часть кусков идёт с других хостов.
+def test_tracker():
+    chunks = swarm.split(FILES + ['base.txt'], SIZES, MANIFEST, 300, 'base.txt')
+    tracker = swarm.Tracker(chunks, lambda hostname: 2, Topology(), 'orchestrator')
+    hosts = ['h%d' % i for i in range(6)]
+    for hostname in hosts:
+        tracker.join(hostname)
+    received = dict((hostname, []) for hostname in hosts)
+    sources = []
+    finished = []
+    while len(finished) < len(hosts):
+        transfers = []
+        while True:
+            transfer = tracker.next_transfer()
+            if not transfer:
+                break
+            transfers.append(transfer)
+        assert transfers or tracker.transfers
+        for i, source, destination, files in transfers:
+            assert source != destination
+            assert tracker.uploads[source] <= 2
+            received[destination].append(i)
+            sources.append(source)
+            assert tracker.done(i, source, destination, True) is False
+        finished += tracker.finished()
+    assert sorted(finished) == hosts
+    for hostname in hosts:
+        assert received[hostname][0] == 0
+        assert sorted(received[hostname]) == list(range(len(chunks)))
+    assert any(source is not None for source in sources)
+    assert tracker.transfers == 0
+
+
+def test_tracker_failures():
+    chunks = swarm.split(FILES + ['base.txt'], SIZES, MANIFEST, 300, 'base.txt')
+    tracker = swarm.Tracker(chunks, lambda hostname: 4, Topology(), 'orchestrator')
+    tracker.seed('h0')
+    # Уже установленный хост с изменённым одним файлом получает только его кусок.
+    tracker.join('h1', [FILES[5]])
+    i, source, destination, files = tracker.next_transfer()
+    assert (destination, files) == ('h1', [FILES[5]])
+    assert tracker.next_transfer() is None
+    # С источника, передача с которого не удалась, приёмник больше не получает; после RETRIES ошибок он снимается.
+    assert tracker.done(i, source, destination, False) is False
+    for attempt in range(swarm.RETRIES):
+        i, next_source, destination, files = tracker.next_transfer()
+        if source is not None:
+            assert next_source != source
+        failed = tracker.done(i, next_source, destination, False)
+    assert failed is True
@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+# Транспорты без сети: подбор сжатия.
+#   python -m pytest -q tests
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import helpers
+import transport
+from globals import Globals
+
+
+def test_compression_per_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers.Logger, 'write', staticmethod(lambda message: None))
+    monkeypatch.setattr(Globals, 'compression', 'zstd')
+    monkeypatch.setattr(transport, 'cpu_busy', lambda threshold: True)
+    local = transport.LocalTransport(str(tmp_path))
+    local.probe_compressors = lambda hostname: {'zstd'}
+    pushed = local.compression(None, 'h1')
+    relayed = local.compression('h2', 'h1')
+    assert local.compression('h2', 'h3') is relayed
+    assert local.compression('h3', 'h1') is not relayed
+    assert pushed is not relayed
+    # Занятый процессор этого компьютера понижает уровень, только когда сжимает он сам.
+    level = relayed.level
+    relayed.record(1000, 1)
+    assert relayed.level == level + 1
+    level = pushed.level
+    pushed.record(1000, 1)
+    assert pushed.level == level - 1
@@ -0,0 +1,57 @@
+# encoding: utf-8
+
+# Замер построения манифеста (manifest.py build): без индекса, с индексом без изменений и после изменения
+# части файлов.
+#   python tools/bench-manifest.py --files 1000000 --changed 1
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import manifest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--changed', type=float, default=1, help='процент изменяемых файлов')
+    parser.add_argument('--algorithm', default='md5')
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='bench-manifest-')
+    try:
+        root = os.path.join(work, 'base')
+        for i in range(args.files):
+            d = os.path.join(root, 'd%03d' % (i % 1000))
+            if i < 1000:
+                os.makedirs(d)
+            with open(os.path.join(d, 'f%07d' % i), 'wb') as f:
+                f.write(os.urandom(args.size))
+
+        def measure(label):
+            started = time.time()
+            output, hashed, total = manifest.build(root, args.algorithm, 'bench')
+            print('%-10s files=%d hashed=%d: %.2fs' % (label, total, hashed, time.time() - started))
+
+        measure('cold')
+        measure('warm')
+        step = max(1, int(100 / args.changed)) if args.changed > 0 else 0
+        for i in range(0, args.files, step) if step else []:
+            with open(os.path.join(root, 'd%03d' % (i % 1000), 'f%07d' % i), 'wb') as f:
+                f.write(os.urandom(args.size))
+        measure('changed')
+        started = time.time()
+        mismatched = manifest.verify(root)
+        print('verify     mismatched=%d: %.2fs' % (len(mismatched), time.time() - started))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
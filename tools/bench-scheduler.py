@@ -0,0 +1,72 @@
+# encoding: utf-8
+
+# Замер стоимости одного шага планировщика на фазе base в зависимости от числа хостов.
+# Копирования не выполняются: каждое сразу считается успешным.
+#   python tools/bench-scheduler.py 100 1000 10000 --racks 8 --fanout 2
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import helpers
+from engine import Host, TableData, Engine
+from distribution import Distribution
+
+
+def measure(count, racks, fanout):
+    table_data = TableData('', '/opt/bench')
+    table_data.settings = [['segment', 'r%02d' % rack, 'r%02d-*' % rack] for rack in range(racks)]
+    table_data.hosts = [TableData.Host('r%02d-h%05d' % (i % racks, i) if racks else 'h%05d' % i)
+                        for i in range(count)]
+    distribution = Distribution('bench')
+    distribution.table_data_dict['bench'] = table_data
+
+    engine = Engine(hostname='orchestrator')
+    engine.distribution = distribution
+    engine.configuration = 'bench'
+    engine.hosts = table_data.hosts
+    engine.fanout = fanout
+    engine.wipe = True  # Без сканирования base и проверки отметок: замеряется только планировщик
+    jobs = []
+    engine.submit = lambda phase, target, *args: jobs.append((target, args))
+
+    engine.start()
+    events = 0
+    spent = 0
+    worst = 0
+    while jobs:
+        target, args = jobs.pop(0)
+        if target != engine.do_copy_base:
+            break
+        source_host, destination_host = args
+        destination_host.state = Host.State.BASE_SUCCESS
+        if source_host:
+            engine.release_source(source_host)
+        started = time.perf_counter()
+        engine.worker()
+        elapsed = time.perf_counter() - started
+        spent += elapsed
+        worst = max(worst, elapsed)
+        events += 1
+    return events, spent, worst
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('counts', type=int, nargs='*', default=[100, 1000, 10000])
+    parser.add_argument('--racks', type=int, default=0)
+    parser.add_argument('--fanout', type=int, default=0)
+    args = parser.parse_args()
+
+    helpers.Logger.write = staticmethod(lambda message: None)
+    for count in args.counts:
+        events, spent, worst = measure(count, args.racks, args.fanout)
+        print('hosts=%d events=%d: %.1f us/event, worst %.1f us'
+              % (count, events, spent / max(events, 1) * 1e6, worst * 1e6))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
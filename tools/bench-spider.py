@@ -0,0 +1,244 @@
+# encoding: utf-8
+
+# Замер сквозной установки "пауком" на LocalTransport: без сети, все хосты - каталоги на этой машине.
+#   python tools/bench-spider.py --hosts 500 --files 200 --size 65536
+# С --changed 5 после первой установки 5% файлов base меняются и установка повторяется (замер инкрементальной).
+# С --archive unpack|stream дистрибутив открывается из zip: распаковкой или с отдачей base потоком из архива.
+# С --link 50 копирования base занимают входящий и исходящий каналы хостов по 50 МБ/с (модель сети),
+# например для сравнения обычного "паука" с роем (--swarm) и цепочкой (--chain).
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import helpers
+from globals import Globals
+from engine import Host, Engine
+from distribution import Distribution
+from transport import LocalTransport
+
+
+def make_distribution(root, hosts, files, size, racks=0):
+    base = os.path.join(root, 'base')
+    lines = ['name bench']
+    for i in range(files):
+        relative = os.path.join('d%02d' % (i % 16), 'f%06d.bin' % i)
+        os.makedirs(os.path.join(base, os.path.dirname(relative)), exist_ok=True)
+        data = os.urandom(size)
+        with open(os.path.join(base, relative), 'wb') as f:
+            f.write(data)
+        lines.append('md5 %s %s' % (hashlib.md5(data).hexdigest(), relative))
+    with open(os.path.join(base, 'base.txt'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    conf = os.path.join(root, 'conf', 'bench')
+    os.makedirs(os.path.join(conf, 'common', 'etc'))
+    with open(os.path.join(conf, 'settings.txt'), 'w') as f:
+        f.write('path /opt/bench\n')
+        for rack in range(racks):
+            f.write('segment r%02d r%02d-*\n' % (rack, rack))
+    for i in range(hosts):
+        if racks:
+            os.makedirs(os.path.join(conf, 'r%02d-h%05d' % (i % racks, i)))
+        else:
+            os.makedirs(os.path.join(conf, 'h%05d' % i))
+    return os.path.join(base, 'base.txt')
+
+
+# Замена содержимого percent процентов файлов base с пересчётом манифеста.
+def change_distribution(base_txt, percent):
+    base = os.path.dirname(base_txt)
+    lines = []
+    manifest = open(base_txt).read().splitlines()
+    step = max(1, int(100 / percent)) if percent > 0 else 0
+    changed = 0
+    for i, line in enumerate(manifest):
+        if step and line.startswith('md5 ') and i % step == 0:
+            relative = line.split(' ', 2)[2]
+            path = os.path.join(base, relative)
+            data = os.urandom(os.path.getsize(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+            line = 'md5 %s %s' % (hashlib.md5(data).hexdigest(), relative)
+            changed += 1
+        lines.append(line)
+    with open(base_txt, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return changed
+
+
+# zip-дистрибутив из распакованного root (с пустыми каталогами хостов в conf).
+def make_archive(root):
+    archive = root + '.zip'
+    with zipfile.ZipFile(archive, 'w') as z:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                z.write(path, os.path.relpath(path, root))
+    return archive
+
+
+# Модель сети: у каждого хоста (и у локального компьютера) один исходящий и один входящий канал по rate байт/с,
+# копирование size байт занимает исходящий канал источника и входящий приёмника на size / rate секунд.
+class Links:
+    def __init__(self, rate):
+        self.rate = rate
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def channel(self, key):
+        with self.lock:
+            return self.channels.setdefault(key, threading.Lock())
+
+    def transfer(self, source, destination, size):
+        with self.channel(('up', source)):
+            with self.channel(('down', destination)):
+                time.sleep(size / self.rate)
+
+    # Цепочка занимает исходящий канал каждого звена и входящий следующего одновременно, поток идёт
+    # со скоростью одного канала.
+    def transfer_chain(self, hostnames, size):
+        channels = [self.channel(('up', None))]
+        for i, hostname in enumerate(hostnames):
+            channels.append(self.channel(('down', hostname)))
+            if i < len(hostnames) - 1:
+                channels.append(self.channel(('up', hostname)))
+        for channel in channels:
+            channel.acquire()
+        try:
+            time.sleep(size / self.rate)
+        finally:
+            for channel in channels:
+                channel.release()
+
+    # Копирования base транспорта transport идут через каналы; файлов base - count по size байт.
+    def throttle(self, transport, base, count, size):
+        push, relay, stream, chain = transport.push, transport.relay, transport.stream, transport.chain
+
+        def throttled_push(source_path, hostname, path, delete=False, files=None):
+            if source_path == base:
+                self.transfer(None, hostname, (count if files is None else len(files)) * size)
+            return push(source_path, hostname, path, delete, files)
+
+        def throttled_relay(source_hostname, source_path, hostname, path, files=None):
+            self.transfer(source_hostname, hostname, (count if files is None else len(files)) * size)
+            return relay(source_hostname, source_path, hostname, path, files)
+
+        def throttled_stream(source_hostname, source_path, hostname, path, files, *args):
+            self.transfer(source_hostname, hostname, len(files) * size)
+            return stream(source_hostname, source_path, hostname, path, files, *args)
+
+        def throttled_chain(source_path, hostnames, path, files, *args):
+            self.transfer_chain(hostnames, len(files) * size)
+            return chain(source_path, hostnames, path, files, *args)
+        transport.push, transport.relay, transport.stream = throttled_push, throttled_relay, throttled_stream
+        transport.chain = throttled_chain
+
+
+# Время считается с открытия дистрибутива: для zip сюда входит распаковка.
+def run(base_txt, root, setup=lambda engine: None):
+    started = time.time()
+    distribution = Distribution(base_txt)
+    distribution.prepare()
+    table_data = distribution.table_data_dict['bench']
+    for host in table_data.hosts:
+        host.checked = True
+
+    engine = Engine(hostname='orchestrator', transport=LocalTransport(root))
+    engine.distribution = distribution
+    engine.configuration = 'bench'
+    engine.installation_path = table_data.destination
+    engine.hosts = table_data.hosts
+    setup(engine)
+
+    finished = threading.Event()
+    engine.on_finished = finished.set
+    engine.start()
+    finished.wait()
+    elapsed = time.time() - started
+    failed = [host.hostname for host in engine.hosts if host.state != Host.State.SUCCESS]
+    return elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=500)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--racks', type=int, default=0, help='разбить хосты на сегменты (settings.txt: segment)')
+    parser.add_argument('--fanout', type=int, default=0)
+    parser.add_argument('--no-verify', action='store_true')
+    parser.add_argument('--pipeline', action='store_true', help='conf и post каждого хоста сразу после его base')
+    parser.add_argument('--wipe', action='store_true', help='очищать каталог установки и копировать base целиком')
+    parser.add_argument('--verify-on-copy', action='store_true', help='проверять md5 при записи, tar-потоком')
+    parser.add_argument('--agent', action='store_true', help='шаги на хостах через сессии agent.py serve')
+    parser.add_argument('--swarm', action='store_true', help='base кусками с нескольких хостов сразу')
+    parser.add_argument('--swarm-chunk', type=int, default=0, help='размер куска роя, байт')
+    parser.add_argument('--chain', action='store_true', help='base одним потоком по цепочке хостов')
+    parser.add_argument('--link', type=float, default=0, help='скорость каналов хостов, МБ/с (0 - без модели сети)')
+    parser.add_argument('--archive', choices=('unpack', 'stream'),
+                        help='открывать zip-дистрибутив: распаковать его или отдавать base потоком из архива')
+    parser.add_argument('--changed', type=float, default=0,
+                        help='процент файлов, меняемых перед повторной установкой')
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='bench-spider-')
+    os.chdir(work)
+    helpers.Logger.write = staticmethod(lambda message: None)
+    try:
+        base_txt = make_distribution(os.path.join(work, 'distribution'), args.hosts, args.files, args.size,
+                                     args.racks)
+        Globals.agent_session = args.agent
+        if args.archive:
+            Globals.cache_dir = os.path.join(work, 'cache')
+            Globals.stream_archive = args.archive == 'stream'
+            distribution_uri = make_archive(os.path.join(work, 'distribution'))
+        else:
+            distribution_uri = base_txt
+        crossings = []
+
+        def setup(engine):
+            engine.do_verify = not args.no_verify
+            engine.fanout = args.fanout
+            engine.pipeline = args.pipeline
+            engine.wipe = args.wipe
+            engine.verify_on_copy = args.verify_on_copy
+            engine.swarm = args.swarm
+            engine.chain = args.chain
+            if args.swarm_chunk:
+                engine.swarm_chunk = args.swarm_chunk
+            if args.link:
+                Links(args.link * 1024 ** 2).throttle(engine.transport, engine.distribution.base, args.files + 1,
+                                                      args.size)
+            relay = engine.transport.relay
+
+            # Подсчёт копирований между сегментами.
+            def counting_relay(source_hostname, source_path, hostname, path, files=None):
+                if args.racks and source_hostname.split('-')[0] != hostname.split('-')[0]:
+                    crossings.append((source_hostname, hostname))
+                return relay(source_hostname, source_path, hostname, path, files)
+            engine.transport.relay = counting_relay
+
+        elapsed, failed = run(distribution_uri, os.path.join(work, 'hosts'), setup)
+        total = args.hosts * args.files * args.size
+        print('hosts=%d files=%d size=%s: %.1fs, %s/s, failed=%d, cross-segment=%d'
+              % (args.hosts, args.files, helpers.bytes_to_human(args.size), elapsed,
+                 helpers.bytes_to_human(total / elapsed), len(failed), len(crossings)))
+        if args.changed and not failed:
+            changed = change_distribution(base_txt, args.changed)
+            elapsed, failed = run(base_txt, os.path.join(work, 'hosts'), setup)
+            print('repeat with %d changed files: %.1fs, failed=%d' % (changed, elapsed, len(failed)))
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+# Замер копирования base на пустой каталог на LocalTransport: пофайловое копирование (замена rsync, push)
+# против tar-потока (push_tar) без сжатия, с lz4 и zstd, на дереве мелких файлов и на дереве больших.
+#   python tools/bench-transport.py --small 100000 --small-size 2048 --large 8 --large-size 67108864
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import helpers
+from globals import Globals
+from transport import LocalTransport, Compression
+
+
+# Дерево из count файлов по size байт; половина каждого файла - повторяющиеся данные, чтобы сжатию было что сжимать.
+def make_tree(root, count, size):
+    for i in range(count):
+        d = os.path.join(root, 'd%03d' % (i % 256))
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, 'f%07d' % i), 'wb') as f:
+            f.write(os.urandom(size // 2) + b'installer' * (size // 2 // 9) + b'\n' * (size // 2 % 9))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--small', type=int, default=20000, help='число мелких файлов')
+    parser.add_argument('--small-size', type=int, default=2048)
+    parser.add_argument('--large', type=int, default=4, help='число больших файлов')
+    parser.add_argument('--large-size', type=int, default=64 * 1024 * 1024)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='bench-transport-')
+    helpers.Logger.write = staticmethod(lambda message: None)
+    try:
+        transport = LocalTransport(os.path.join(work, 'hosts'))
+        trees = (('small', args.small, args.small_size), ('large', args.large, args.large_size))
+        for name, count, size in trees:
+            source = os.path.join(work, name)
+            make_tree(source, count, size)
+            total = count * size
+            methods = [('push', '', lambda host: transport.push(source, host, '/opt/bench', True))]
+            for compression in ('',) + tuple(c for c in Compression.LEVELS if shutil.which(c)):
+                methods.append(('push_tar', compression,
+                                lambda host: transport.push_tar(source, host, '/opt/bench', size=total)))
+            for method, compression, copy in methods:
+                Globals.compression = compression
+                host = '%s-%s-%s' % (name, method, compression or 'none')
+                started = time.time()
+                returncode = copy(host)
+                elapsed = time.time() - started
+                print('%-5s files=%-7d %-8s %-5s %6.2fs %s/s%s'
+                      % (name, count, method, compression or '-', elapsed, helpers.bytes_to_human(total / elapsed),
+                         '' if returncode == 0 else ' returncode=%d' % returncode))
+                shutil.rmtree(os.path.join(work, 'hosts', host), ignore_errors=True)
+            shutil.rmtree(source, ignore_errors=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
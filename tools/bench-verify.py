@@ -0,0 +1,52 @@
+# encoding: utf-8
+
+# Замер проверки каталога по манифесту (agent.py verify) в зависимости от алгоритма и числа потоков.
+#   python tools/bench-verify.py --files 2000 --size 1048576 --jobs 1 4 16
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import agent
+import helpers
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--size', type=int, default=1024 * 1024)
+    parser.add_argument('--jobs', type=int, nargs='*', default=[1, 0], help='0 - по умолчанию агента')
+    parser.add_argument('--algorithms', nargs='*', default=['md5', 'blake2b'])
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='bench-verify-')
+    try:
+        data = {}
+        for i in range(args.files):
+            relative = 'f%06d.bin' % i
+            data[relative] = os.urandom(args.size)
+            with open(os.path.join(work, relative), 'wb') as f:
+                f.write(data[relative])
+        total = args.files * args.size
+        for algorithm in args.algorithms:
+            entries = [(algorithm, hashlib.new(algorithm, content).hexdigest(), relative)
+                       for relative, content in data.items()]
+            for jobs in args.jobs:
+                started = time.time()
+                mismatched = agent.verify(work, entries, jobs)
+                elapsed = time.time() - started
+                print('%s jobs=%s: %.2fs, %s/s, mismatched=%d'
+                      % (algorithm, jobs if jobs else 'auto', elapsed, helpers.bytes_to_human(total / elapsed),
+                         mismatched))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
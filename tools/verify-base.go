@@ -7,6 +7,7 @@ import (
 	"fmt"
 	"io"
 	"os"
+	"strconv"
 	"strings"
 )
 
@@ -56,6 +57,18 @@ func main() {
 	var line string
 	for {
 		line, err = reader.ReadString('\n')
+		// Манифест версии 2 и выше может содержать не только md5 - такие проверяет agent.py.
+		// "manifest 1" проверяется здесь, неразборчивая версия - как слишком новая.
+		if words := strings.Fields(line); len(words) > 0 && words[0] == "manifest" {
+			version, parse_err := 0, error(nil)
+			if len(words) >= 2 {
+				version, parse_err = strconv.Atoi(words[1])
+			}
+			if len(words) < 2 || parse_err != nil || version >= 2 {
+				fmt.Fprintln(os.Stderr, "unsupported manifest version, use agent.py")
+				os.Exit(2)
+			}
+		}
 		if strings.HasPrefix(line, "md5 ") {
 			words := strings.SplitN(line, " ", 3)
 			words[2] = strings.TrimSpace(words[2])
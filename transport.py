@@ -0,0 +1,1184 @@
+# encoding: utf-8
+
+# Транспорты: как доставить файлы на хост и выполнить там команду.
+#   SshTransport     - ssh + rsync (Linux);
+#   WindowsTransport - PsExec + xcopy (Windows);
+#   LocalTransport   - каждый хост это каталог на этой же машине, для замеров и регресс-тестов без сети.
+# Все методы блокирующие и возвращают код возврата; terminate() прерывает все запущенные операции.
+
+import os
+import sys
+import glob
+import json
+import stat
+import time
+import signal
+import shlex
+import tarfile
+import hashlib
+import functools
+import shutil
+import zipfile
+import threading
+import tempfile
+import subprocess
+
+import agent
+import helpers
+from globals import Globals
+
+
+def agent_file():
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'agent.py')
+
+
+# Путь к agent.py на хостах (Linux).
+@functools.lru_cache()
+def agent_remote_path():
+    with open(agent_file(), 'rb') as f:
+        return '/var/tmp/installer-agent-%s.py' % hashlib.md5(f.read()).hexdigest()[:12]
+
+
+# Недокопированные при обрыве файлы rsync оставляет в этом каталоге (относительно каталога файла),
+# и следующее копирование, например повтор после неудачи, докачивает их, а не начинает заново.
+PARTIAL_DIR = '.rsync-partial'
+
+
+# Список файлов для rsync --files-from=- (None - копируется весь каталог).
+# Файлы из списка копируются без сверки размера и времени (-I): список уже состоит из изменившихся файлов.
+def files_from(files):
+    if files is None:
+        return None
+    return ''.join(f.replace(os.sep, '/') + '\n' for f in files).encode()
+
+
+# Запись stdin процесса; если процесс завершился раньше, остаток не нужен.
+def feed_stdin(feed, stdin):
+    try:
+        feed(stdin)
+    except (OSError, ValueError):
+        pass
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+# Файлы base в порядке передачи потоком: манифест первым, чтобы приёмник проверял остальные по мере записи.
+def stream_order(files, manifest):
+    return [f for f in files if f == manifest] + [f for f in files if f != manifest]
+
+
+# tar-поток файлов files (пути относительно root) в stream. root - каталог или ArchiveBase.
+def send_tar(stream, root, files, stopped=lambda: False):
+    with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        if isinstance(root, ArchiveBase):
+            root.send(tar, files, stopped)
+            return
+        for f in files:
+            if stopped():
+                raise OSError('Остановлено')
+            tar.add(os.path.join(root, f), arcname=f.replace(os.sep, '/'), recursive=False)
+
+
+# base, оставленный внутри zip-дистрибутива: файлы отдаются tar-потоком прямо из архива, без распаковки на диск.
+# Копировать из него умеет только stream.
+class ArchiveBase:
+    def __init__(self, archive, prefix='base/'):
+        self.archive = archive
+        self.prefix = prefix
+        self.members = {}  # Путь относительно base -> ZipInfo
+        with zipfile.ZipFile(archive) as z:
+            for member in z.infolist():
+                if member.filename.startswith(prefix) and not member.is_dir() and member.filename != prefix:
+                    self.members[os.path.normpath(member.filename[len(prefix):])] = member
+
+    def __str__(self):
+        return '%s:%s' % (self.archive, self.prefix)
+
+    def send(self, tar, files, stopped=lambda: False):
+        with zipfile.ZipFile(self.archive) as z:
+            for f in files:
+                if stopped():
+                    raise OSError('Остановлено')
+                member = self.members.get(os.path.normpath(f))
+                if member is None:
+                    raise OSError('Нет в архиве: %s%s' % (self.prefix, f))
+                info = tarfile.TarInfo(f.replace(os.sep, '/'))
+                mode = member.external_attr >> 16
+                info.mode = mode & 0o7777 or 0o644
+                info.mtime = time.mktime(member.date_time + (0, 0, -1))
+                if stat.S_ISLNK(mode):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = z.read(member).decode()
+                    tar.addfile(info)
+                    continue
+                info.size = member.file_size
+                with z.open(member) as source:
+                    tar.addfile(info, source)
+
+
+# Команда tar, пишущая в stdout каталог path целиком или файлы files (список читается из stdin).
+def tar_create(path, files=None):
+    if files is None:
+        return 'tar -C "%s" -cf - .' % path
+    return 'tar -C "%s" -cf - --no-recursion --verbatim-files-from -T -' % path
+
+
+# Сжатие tar-потока (zstd или lz4) с подбором уровня по измеренной скорости копирования: уровень меняется на шаг
+# после каждого копирования, пока скорость растёт, и в обратную сторону, когда она упала. Если процессор этого
+# компьютера занят больше CPU_BUSY, уровень снижается.
+class Compression:
+    LEVELS = {'zstd': (1, 19, 3), 'lz4': (1, 12, 1)}  # Наименьший, наибольший, начальный
+    CPU_BUSY = 0.9
+
+    # host - хост, на котором идёт сжатие (источник копирования), None - этот компьютер.
+    def __init__(self, name, host=None):
+        self.name = name
+        self.host = host
+        self.low, self.high, self.level = Compression.LEVELS[name]
+        self.step = 1
+        self.rate = 0.0  # Байт base в секунду при последнем копировании
+        self.lock = threading.Lock()
+
+    def compress(self):
+        with self.lock:
+            level = self.level
+        return '%s -q -%d%s' % (self.name, level, ' -T0' if self.name == 'zstd' else '')
+
+    def decompress(self):
+        return '%s -q -d' % self.name
+
+    # Копирование size байт заняло seconds секунд. Загрузка процессора учитывается, только когда сжимает
+    # этот компьютер: загрузку источника отсюда не видно.
+    def record(self, size, seconds):
+        if size <= 0 or seconds <= 0:
+            return
+        rate = size / seconds
+        with self.lock:
+            if self.host is None and cpu_busy(Compression.CPU_BUSY):
+                self.step = -1
+            elif self.rate and rate < self.rate:
+                self.step = -self.step
+            self.rate = rate
+            self.level = min(self.high, max(self.low, self.level + self.step))
+        helpers.Logger.i('%s на %s: %s/s, следующий уровень %d'
+                         % (self.name, self.host or 'localhost', helpers.bytes_to_human(rate), self.level))
+
+
+def cpu_busy(threshold):
+    return hasattr(os, 'getloadavg') and os.getloadavg()[0] / (os.cpu_count() or 1) > threshold
+
+
+class Transport:
+    # Умеет ли транспорт копировать только заданный список файлов (параметр files у push/relay).
+    files_supported = True
+    # Умеет ли транспорт копировать с проверкой при записи (stream).
+    stream_supported = True
+    # Умеет ли транспорт копировать tar-потоком (push_tar/relay_tar).
+    tar_supported = True
+    # Умеет ли транспорт запускать на хосте agent.py serve (см. AgentTransport).
+    agent_supported = True
+    # Умеет ли транспорт прерывать отдельное задание (cancel), не останавливая остальные.
+    cancel_supported = True
+
+    def __init__(self):
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.agents = set()  # Хосты, на которые за эту установку уже скопирован agent.py
+        self.compressors = {}  # Хост (None - этот компьютер) -> множество доступных на нём сжатий
+        self.compressions = {}  # (сжатие, хост, на котором оно идёт) -> Compression со своим уровнем
+        self.local = threading.local()  # job - задание, которое выполняет поток, см. begin
+        self.jobs = {}  # Задание -> множество его процессов
+        self.cancelled = set()  # Отменённые задания
+
+    # Запуск команды с учётом в self.processes, чтобы terminate() мог её прервать.
+    # lines - функция, которой по мере появления передаются строки stdout (без перевода строки);
+    # feed - функция, которая в отдельном потоке пишет stdin команды (вместо input).
+    def run(self, cmd, stdout=None, stderr=None, cwd=None, input=None, lines=None, feed=None):
+        helpers.Logger.i(cmd)
+        if input is not None and lines:
+            feed = lambda stdin: stdin.write(input)
+        r = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE if lines else stdout, stderr=stderr, cwd=cwd,
+                             stdin=subprocess.PIPE if input is not None or feed else None,
+                             start_new_session=sys.platform != 'win32')
+        job = getattr(self.local, 'job', None)
+        with self.lock:
+            self.processes.add(r)
+            if job is not None:
+                self.jobs.setdefault(job, set()).add(r)
+            if job in self.cancelled:
+                self.kill(r)
+        try:
+            if lines or feed:
+                writer = threading.Thread(target=feed_stdin, args=(feed, r.stdin)) if feed else None
+                if writer:
+                    writer.start()
+                if lines:
+                    for line in r.stdout:
+                        lines(line.decode(errors='ignore').rstrip('\r\n'))
+                r.wait()
+                if writer:
+                    writer.join()
+                out, err = None, None
+            else:
+                out, err = r.communicate(input)
+        finally:
+            with self.lock:
+                self.processes.discard(r)
+                if job is not None:
+                    self.jobs[job].discard(r)
+                    if not self.jobs[job]:
+                        del self.jobs[job]
+        return subprocess.CompletedProcess(cmd, r.returncode, out, err)
+
+    def terminate(self):
+        self.stopped = True
+        with self.lock:
+            processes = list(self.processes)
+        for r in processes:
+            self.kill(r)
+
+    @staticmethod
+    def kill(r):
+        try:
+            os.killpg(r.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    # Задание job (любой уникальный ключ): команды, которые поток запускает между begin и end, можно прервать
+    # cancel(job), не трогая остальные. Копирование внутри процесса (LocalTransport, отправка tar) проверяет halted.
+    def begin(self, job):
+        self.local.job = job
+
+    def end(self):
+        job = getattr(self.local, 'job', None)
+        self.local.job = None
+        with self.lock:
+            self.cancelled.discard(job)
+
+    def cancel(self, job):
+        with self.lock:
+            self.cancelled.add(job)
+            processes = list(self.jobs.get(job, ()))
+        for r in processes:
+            self.kill(r)
+
+    # Отмена задания job больше не действует (например, оно успело закончиться).
+    def keep(self, job):
+        with self.lock:
+            self.cancelled.discard(job)
+
+    # Проверка "пора прекратить" для задания текущего потока: останов установки или отмена задания.
+    # Возвращает функцию, её можно вызывать и из других потоков (например, отправляющего tar).
+    def halted(self):
+        job = getattr(self.local, 'job', None)
+        return lambda: self.stopped or job in self.cancelled
+
+    # Завершение установки: освобождение того, что транспорт держал на время установки.
+    def close(self):
+        pass
+
+    # Сброс флага останова перед новой установкой. Уровни сжатия сохраняются между установками.
+    def reset(self):
+        self.stopped = False
+        self.agents = set()
+        self.compressors = {}
+        self.cancelled = set()
+
+    # Сжатия, доступные на хосте hostname (None - этот компьютер).
+    def probe_compressors(self, hostname):
+        return set(name for name in Compression.LEVELS if shutil.which(name))
+
+    # Сжатие для копирования между хостами hostnames (None - этот компьютер) по Globals.compression:
+    # первое из доступных на всех или None. Сжимает первый из hostnames (источник), уровень подбирается
+    # отдельно для каждого источника.
+    def compression(self, *hostnames):
+        if Globals.compression == 'auto':
+            names = list(Compression.LEVELS)
+        else:
+            names = [Globals.compression] if Globals.compression else []
+        for hostname in hostnames:
+            with self.lock:
+                available = self.compressors.get(hostname)
+            if available is None:
+                available = self.probe_compressors(hostname)
+                with self.lock:
+                    self.compressors[hostname] = available
+            names = [name for name in names if name in available]
+        if not names:
+            return None
+        key = (names[0], hostnames[0] if hostnames else None)
+        with self.lock:
+            if key not in self.compressions:
+                self.compressions[key] = Compression(*key)
+            return self.compressions[key]
+
+    # Копирование tar-потоком, со сжатием; command(сжатие или None) - команда копирования. Уровень сжатия
+    # подстраивается по времени копирования size байт.
+    def tar_copy(self, compression, command, size, files):
+        started = time.time()
+        returncode = self.run(command(compression), input=files_from(files)).returncode
+        if returncode == 0 and compression:
+            compression.record(size, time.time() - started)
+        return returncode
+
+    # Подготовка каталога установки: останов процессов из него и очистка (wipe=False - каталог сохраняется).
+    def prepare(self, hostname, path, wipe=True):
+        raise NotImplementedError
+
+    # Манифест base*.txt, лежащий в каталоге установки: (имя файла, текст) или None, если его нет.
+    def read_manifest(self, hostname, path):
+        raise NotImplementedError
+
+    # Удаление файлов (пути относительно path).
+    def remove(self, hostname, path, files):
+        raise NotImplementedError
+
+    # Удаление всех файлов, кроме files (пути относительно path).
+    def prune(self, hostname, path, files):
+        raise NotImplementedError
+
+    # Чтение небольшого текстового файла на хосте: текст или None, если его нет.
+    def read_file(self, hostname, file):
+        raise NotImplementedError
+
+    # Запись небольшого текстового файла на хосте.
+    def write_file(self, hostname, file, text):
+        raise NotImplementedError
+
+    # Копирование локального каталога на хост. files - только эти файлы (пути относительно source_path).
+    def push(self, source_path, hostname, path, delete=False, files=None):
+        raise NotImplementedError
+
+    # Копирование с хоста на хост, выполняется на source_hostname. Без files - с удалением лишнего.
+    def relay(self, source_hostname, source_path, hostname, path, files=None):
+        raise NotImplementedError
+
+    # Команда запуска сессии agent.py serve на хосте или None, если агент туда не попал.
+    def agent_command(self, hostname):
+        raise NotImplementedError
+
+    # Путь path на хосте hostname так, как его видит агент.
+    def agent_path(self, hostname, path):
+        return path
+
+    # Копирование на пустой каталог tar-потоком со сжатием: без пофайловых проверок rsync, быстрее на множестве
+    # мелких файлов. Лишнее на приёмнике не удаляется. size - сколько байт копируется (для подбора уровня сжатия).
+    def push_tar(self, source_path, hostname, path, files=None, size=0):
+        raise NotImplementedError
+
+    def relay_tar(self, source_hostname, source_path, hostname, path, files=None, size=0):
+        raise NotImplementedError
+
+    # Выполнение на хосте скрипта script (путь относительно path) из каталога path.
+    # Если задан output (файл, открытый на запись в двоичном режиме), туда пишутся stdout и stderr.
+    def execute(self, hostname, path, script, output=None):
+        raise NotImplementedError
+
+    # Проверка каталога по манифесту (только файлов files, если задано). Возвращает (код возврата, список файлов
+    # с ошибками), found(файл) вызывается для каждого файла с ошибкой по мере нахождения.
+    def verify(self, hostname, path, manifest, found=lambda file: None, files=None):
+        raise NotImplementedError
+
+    # Копирование файлов files потоком tar с проверкой по манифесту на приёмнике по мере записи (agent.py receive).
+    # source_hostname=None - с локального компьютера из source_path. rest - проверить чтением файлы манифеста,
+    # не вошедшие в files; delete - удалить на приёмнике всё, что не вошло в files.
+    # Возвращает (код возврата, список файлов с ошибками): 1 - есть ошибки, другой ненулевой - сбой копирования.
+    def stream(self, source_hostname, source_path, hostname, path, files, manifest, rest=False, delete=False,
+               found=lambda file: None):
+        raise NotImplementedError
+
+    # Звено цепочки для agent.py chain: {"host", "path" - каталог установки на хосте, "command" - запуск агента
+    # на хосте с предыдущего звена (first - с этого компьютера)}.
+    def chain_hop(self, hostname, path, first=False):
+        raise NotImplementedError
+
+    # Цепочка: tar-поток файлов files из source_path (каталог или ArchiveBase) идёт на первый хост hostnames, тот
+    # пишет его с проверкой по манифесту и одновременно передаёт следующему, и так далее (agent.py chain).
+    # found(хост, файл) - файл не совпал с манифестом. Возвращает {хост: код возврата, как у stream};
+    # 255 - хост пропущен или не сообщил о результате (оборвалось звено перед ним).
+    def chain(self, source_path, hostnames, path, files, manifest, found=lambda hostname, file: None):
+        hops = [self.chain_hop(hostname, path, i == 0) for i, hostname in enumerate(hostnames)]
+        helpers.Logger.i('Цепочка: %s' % ' -> '.join(hostnames))
+        results = {}
+
+        def report(message):
+            if 'found' in message:
+                found(message['host'], message['found'])
+            elif 'rc' in message:
+                results[message['host']] = message['rc']
+                if message.get('error'):
+                    helpers.Logger.w('%s: %s' % (message['host'], message['error']))
+        process, reader = agent.start_chain(hops, {'manifest': manifest}, report, sys.platform != 'win32')
+        if process:
+            with self.lock:
+                self.processes.add(process)
+            try:
+                feed_stdin(lambda stream: send_tar(stream, source_path, stream_order(files, manifest),
+                                                   self.halted()), process.stdin)
+                process.wait()
+                reader.join()
+            finally:
+                with self.lock:
+                    self.processes.discard(process)
+        return dict((hostname, results.get(hostname, 255)) for hostname in hostnames)
+
+
+# Соединения ssh с хостами открываются один раз за установку (ControlMaster) и переиспользуются всеми командами:
+# подготовка каталога, rsync, agent.py, conf, post. Вложенные соединения с источника на приёмник не объединяются:
+# каждая пара источник-приёмник и так соединяется один-два раза.
+class SshTransport(Transport):
+    CONTROL_PERSIST = 600  # Секунд простоя, после которых соединение закрывается само (если установщик упал)
+
+    def __init__(self):
+        super().__init__()
+        self.control_dir = ''  # Каталог сокетов ControlPath, создаётся на установку
+        self.masters = {}  # hostname -> Event: основное соединение установлено (или не удалось)
+
+    def reset(self):
+        self.close()
+        super().reset()
+        self.control_dir = tempfile.mkdtemp(prefix='installer-ssh-')
+
+    # Закрытие основных соединений в конце установки.
+    def close(self):
+        with self.lock:
+            hostnames = list(self.masters)
+            control_dir = self.control_dir
+            self.masters = {}
+            self.control_dir = ''
+        for hostname in hostnames:
+            subprocess.run('ssh -O exit -o ControlPath="%s/%%C" root@%s' % (control_dir, hostname), shell=True,
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if control_dir:
+            shutil.rmtree(control_dir, ignore_errors=True)
+
+    # Основное соединение с хостом: ssh -M -N -f уходит в фон после входа, с закрытыми stdin/stdout/stderr,
+    # чтобы не держать каналы команд, которые им пользуются. Пока оно открывается, остальные команды к хосту ждут.
+    def connect(self, hostname):
+        with self.lock:
+            if not self.control_dir:
+                return
+            ready = self.masters.get(hostname)
+            opening = ready is None
+            if opening:
+                ready = self.masters[hostname] = threading.Event()
+        if not opening:
+            ready.wait()
+            return
+        try:
+            self.run('ssh -M -N -f -o ControlPersist=%d -o ControlPath="%s/%%C" root@%s'
+                     % (SshTransport.CONTROL_PERSIST, self.control_dir, hostname),
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            ready.set()
+
+    # Параметры ssh для работы через основное соединение. Если его нет, ssh соединяется сам, как раньше.
+    def ssh_options(self, hostname):
+        self.connect(hostname)
+        with self.lock:
+            control_dir = self.control_dir
+        return '-o ControlMaster=no -o ControlPath=%s/%%C' % control_dir if control_dir else ''
+
+    def ssh_command(self, hostname):
+        return ('ssh ' + self.ssh_options(hostname)).strip()
+
+    def ssh(self, hostname):
+        return '%s root@%s' % (self.ssh_command(hostname), hostname)
+
+    def prepare(self, hostname, path, wipe=True):
+        # TODO Сделать останов процессов из места установки для Linux!
+        if not wipe:
+            return self.run('%s "mkdir -p \\"%s\\""' % (self.ssh(hostname), path)).returncode
+        return self.run('%s "rm -rf \\"%s\\" ; mkdir -p \\"%s\\""' % (self.ssh(hostname), path, path)).returncode
+
+    def read_manifest(self, hostname, path):
+        r = self.run('%s "cd \\"%s\\" && set -- base*.txt && [ \\$# -eq 1 ] && [ -f \\"\\$1\\" ]'
+                     ' && echo \\"\\$1\\" && cat \\"\\$1\\""' % (self.ssh(hostname), path),
+                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if r.returncode != 0:
+            return None
+        name, _, text = r.stdout.decode(errors='ignore').partition('\n')
+        return name.strip(), text
+
+    def remove(self, hostname, path, files):
+        return self.run('%s "cd \\"%s\\" && xargs -d \'\\n\' rm -f --"' % (self.ssh(hostname), path),
+                        input=files_from(files)).returncode
+
+    def prune(self, hostname, path, files):
+        if self.install_agent(hostname) != 0:
+            return 1
+        return self.run('%s "cd \\"%s\\" && python3 %s prune"' % (self.ssh(hostname), path, agent_remote_path()),
+                        input=files_from(files)).returncode
+
+    def read_file(self, hostname, file):
+        r = self.run('%s "cat \\"%s\\""' % (self.ssh(hostname), file),
+                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return r.stdout.decode(errors='ignore') if r.returncode == 0 else None
+
+    def write_file(self, hostname, file, text):
+        return self.run('%s "cat > \\"%s\\""' % (self.ssh(hostname), file), input=text.encode()).returncode
+
+    def push(self, source_path, hostname, path, delete=False, files=None):
+        additional_params = ''
+        if delete:
+            additional_params = '--delete'
+        if files is not None:
+            additional_params += ' -I --files-from=-'
+        return self.run('rsync -a --partial-dir=%s -e "%s" %s "%s/" root@%s:"%s"'
+                        % (PARTIAL_DIR, self.ssh_command(hostname), additional_params, source_path, hostname, path),
+                        input=files_from(files)).returncode
+
+    def relay(self, source_hostname, source_path, hostname, path, files=None):
+        additional_params = '--delete' if files is None else '-I --files-from=-'
+        return self.run('%s "rsync -a --partial-dir=%s %s \\"%s/\\" root@%s:\\"%s\\""'
+                        % (self.ssh(source_hostname), PARTIAL_DIR, additional_params, source_path, hostname, path),
+                        input=files_from(files)).returncode
+
+    def probe_compressors(self, hostname):
+        if hostname is None:
+            return super().probe_compressors(hostname)
+        r = self.run('%s %s' % (self.ssh(hostname), shlex.quote(' '.join(
+            'command -v %s >/dev/null && echo %s;' % (name, name) for name in Compression.LEVELS))),
+                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return set(r.stdout.decode(errors='ignore').split())
+
+    def push_tar(self, source_path, hostname, path, files=None, size=0):
+        def command(compression):
+            receiver = 'mkdir -p "%s" && %star -C "%s" -xf -' \
+                       % (path, compression.decompress() + ' | ' if compression else '', path)
+            return '%s | %s%s %s' % (tar_create(source_path, files),
+                                       compression.compress() + ' | ' if compression else '',
+                                       self.ssh(hostname), shlex.quote(receiver))
+        return self.tar_copy(self.compression(None, hostname), command, size, files)
+
+    def relay_tar(self, source_hostname, source_path, hostname, path, files=None, size=0):
+        def command(compression):
+            receiver = 'mkdir -p "%s" && %star -C "%s" -xf -' \
+                       % (path, compression.decompress() + ' | ' if compression else '', path)
+            sender = '%s | %sssh root@%s %s' % (tar_create(source_path, files),
+                                                  compression.compress() + ' | ' if compression else '',
+                                                  hostname, shlex.quote(receiver))
+            return '%s %s' % (self.ssh(source_hostname), shlex.quote(sender))
+        return self.tar_copy(self.compression(source_hostname, hostname), command, size, files)
+
+    def execute(self, hostname, path, script, output=None):
+        return self.run('%s "cd \\"%s\\" && chmod +x %s/*.sh; ./%s"'
+                        % (self.ssh(hostname), path, os.path.dirname(script), script),
+                        stdout=output, stderr=subprocess.STDOUT if output else None).returncode
+
+    # Копирование agent.py на хост, один раз за установку. Имя зависит от содержимого,
+    # поэтому оставшийся от прошлых версий агент не используется.
+    def install_agent(self, hostname):
+        with self.lock:
+            if hostname in self.agents:
+                return 0
+        returncode = self.run('scp -q %s "%s" root@%s:%s' % (self.ssh_options(hostname), agent_file(), hostname,
+                                                               agent_remote_path())).returncode
+        if returncode == 0:
+            with self.lock:
+                self.agents.add(hostname)
+        return returncode
+
+    def agent_command(self, hostname):
+        if self.install_agent(hostname) != 0:
+            return None
+        return '%s %s' % (self.ssh(hostname), shlex.quote('python3 %s serve' % agent_remote_path()))
+
+    # Первое звено - через общее соединение с хостом, следующие запускает на хосте предыдущее звено, как и rsync
+    # при копировании между хостами.
+    def chain_hop(self, hostname, path, first=False):
+        command = 'python3 %s chain' % agent_remote_path()
+        if first:
+            command = '%s %s' % (self.ssh(hostname), shlex.quote(command))
+        else:
+            command = ['ssh', 'root@%s' % hostname, command]
+        return {'host': hostname, 'path': path, 'command': command}
+
+    # Агент нужен на всех хостах цепочки до её запуска; хост, куда он не скопировался, пропускается.
+    def chain(self, source_path, hostnames, path, files, manifest, found=lambda hostname, file: None):
+        installed = dict(agent.parallel(lambda hostname: (hostname, self.install_agent(hostname)), hostnames))
+        results = super().chain(source_path, [hostname for hostname in hostnames if installed[hostname] == 0],
+                                path, files, manifest, found)
+        return dict((hostname, results.get(hostname, 255)) for hostname in hostnames)
+
+    def verify(self, hostname, path, manifest, found=lambda file: None, files=None):
+        if self.install_agent(hostname) != 0:
+            return 1, []
+        mismatched = []
+
+        def line(file):
+            if file.strip():
+                mismatched.append(file)
+                found(file)
+        r = self.run('%s "cd \\"%s\\" && python3 %s verify%s %s"'
+                     % (self.ssh(hostname), path, agent_remote_path(), '' if files is None else ' -T -', manifest),
+                     stderr=subprocess.DEVNULL, lines=line, input=files_from(files))
+        return r.returncode, mismatched
+
+    def stream(self, source_hostname, source_path, hostname, path, files, manifest, rest=False, delete=False,
+               found=lambda file: None):
+        if self.install_agent(hostname) != 0:
+            return 255, []
+        files = stream_order(files, manifest)
+        mismatched = []
+
+        def line(file):
+            if file.strip():
+                mismatched.append(file)
+                found(file)
+        receiver = 'mkdir -p "%s" && cd "%s" && python3 %s receive%s%s %s' \
+                   % (path, path, agent_remote_path(), ' --rest' if rest else '', ' --delete' if delete else '',
+                      shlex.quote(manifest))
+        if source_hostname:
+            # Поток идёт с источника напрямую на приёмник, список файлов - в stdin tar на источнике.
+            sender = 'cd "%s" && tar -cf - --no-recursion --verbatim-files-from -T - | ssh root@%s %s' \
+                     % (source_path, hostname, shlex.quote(receiver))
+            r = self.run('%s %s' % (self.ssh(source_hostname), shlex.quote(sender)),
+                         input=files_from(files), lines=line)
+        else:
+            r = self.run('%s %s' % (self.ssh(hostname), shlex.quote(receiver)), lines=line,
+                         feed=lambda stdin: send_tar(stdin, source_path, files, self.halted()))
+        return r.returncode, mismatched
+
+
+class WindowsTransport(Transport):
+    files_supported = False  # xcopy копирует каталог целиком
+    stream_supported = False  # На хостах нет python3 для agent.py
+    tar_supported = False
+    agent_supported = False
+    cancel_supported = False  # Процессы останавливает taskkill, только все сразу (terminate)
+
+    def __init__(self, local_hostname):
+        super().__init__()
+        self.local_hostname = local_hostname
+
+    def terminate(self):
+        self.stopped = True
+        with self.lock:
+            processes = list(self.processes)
+        cmd = r'taskkill /t /f'
+        for r in processes:
+            cmd += r' /pid ' + str(r.pid)
+        if processes:
+            subprocess.run(cmd, shell=True)
+
+    def prepare(self, hostname, path, wipe=True):
+        # Останов процессов, запущенных из места установки.
+        if self.local_hostname != hostname:
+            auth = ' /node:"%s" /user:"%s" /password:"%s"' \
+                   % (hostname, Globals.samba_login, Globals.samba_password)
+        else:
+            auth = ''
+        r = self.run(r'wmic%s process list full' % auth, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        processes = []
+        for line in list(filter(None, [line.strip() for line in r.stdout.decode(errors='ignore').splitlines()])):
+            if line.startswith('ExecutablePath='):
+                processes.append([line.split('=')[1], None])
+            if line.startswith('Handle=') and not processes[-1][1]:
+                processes[-1][1] = line.split('=')[1]
+        for process in processes:
+            if process[0].lower().startswith(path.lower()):
+                if self.local_hostname != hostname:
+                    auth = ' /s %s /u %s /p %s' % (hostname, Globals.samba_login, Globals.samba_password)
+                else:
+                    auth = ''
+                self.run('taskkill%s /t /f /pid %s' % (auth, process[1]))
+        if not wipe:
+            return 0
+
+        # Удаление существующего каталога установки.
+        if self.local_hostname != hostname:
+            auth = r'PsExec64.exe -accepteula -nobanner \\%s -u %s -p %s -c -f ' \
+                   % (hostname, Globals.samba_login, Globals.samba_password)
+        else:
+            auth = ''
+        return self.run(r'%smake-empty.exe "%s"' % (auth, path)).returncode
+
+    def push(self, source_path, hostname, path, delete=False, files=None):
+        # cmd = 'robocopy "%s" "\\\\%s\\%s" /e /mt:32 /r:0 /w:0 /np /nfl /njh /njs /ndl /nc /ns > nul 2>&1' \
+        #       % (source_path, hostname, path.replace(':', '$'))
+        return self.run('xcopy "%s" "\\\\%s\\%s" /seyq > nul 2>&1'
+                        % (source_path, hostname, path.replace(':', '$'))).returncode
+
+    def relay(self, source_hostname, source_path, hostname, path, files=None):
+        # cmd = 'PsExec64.exe -accepteula -nobanner \\\\%s -u %s -p %s robocopy %s \\\\%s\\%s /e /mt:32 /r:0 /w:0 /np /nfl /njh /njs /ndl /nc /ns > nul 2>&1' \
+        #       % (source_hostname,
+        #          login, password,
+        #          path, destination_hostname, path.replace(':', '$'))
+        return self.run('PsExec64.exe -accepteula -nobanner \\\\%s -u %s -p %s xcopy "%s" "\\\\%s\\%s" /seyq > nul 2>&1'
+                        % (source_hostname, Globals.samba_login, Globals.samba_password,
+                           source_path, hostname, path.replace(':', '$'))).returncode
+
+    def execute(self, hostname, path, script, output=None):
+        return self.run(r'PsExec64.exe \\%s -u %s -p %s %s'
+                        % (hostname, Globals.samba_login, Globals.samba_password,
+                           os.path.join(path, script)),
+                        stdout=output, stderr=subprocess.STDOUT if output else None).returncode
+
+    # verify-md5 проверяет манифест целиком, files не учитывается (копирование по списку не поддерживается).
+    def verify(self, hostname, path, manifest, found=lambda file: None, files=None):
+        if self.local_hostname != hostname:
+            cmd = (r'PsExec64.exe -accepteula -nobanner \\%s -u %s -p %s -w %s -c -f verify-md5.exe %s'
+                   % (hostname, Globals.samba_login, Globals.samba_password, path, manifest))
+        else:
+            cmd = (r'cd /d %s & %s'
+                   % (path, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                         'verify-md5.exe %s' % manifest)))
+        r = self.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        mismatched = list(filter(None, [file.strip() for file in r.stdout.decode(errors='ignore').split('\n')]))
+        for file in mismatched:
+            found(file)
+        return r.returncode, mismatched
+
+
+class LocalTransport(Transport):
+    def __init__(self, root):
+        super().__init__()
+        self.root = os.path.abspath(root)
+
+    # Каталог, соответствующий пути path на хосте hostname.
+    def host_path(self, hostname, path):
+        return os.path.join(self.root, hostname, path.replace(':', '').lstrip('/\\'))
+
+    # Аналог rsync -a: копируются файлы, у которых отличается размер или время изменения.
+    # files - копировать только эти файлы (пути относительно source) и без сверки, как rsync -I --files-from.
+    def sync(self, source, destination, delete, files=None):
+        copied = set()
+        listed = files is not None
+        if files is None:
+            files = []
+            for dirpath, dirnames, filenames in os.walk(source):
+                relative = os.path.relpath(dirpath, source)
+                os.makedirs(os.path.normpath(os.path.join(destination, relative)), exist_ok=True)
+                files.extend(os.path.join(relative, f) for f in filenames)
+                files.extend(os.path.join(relative, d) for d in dirnames if os.path.islink(os.path.join(dirpath, d)))
+        halted = self.halted()
+        for relative in files:
+            if halted():
+                return 1
+            relative = os.path.normpath(relative)
+            s = os.path.join(source, relative)
+            d = os.path.join(destination, relative)
+            os.makedirs(os.path.dirname(d), exist_ok=True)
+            copied.add(relative)
+            if os.path.islink(s) or os.path.islink(d):  # Ссылки копируются ссылками, как rsync -a
+                if os.path.isdir(d) and not os.path.islink(d):
+                    shutil.rmtree(d)
+                elif os.path.lexists(d):
+                    os.remove(d)
+                if os.path.islink(s):
+                    os.symlink(os.readlink(s), d)
+                    continue
+            if not listed:
+                ss = os.stat(s)
+                try:
+                    ds = os.stat(d)
+                    if ds.st_size == ss.st_size and int(ds.st_mtime) == int(ss.st_mtime):
+                        continue
+                except OSError:
+                    pass
+            shutil.copy2(s, d)
+        if delete:
+            for dirpath, dirnames, filenames in os.walk(destination):
+                relative = os.path.relpath(dirpath, destination)
+                for f in filenames:
+                    if os.path.normpath(os.path.join(relative, f)) not in copied:
+                        os.remove(os.path.join(dirpath, f))
+        return 0
+
+    def prepare(self, hostname, path, wipe=True):
+        d = self.host_path(hostname, path)
+        if wipe:
+            shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(d, exist_ok=True)
+        return 0
+
+    def read_manifest(self, hostname, path):
+        g = glob.glob(os.path.join(self.host_path(hostname, path), 'base*.txt'))
+        if len(g) != 1:
+            return None
+        with open(g[0], errors='ignore') as f:
+            return os.path.basename(g[0]), f.read()
+
+    def remove(self, hostname, path, files):
+        d = self.host_path(hostname, path)
+        for file in files:
+            try:
+                os.remove(os.path.join(d, file))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                helpers.Logger.e('%s: %s' % (hostname, e))
+                return 1
+        return 0
+
+    def prune(self, hostname, path, files):
+        try:
+            agent.prune(self.host_path(hostname, path), set(os.path.normpath(f) for f in files))
+        except OSError as e:
+            helpers.Logger.e('%s: %s' % (hostname, e))
+            return 1
+        return 0
+
+    def read_file(self, hostname, file):
+        try:
+            with open(self.host_path(hostname, file), errors='ignore') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write_file(self, hostname, file, text):
+        try:
+            os.makedirs(os.path.dirname(self.host_path(hostname, file)), exist_ok=True)
+            with open(self.host_path(hostname, file), 'w') as f:
+                f.write(text)
+        except OSError as e:
+            helpers.Logger.e('%s: %s' % (hostname, e))
+            return 1
+        return 0
+
+    def push(self, source_path, hostname, path, delete=False, files=None):
+        try:
+            return self.sync(source_path, self.host_path(hostname, path), delete, files)
+        except OSError as e:
+            helpers.Logger.e('%s: %s' % (hostname, e))
+            return 1
+
+    def relay(self, source_hostname, source_path, hostname, path, files=None):
+        return self.push(self.host_path(source_hostname, source_path), hostname, path, files is None, files)
+
+    # Агент запускается здесь же, пути хоста - каталоги в root.
+    def agent_command(self, hostname):
+        return '"%s" "%s" serve' % (sys.executable, agent_file())
+
+    def chain_hop(self, hostname, path, first=False):
+        return {'host': hostname, 'path': self.host_path(hostname, path),
+                'command': [sys.executable, agent_file(), 'chain']}
+
+    def agent_path(self, hostname, path):
+        return self.host_path(hostname, path)
+
+    # Тот же конвейер tar | сжатие | распаковка | tar, что у SshTransport, только без ssh.
+    def push_tar(self, source_path, hostname, path, files=None, size=0):
+        d = self.host_path(hostname, path)
+        os.makedirs(d, exist_ok=True)
+
+        def command(compression):
+            return '%s | %star -C "%s" -xf -' % (
+                tar_create(source_path, files),
+                '%s | %s | ' % (compression.compress(), compression.decompress()) if compression else '', d)
+        return self.tar_copy(self.compression(None), command, size, files)
+
+    def relay_tar(self, source_hostname, source_path, hostname, path, files=None, size=0):
+        return self.push_tar(self.host_path(source_hostname, source_path), hostname, path, files, size)
+
+    def execute(self, hostname, path, script, output=None):
+        return self.run('sh "%s"' % script, cwd=self.host_path(hostname, path),
+                        stdout=output, stderr=subprocess.STDOUT if output else None).returncode
+
+    # Тот же приём, что у agent.py receive на хосте, но в этом процессе: tar пишется в канал из другого потока.
+    def stream(self, source_hostname, source_path, hostname, path, files, manifest, rest=False, delete=False,
+               found=lambda file: None):
+        if source_hostname:
+            source_path = self.host_path(source_hostname, source_path)
+        d = self.host_path(hostname, path)
+        os.makedirs(d, exist_ok=True)
+        files = stream_order(files, manifest)
+        mismatched = []
+
+        def line(file):
+            mismatched.append(file)
+            found(file)
+        halted = self.halted()
+        read, write = os.pipe()
+        with open(read, 'rb') as reader, open(write, 'wb') as writer:
+            sender = threading.Thread(target=feed_stdin,
+                                      args=(lambda stream: send_tar(stream, source_path, files, halted),
+                                            writer))
+            sender.start()
+            try:
+                agent.receive(d, reader, manifest, rest, delete, found=line)
+                returncode = 1 if mismatched else 0
+            except (OSError, agent.ManifestError, tarfile.TarError) as e:
+                helpers.Logger.e('%s: %s' % (hostname, e))
+                returncode = 2
+            # Если приёмник остановился раньше, отправитель не должен ждать записи в полный канал.
+            reader.close()
+            sender.join()
+        return returncode, mismatched
+
+    # Та же проверка, что у agent.py на хосте, но в этом процессе.
+    def verify(self, hostname, path, manifest, found=lambda file: None, files=None):
+        d = self.host_path(hostname, path)
+        mismatched = []
+        try:
+            with open(os.path.join(d, manifest), encoding='utf-8', errors='ignore') as f:
+                entries = agent.select(agent.read_manifest(f), files)
+        except (OSError, agent.ManifestError) as e:
+            helpers.Logger.e('%s: %s' % (hostname, e))
+            return 2, []
+
+        def line(file):
+            mismatched.append(file)
+            found(file)
+        agent.verify(d, entries, found=line)
+        return (1 if mismatched else 0), mismatched
+
+
+# Запись tar-потока кадрами D сессии агента: кадры до CHUNK байт, в конце пустой кадр.
+class FrameWriter:
+    def __init__(self, stream, id):
+        self.stream = stream
+        self.id = id
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= agent.CHUNK:
+            agent.write_frame(self.stream, b'D', self.id, bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            agent.write_frame(self.stream, b'D', self.id, bytes(self.buffer))
+            self.buffer = bytearray()
+        agent.write_frame(self.stream, b'D', self.id, b'')
+
+
+# Сессия agent.py serve на одном хосте. Запросы из разных потоков пишутся сразу, не дожидаясь ответов
+# на предыдущие (агент выполняет их по очереди), ответы разбирает отдельный поток.
+class AgentSession:
+    def __init__(self, command):
+        helpers.Logger.i(command)
+        self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        start_new_session=sys.platform != 'win32')
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # Запрос receive пишется вместе со своим tar-потоком
+        self.next_id = 0
+        self.pending = {}  # Номер запроса -> ожидающий ответа, см. request
+        self.alive = True
+        threading.Thread(target=self.read_replies, daemon=True).start()
+
+    def read_replies(self):
+        while True:
+            frame = agent.read_frame(self.process.stdout)
+            if frame is None:
+                break
+            kind, id, payload = frame
+            with self.lock:
+                waiter = self.pending.get(id)
+            if not waiter:
+                continue
+            if kind == b'D':
+                waiter['output'](payload)
+                continue
+            message = json.loads(payload.decode())
+            if 'found' in message:
+                waiter['found'](message['found'])
+                continue
+            waiter['reply'] = message
+            waiter['done'].set()
+        with self.lock:
+            self.alive = False
+            waiters = list(self.pending.values())
+        for waiter in waiters:
+            if waiter['reply'] is None:
+                waiter['reply'] = {'rc': 255, 'error': 'Сессия агента прервана'}
+            waiter['done'].set()
+
+    # Запрос op с параметрами params; feed(файл) пишет tar-поток запроса receive. Возвращает ответ агента.
+    def request(self, op, feed=None, found=lambda file: None, output=lambda data: None, **params):
+        with self.lock:
+            if not self.alive:
+                return {'rc': 255, 'error': 'Сессия агента прервана'}
+            self.next_id += 1
+            id = self.next_id
+            waiter = self.pending[id] = {'done': threading.Event(), 'reply': None, 'found': found, 'output': output}
+        try:
+            with self.write_lock:
+                agent.write_frame(self.process.stdin, b'J', id, json.dumps(dict(params, id=id, op=op)).encode())
+                if feed:
+                    writer = FrameWriter(self.process.stdin, id)
+                    try:
+                        feed(writer)
+                    finally:  # Конец потока пишется и при сбое, иначе следующий запрос примут за его продолжение
+                        writer.close()
+        except (OSError, ValueError) as e:
+            helpers.Logger.w('Запрос %s агенту: %s' % (op, e))
+        waiter['done'].wait()
+        with self.lock:
+            del self.pending[id]
+        return waiter['reply']
+
+    def close(self):
+        if self.alive:
+            self.request('exit')
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (OSError, AttributeError):
+            self.process.kill()
+
+
+# Транспорт, выполняющий шаги на хосте (подготовка каталога, приём base и conf, проверка, post-скрипт, отметка)
+# запросами к сессии agent.py serve, которая запускается на хост один раз за установку, вместо отдельной
+# команды на каждый шаг. Копирование между хостами и запуск сессии - у транспорта inner.
+class AgentTransport(Transport):
+    def __init__(self, inner):
+        super().__init__()
+        self.inner = inner
+        self.files_supported = inner.files_supported
+        self.stream_supported = inner.stream_supported
+        self.tar_supported = inner.tar_supported
+        self.cancel_supported = False  # Запрос к сессии агента не прерывается отдельно от сессии
+        self.sessions = {}  # hostname -> AgentSession
+        self.starting = {}  # hostname -> Lock на время запуска сессии
+
+    def session(self, hostname):
+        with self.lock:
+            starting = self.starting.setdefault(hostname, threading.Lock())
+        with starting:
+            with self.lock:
+                session = self.sessions.get(hostname)
+            if session and session.alive:
+                return session
+            command = self.inner.agent_command(hostname)
+            if command is None or self.stopped:
+                return None
+            session = AgentSession(command)
+            with self.lock:
+                self.sessions[hostname] = session
+            return session
+
+    # Запрос к агенту на хосте: ответ со статусом rc и временем выполнения seconds.
+    def call(self, hostname, op, **params):
+        session = self.session(hostname)
+        if not session:
+            return {'rc': 255, 'error': 'Агент не запущен'}
+        reply = session.request(op, **params)
+        if reply.get('error'):
+            helpers.Logger.e('%s: %s: %s' % (hostname, op, reply['error']))
+        helpers.Logger.i('%s: %s rc=%d %.2fs' % (hostname, op, reply['rc'], reply.get('seconds', 0)))
+        return reply
+
+    def terminate(self):
+        self.stopped = True
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.kill()
+        self.inner.terminate()
+
+    def reset(self):
+        self.close_sessions()
+        super().reset()
+        self.inner.reset()
+
+    def close(self):
+        self.close_sessions()
+        self.inner.close()
+
+    def close_sessions(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+    def prepare(self, hostname, path, wipe=True):
+        return self.call(hostname, 'prepare', path=self.inner.agent_path(hostname, path), wipe=wipe)['rc']
+
+    def read_manifest(self, hostname, path):
+        reply = self.call(hostname, 'read_manifest', path=self.inner.agent_path(hostname, path))
+        return (reply['name'], reply['text']) if reply['rc'] == 0 else None
+
+    def remove(self, hostname, path, files):
+        return self.call(hostname, 'remove', path=self.inner.agent_path(hostname, path),
+                         files=[f.replace(os.sep, '/') for f in files])['rc']
+
+    def prune(self, hostname, path, files):
+        return self.call(hostname, 'prune', path=self.inner.agent_path(hostname, path),
+                         files=[f.replace(os.sep, '/') for f in files])['rc']
+
+    def read_file(self, hostname, file):
+        reply = self.call(hostname, 'read_file', path=self.inner.agent_path(hostname, file))
+        return reply['text'] if reply['rc'] == 0 else None
+
+    def write_file(self, hostname, file, text):
+        return self.call(hostname, 'write_file', path=self.inner.agent_path(hostname, file), text=text)['rc']
+
+    # Копирование с этого компьютера - tar-потоком в сессию, без отдельного rsync.
+    def push(self, source_path, hostname, path, delete=False, files=None):
+        if files is None:
+            files = []
+            for dirpath, dirnames, filenames in os.walk(source_path):
+                files.extend(os.path.relpath(os.path.join(dirpath, f), source_path) for f in filenames)
+                # Ссылки на каталоги os.walk отдаёт в dirnames: передаются ссылками, как в LocalTransport.sync.
+                files.extend(os.path.relpath(os.path.join(dirpath, d), source_path)
+                             for d in dirnames if os.path.islink(os.path.join(dirpath, d)))
+        return self.call(hostname, 'receive', path=self.inner.agent_path(hostname, path), delete=delete,
+                         feed=lambda stream: send_tar(stream, source_path, files, lambda: self.stopped))['rc']
+
+    def relay(self, source_hostname, source_path, hostname, path, files=None):
+        return self.inner.relay(source_hostname, source_path, hostname, path, files)
+
+    # Цепочка идёт мимо сессий: каждое звено запускает агент chain на следующем хосте само.
+    def chain(self, source_path, hostnames, path, files, manifest, found=lambda hostname, file: None):
+        return self.inner.chain(source_path, hostnames, path, files, manifest, found)
+
+    def push_tar(self, source_path, hostname, path, files=None, size=0):
+        return self.inner.push_tar(source_path, hostname, path, files, size)
+
+    def relay_tar(self, source_hostname, source_path, hostname, path, files=None, size=0):
+        return self.inner.relay_tar(source_hostname, source_path, hostname, path, files, size)
+
+    def execute(self, hostname, path, script, output=None):
+        write = output.write if output else lambda data: None
+        return self.call(hostname, 'execute', path=self.inner.agent_path(hostname, path),
+                         script=script.replace(os.sep, '/'), output=write)['rc']
+
+    def verify(self, hostname, path, manifest, found=lambda file: None, files=None):
+        mismatched = []
+
+        def line(file):
+            mismatched.append(file)
+            found(file)
+        reply = self.call(hostname, 'verify', path=self.inner.agent_path(hostname, path), manifest=manifest,
+                          files=None if files is None else [f.replace(os.sep, '/') for f in files], found=line)
+        return reply['rc'], mismatched
+
+    def stream(self, source_hostname, source_path, hostname, path, files, manifest, rest=False, delete=False,
+               found=lambda file: None):
+        if source_hostname:
+            return self.inner.stream(source_hostname, source_path, hostname, path, files, manifest, rest, delete,
+                                     found)
+        files = stream_order(files, manifest)
+        mismatched = []
+
+        def line(file):
+            mismatched.append(file)
+            found(file)
+        reply = self.call(hostname, 'receive', path=self.inner.agent_path(hostname, path), manifest=manifest,
+                          rest=rest, delete=delete, found=line,
+                          feed=lambda stream: send_tar(stream, source_path, files, lambda: self.stopped))
+        return reply['rc'], mismatched
+
+
+def default_transport(local_hostname):
+    if sys.platform == 'win32':
+        return WindowsTransport(local_hostname)
+    return SshTransport()